@@ -0,0 +1,406 @@
+import datetime
+import hashlib
+import hmac
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from contextlib import redirect_stdout
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+"""
+    Exercises the Bittrex v3 adapter (selective_dca_bot/exchanges/bittrex_exchange.py)
+    offline, against a local fake of the v3 REST API.
+
+    The fake serves markets, tickers, ~60 days of random-walk hourly candles
+    (recent + historical endpoints, including the still-open candle), signed
+    order endpoints and the batch endpoint, and fills LIMIT SELLs on demand.
+    Checks that candles are caught up in one call per market, that older gaps
+    come from the historical endpoint, that sell targets are replaced in a few
+    batch requests (but not ones whose cancel failed) and that fills are
+    reconciled from the open/closed order lists.
+
+    To run (from the `src` dir):
+        python -m benchmarks.bittrex_v3_stub
+"""
+API_KEY = 'stub-key'
+API_SECRET = 'stub-secret'
+HOUR = 3600
+NUM_DAYS = 60
+
+
+
+def iso(timestamp):
+    return datetime.datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+
+class FakeBittrex():
+    def __init__(self, symbols, seed=1):
+        rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.unsigned = 0
+        self.markets = []
+        self.candles = {}
+        self.orders = {}
+
+        # Up to and including the currently open candle
+        open_hour = int(time.time() // HOUR * HOUR)
+        start = open_hour - NUM_DAYS * 24 * HOUR
+        for symbol in symbols:
+            (crypto, base) = symbol.split('-')
+            self.markets.append({
+                "symbol": symbol,
+                "baseCurrencySymbol": crypto,
+                "quoteCurrencySymbol": base,
+                "minTradeSize": "0.01000000",
+                "precision": 8,
+                "status": "ONLINE",
+                "createdAt": "2014-02-13T00:00:00Z",
+            })
+
+            price = rng.uniform(0.001, 0.05)
+            candles = []
+            for timestamp in range(start, open_hour + HOUR, HOUR):
+                close = price * (1 + rng.gauss(0, 0.01))
+                candles.append({
+                    "startsAt": iso(timestamp),
+                    "timestamp": timestamp,
+                    "open": f"{price:.8f}",
+                    "high": f"{max(price, close) * 1.005:.8f}",
+                    "low": f"{min(price, close) * 0.995:.8f}",
+                    "close": f"{close:.8f}",
+                    "volume": "100.0",
+                    "quoteVolume": "1.0",
+                })
+                price = close
+            self.candles[symbol] = candles
+
+
+    def count(self, method, prefix):
+        return len([r for r in self.requests if r[0] == method and r[1].startswith(prefix)])
+
+
+    def price(self, symbol):
+        return Decimal(self.candles[symbol][-1]["close"])
+
+
+    def tickers(self):
+        return [{
+            "symbol": symbol,
+            "lastTradeRate": f"{self.price(symbol):.8f}",
+            "bidRate": f"{self.price(symbol) * Decimal('0.999'):.8f}",
+            "askRate": f"{self.price(symbol) * Decimal('1.001'):.8f}",
+        } for symbol in self.candles]
+
+
+    def candle_response(self, candles):
+        return [{k: v for (k, v) in c.items() if k != 'timestamp'} for c in candles]
+
+
+    def recent_candles(self, symbol):
+        cutoff = self.candles[symbol][-1]["timestamp"] - 31 * 24 * HOUR
+        return self.candle_response([c for c in self.candles[symbol] if c["timestamp"] > cutoff])
+
+
+    def historical_candles(self, symbol, year, month):
+        prefix = f"{year:04d}-{month:02d}-"
+        candles = [c for c in self.candles[symbol][:-1] if c["startsAt"].startswith(prefix)]
+        if not candles:
+            return (404, {"code": "NOT_FOUND"})
+        return (200, self.candle_response(candles))
+
+
+    def place_order(self, order):
+        symbol = order["marketSymbol"]
+        quantity = Decimal(order["quantity"])
+        if quantity < Decimal('0.01'):
+            return (409, {"code": "MIN_TRADE_REQUIREMENT_NOT_MET"})
+
+        now = iso(time.time())
+        result = {
+            "id": str(uuid.uuid4()),
+            "marketSymbol": symbol,
+            "direction": order["direction"],
+            "type": order["type"],
+            "quantity": order["quantity"],
+            "timeInForce": order["timeInForce"],
+            "clientOrderId": order.get("clientOrderId"),
+            "fillQuantity": "0.00000000",
+            "commission": "0.00000000",
+            "proceeds": "0.00000000",
+            "status": "OPEN",
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        if order["type"] == 'LIMIT':
+            result["limit"] = order["limit"]
+        else:
+            # Market orders fill immediately at the ask/bid
+            price = self.price(symbol) * (Decimal('1.001') if order["direction"] == 'BUY' else Decimal('0.999'))
+            proceeds = price * quantity
+            result.update({
+                "fillQuantity": order["quantity"],
+                "proceeds": f"{proceeds:.8f}",
+                "commission": f"{proceeds * Decimal('0.002'):.8f}",
+                "status": "CLOSED",
+                "closedAt": now,
+            })
+        self.orders[result["id"]] = result
+        return (201, result)
+
+
+    def cancel_order(self, order_id):
+        order = self.orders.get(order_id)
+        if not order:
+            return (404, {"code": "NOT_FOUND"})
+        if order["status"] != 'OPEN':
+            return (409, {"code": "ORDER_NOT_OPEN"})
+        order["status"] = "CLOSED"
+        order["closedAt"] = iso(time.time())
+        return (200, order)
+
+
+    def fill(self, order_ids):
+        with self.lock:
+            for order_id in order_ids:
+                order = self.orders[order_id]
+                proceeds = Decimal(order["limit"]) * Decimal(order["quantity"])
+                order.update({
+                    "fillQuantity": order["quantity"],
+                    "proceeds": f"{proceeds:.8f}",
+                    "commission": f"{proceeds * Decimal('0.002'):.8f}",
+                    "status": "CLOSED",
+                    "closedAt": iso(time.time()),
+                })
+
+
+    def closed_orders(self, params):
+        orders = sorted(
+            [o for o in self.orders.values() if o["status"] == 'CLOSED' and o["marketSymbol"] == params["marketSymbol"][0]],
+            key=lambda o: (o["closedAt"], o["id"]), reverse=True)
+        if "startDate" in params:
+            orders = [o for o in orders if o["closedAt"] >= params["startDate"][0]]
+        if "nextPageToken" in params:
+            index = [o["id"] for o in orders].index(params["nextPageToken"][0])
+            orders = orders[index + 1:]
+        return orders[:int(params.get("pageSize", ["100"])[0])]
+
+
+    def handle(self, method, path, params, body):
+        parts = path.strip('/').split('/')[1:]     # drop the 'v3'
+        if parts == ['markets']:
+            return (200, self.markets)
+        if parts == ['markets', 'tickers']:
+            return (200, self.tickers())
+        if len(parts) >= 5 and parts[0] == 'markets' and parts[2] == 'candles':
+            if parts[4] == 'recent':
+                return (200, self.recent_candles(parts[1]))
+            return self.historical_candles(parts[1], int(parts[5]), int(parts[6]))
+
+        if parts == ['orders', 'open']:
+            return (200, [o for o in self.orders.values() if o["status"] == 'OPEN' and o["marketSymbol"] == params["marketSymbol"][0]])
+        if parts == ['orders', 'closed']:
+            return (200, self.closed_orders(params))
+        if parts == ['orders'] and method == 'POST':
+            return self.place_order(body)
+        if len(parts) == 2 and parts[0] == 'orders':
+            if method == 'DELETE':
+                return self.cancel_order(parts[1])
+            return (200, self.orders[parts[1]]) if parts[1] in self.orders else (404, {"code": "NOT_FOUND"})
+        if parts == ['batch']:
+            results = []
+            for operation in body:
+                if operation["operation"] == 'DELETE':
+                    (status, payload) = self.cancel_order(operation["payload"]["id"])
+                else:
+                    (status, payload) = self.place_order(operation["payload"])
+                results.append({"status": status, "payload": payload})
+            return (200, results)
+        if parts == ['balances']:
+            currencies = {m["baseCurrencySymbol"] for m in self.markets} | {m["quoteCurrencySymbol"] for m in self.markets}
+            return (200, [{"currencySymbol": c, "total": "1000000.0", "available": "1000000.0"} for c in sorted(currencies)])
+
+        return (404, {"code": "NOT_FOUND"})
+
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, exchange):
+        super().__init__(address, StubHandler)
+        self.exchange = exchange
+
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'      # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def _verify_signature(self, method, content):
+        uri = f"http://{self.headers['Host']}{self.path}"
+        content_hash = hashlib.sha512(content).hexdigest()
+        pre_sign = self.headers.get('Api-Timestamp', '') + uri + method + content_hash
+        signature = hmac.new(API_SECRET.encode('utf-8'), pre_sign.encode('utf-8'), hashlib.sha512).hexdigest()
+        return (self.headers.get('Api-Key') == API_KEY and
+                self.headers.get('Api-Content-Hash') == content_hash and
+                self.headers.get('Api-Signature') == signature)
+
+    def _respond(self, method):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        content = self.rfile.read(length) if length else b''
+
+        exchange = self.server.exchange
+        with exchange.lock:
+            exchange.requests.append((method, url.path))
+            if not url.path.startswith('/v3/markets') and not self._verify_signature(method, content):
+                exchange.unsigned += 1
+                (status, body) = (401, {"code": "INVALID_SIGNATURE"})
+            else:
+                (status, body) = exchange.handle(method, url.path, parse_qs(url.query), json.loads(content) if content else None)
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def do_DELETE(self):
+        self._respond('DELETE')
+
+
+
+def check(name, passed, detail):
+    print(f"{'PASS' if passed else 'FAIL'}: {name} ({detail})")
+    return passed
+
+
+
+if __name__ == '__main__':
+    from selective_dca_bot import config
+
+    directory = tempfile.mkdtemp()
+    config.SQLITE_DB_FILE = os.path.join(directory, 'bittrex_stub.db')
+    config.RATE_LIMITS = {}
+    config.GAP_REPAIR_SLEEP = 0
+    config.is_test = True
+    config.verbose = False
+
+    from selective_dca_bot import trading
+    from selective_dca_bot.exchanges import BittrexExchange, EXCHANGE__BITTREX
+    from selective_dca_bot.models import AllTimeWatchlist, Candle, LongPosition, Market
+    from selective_dca_bot.position_book import PositionBook
+
+    cryptos = ['LTC', 'ETH', 'XLM']
+    fake = FakeBittrex([f"{crypto}-BTC" for crypto in cryptos])
+    server = StubServer(('localhost', 0), fake)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config.BITTREX_API_URL = f"http://localhost:{server.server_address[1]}/v3"
+    config.interval = Candle.INTERVAL__1HOUR
+
+    AllTimeWatchlist.create(exchange=EXCHANGE__BITTREX, watchlist=",".join(cryptos))
+    exchange = BittrexExchange(API_KEY, API_SECRET, cryptos)
+    results = []
+    log = io.StringIO()
+
+    # Catching up on candles: one 'recent' call per market, never the open candle
+    with redirect_stdout(log):
+        metrics = exchange.calculate_latest_metrics('BTC', Candle.INTERVAL__1HOUR, [200])
+    last_closed = fake.candles['LTC-BTC'][-2]["timestamp"]
+    results.append(check("metrics from one candle call per market",
+                         len(metrics) == 3 and fake.count('GET', '/v3/markets/LTC-BTC/candles') == 1 and fake.count('GET', '/v3/markets') - fake.count('GET', '/v3/markets/') == 1,
+                         f"{fake.count('GET', '/v3/markets/LTC-BTC/candles')} LTC candle calls, {len(metrics)} markets"))
+    results.append(check("open candle not ingested",
+                         int(Candle.get_last_candle('LTCBTC', Candle.INTERVAL__1HOUR).timestamp) == last_closed,
+                         f"last candle {Candle.get_last_candle('LTCBTC', Candle.INTERVAL__1HOUR).timestamp}, last closed {last_closed}"))
+
+    # Older candles come from the monthly historical endpoint
+    first = fake.candles['LTC-BTC'][0]["timestamp"]
+    with redirect_stdout(log):
+        exchange.ingest_candle_range('LTCBTC', Candle.INTERVAL__1HOUR, first, last_closed)
+    num_candles = Candle.select().where(Candle.market_id == Market.get_id('LTCBTC'), Candle.interval == Candle.INTERVAL__1HOUR).count()
+    results.append(check("candle range filled from historical + recent",
+                         num_candles == len(fake.candles['LTC-BTC']) - 1,
+                         f"{num_candles} candles, {fake.count('GET', '/v3/markets/LTC-BTC/candles/HOUR_1/historical')} historical calls"))
+
+    # Buys plus their initial LIMIT SELLs, all with UUID order ids
+    with redirect_stdout(log):
+        for i in range(30):
+            crypto = cryptos[i % len(cryptos)]
+            market = f"{crypto}BTC"
+            results_buy = exchange.buy(market, Decimal('1.5'))
+            position = LongPosition.create(
+                exchange=EXCHANGE__BITTREX,
+                market=market,
+                buy_order_id=results_buy['order_id'],
+                buy_quantity=results_buy['quantity'],
+                purchase_price=results_buy['price'],
+                fees=results_buy['fees'],
+                timestamp=results_buy['timestamp'],
+                watchlist=",".join(cryptos),
+            )
+            sell = exchange.limit_sell(market, position.buy_quantity, position.purchase_price * Decimal('1.5'))
+            position.sell_order_id = sell['order_id']
+            position.sell_price = sell['price']
+            position.sell_quantity = sell['quantity']
+            position.save()
+    num_open = len([o for o in fake.orders.values() if o["status"] == 'OPEN'])
+    results.append(check("buys and LIMIT SELLs placed",
+                         num_open == 30 and isinstance(LongPosition.get_by_id(1).sell_order_id, str),
+                         f"{num_open} open orders"))
+
+    # Repricing cancels + replaces through the batch endpoint. One LIMIT SELL
+    #   fills just before, so its DELETE fails and it mustn't be replaced.
+    already_filled = LongPosition.get_by_id(1).sell_order_id
+    fake.fill([already_filled])
+    with redirect_stdout(log):
+        trading.update_limit_sell_targets({EXCHANGE__BITTREX: exchange}, metrics, Decimal('1.01'))
+    num_batches = fake.count('POST', '/v3/batch')
+    open_orders = {o["id"] for o in fake.orders.values() if o["status"] == 'OPEN'}
+    positions = list(LongPosition.select())
+    results.append(check("sell targets replaced in batches",
+                         num_batches == 2 * len(cryptos) and len(open_orders) == 29 and all(p.sell_order_id in open_orders for p in positions[1:]),
+                         f"{num_batches} batch requests for 29 replacements, {fake.count('DELETE', '/v3/orders')} single cancels"))
+    results.append(check("no replacement when the cancel fails",
+                         positions[0].sell_order_id == already_filled and len(fake.orders) == 30 * 2 + 29,
+                         f"{len(fake.orders)} orders placed, position 1 still on its filled order"))
+
+    # Fill half of them and reconcile
+    exchange._closed_orders_page_size = 10
+    filled = [p.sell_order_id for p in positions[::2]]
+    fake.fill(filled)
+    before = len(fake.requests)
+    with redirect_stdout(log):
+        sold = trading.update_order_statuses({EXCHANGE__BITTREX: exchange}, book=PositionBook.load())
+    num_requests = len(fake.requests) - before
+    results.append(check("fills reconciled from open/closed order lists",
+                         sorted(p.sell_order_id for p in sold) == sorted(filled) and all(p.sell_price for p in sold),
+                         f"{len(sold)} sold, {num_requests} requests, {fake.count('GET', '/v3/orders/closed')} closed-order pages"))
+
+    results.append(check("every signed request verified",
+                         fake.unsigned == 0,
+                         f"{len(fake.requests)} requests, {fake.unsigned} rejected"))
+
+    server.shutdown()
+    sys.exit(0 if all(results) else 1)
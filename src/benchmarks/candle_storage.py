@@ -0,0 +1,181 @@
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+
+"""
+    Compares the old candle layout (market name + float timestamp in a rowid
+    table, with a separate primary key index) against the interned, WITHOUT
+    ROWID layout that migrations/0009_candle_market_ids.py converts it to.
+
+    Builds a legacy-layout DB, copies it and runs the migration on the copy,
+    then reports each one's on-disk size and candle pages (via dbstat), and
+    times the two hot range scans: the last 200 closes for an MA and a
+    market's full history for back-tests. Both are run with a small page
+    cache so page reads dominate.
+
+    To run (from the `src` dir):
+        python -m benchmarks.candle_storage
+        python -m benchmarks.candle_storage --markets 50 --hours 17520
+"""
+parser = argparse.ArgumentParser(description='Selective DCA Bot candle storage benchmark')
+
+parser.add_argument('--markets', type=int, default=20, dest="num_markets",
+                    help="Number of synthetic markets")
+
+parser.add_argument('--hours', type=int, default=365 * 24, dest="num_hours",
+                    help="Hourly candles per market")
+
+parser.add_argument('--repeat', type=int, default=5, dest="repeat",
+                    help="Timed repetitions per query")
+
+parser.add_argument('--cache-kb', type=int, default=256, dest="cache_kb",
+                    help="SQLite page cache size for the timed queries")
+
+parser.add_argument('--dir', default="benchmarks", dest="directory",
+                    help="Where to build the two DBs")
+
+HOUR = 3600
+INTERVAL__1HOUR = 4
+
+
+
+def build_legacy_db(db_file, num_markets, num_hours, seed=1):
+    """
+        The candle table as the pre-0009 Candle model created it.
+    """
+    rng = random.Random(seed)
+    con = sqlite3.connect(db_file)
+    con.execute('''
+        CREATE TABLE "candle" (
+            "market" VARCHAR(255) NOT NULL,
+            "interval" INTEGER NOT NULL,
+            "timestamp" DATETIME NOT NULL,
+            "open" DECIMAL(10, 5) NOT NULL,
+            "high" DECIMAL(10, 5) NOT NULL,
+            "low" DECIMAL(10, 5) NOT NULL,
+            "close" DECIMAL(10, 5) NOT NULL,
+            "rsi_1min" DECIMAL(10, 5),
+            PRIMARY KEY ("market", "interval", "timestamp"))''')
+
+    end = int(time.time()) // HOUR * HOUR - HOUR
+    start = end - (num_hours - 1) * HOUR
+    prices = [10 ** rng.uniform(-6, -1.5) for i in range(num_markets)]
+
+    # Candles arrive hour by hour across every market, like the bot ingests them
+    with con:
+        for hour in range(num_hours):
+            rows = []
+            for i in range(num_markets):
+                open = prices[i]
+                close = open * (1 + rng.gauss(0, 0.01))
+                prices[i] = close
+                rows.append((f"C{i:03d}BTC", INTERVAL__1HOUR, float(start + hour * HOUR),
+                             f"{open:.8f}", f"{max(open, close) * 1.003:.8f}", f"{min(open, close) * 0.997:.8f}", f"{close:.8f}"))
+            con.executemany('INSERT INTO "candle" VALUES (?, ?, ?, ?, ?, ?, ?, NULL)', rows)
+    con.close()
+    return end
+
+
+
+def candle_pages(db_file):
+    con = sqlite3.connect(db_file)
+    pages = con.execute('''
+        SELECT SUM(pgsize) / (SELECT page_size FROM pragma_page_size), COUNT(DISTINCT name)
+        FROM dbstat
+        WHERE name = 'candle' OR name LIKE 'sqlite_autoindex_candle%' ''').fetchone()
+    con.close()
+    return pages
+
+
+
+def time_queries(db_file, layout, num_markets, end, repeat, cache_kb):
+    con = sqlite3.connect(db_file)
+    con.execute(f"PRAGMA cache_size = -{cache_kb}")
+    if layout == 'legacy':
+        keys = [f"C{i:03d}BTC" for i in range(num_markets)]
+        ma_sql = '''SELECT "close" FROM "candle" WHERE "market" = ? AND "interval" = ? AND "timestamp" <= ?
+                    ORDER BY "timestamp" DESC LIMIT 200'''
+        history_sql = '''SELECT "timestamp", "close" FROM "candle" WHERE "market" = ? AND "interval" = ?
+                         ORDER BY "timestamp"'''
+    else:
+        ids = dict(con.execute('SELECT "name", "id" FROM "market"'))
+        keys = [ids[f"C{i:03d}BTC"] for i in range(num_markets)]
+        ma_sql = '''SELECT "close" FROM "candle" WHERE "market_id" = ? AND "interval" = ? AND "timestamp" <= ?
+                    ORDER BY "timestamp" DESC LIMIT 200'''
+        history_sql = '''SELECT "timestamp", "close" FROM "candle" WHERE "market_id" = ? AND "interval" = ?
+                         ORDER BY "timestamp"'''
+
+    def timed(func):
+        timings = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings)
+
+    # MAs at a spread of points in time, as the performance report / back-tests ask for them
+    points = [end - HOUR * h for h in range(0, 24 * 30, 24)]
+    results = {
+        "ma_200": timed(lambda: [con.execute(ma_sql, (key, INTERVAL__1HOUR, point)).fetchall()
+                                 for key in keys for point in points]),
+        "full_history": timed(lambda: [con.execute(history_sql, (key, INTERVAL__1HOUR)).fetchall()
+                                       for key in keys]),
+    }
+    con.close()
+    return results
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    legacy_file = os.path.join(args.directory, "candles_legacy.db")
+    migrated_file = os.path.join(args.directory, "candles_migrated.db")
+    for path in (legacy_file, migrated_file):
+        if os.path.exists(path):
+            os.remove(path)
+
+    print(f"Building {args.num_markets} markets x {args.num_hours} candles")
+    end = build_legacy_db(legacy_file, args.num_markets, args.num_hours)
+    con = sqlite3.connect(legacy_file)
+    con.execute("VACUUM")
+    con.close()
+
+    shutil.copyfile(legacy_file, migrated_file)
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, os.path.join(os.path.dirname(__file__), '..', 'migrations', '0009_candle_market_ids.py'), migrated_file])
+    print(f"Migrated in {time.perf_counter() - start:0.1f}s")
+
+    con = sqlite3.connect(migrated_file)
+    counts = [sqlite3.connect(legacy_file).execute('SELECT COUNT(*) FROM "candle"').fetchone()[0],
+              con.execute('SELECT COUNT(*) FROM "candle"').fetchone()[0]]
+    con.close()
+    if counts[0] != counts[1]:
+        print(f"FAIL: migration kept {counts[1]} of {counts[0]} candles")
+        sys.exit(1)
+
+    results = {}
+    for (layout, db_file) in (('legacy', legacy_file), ('migrated', migrated_file)):
+        (pages, num_btrees) = candle_pages(db_file)
+        results[layout] = dict(
+            size=os.path.getsize(db_file),
+            pages=pages,
+            num_btrees=num_btrees,
+            **time_queries(db_file, layout, args.num_markets, end, args.repeat, args.cache_kb))
+
+    print(f"{'':>14} {'legacy':>12} {'migrated':>12}")
+    for (name, fmt) in (('size', '{:,}'), ('pages', '{:,}'), ('num_btrees', '{}'), ('ma_200', '{:0.4f}s'), ('full_history', '{:0.4f}s')):
+        legacy = results['legacy'][name]
+        migrated = results['migrated'][name]
+        ratio = f"{legacy / migrated:0.2f}x" if migrated else ""
+        print(f"{name:>14} {fmt.format(legacy):>12} {fmt.format(migrated):>12} {ratio:>8}")
+
+    for path in (legacy_file, migrated_file):
+        os.remove(path)
@@ -0,0 +1,189 @@
+import time
+
+from contextlib import contextmanager
+from decimal import Decimal
+from unittest import mock
+
+from selective_dca_bot.exchanges import BinanceExchange, binance_exchange
+from selective_dca_bot.exchanges.abstract_exchange import AbstractExchange
+from selective_dca_bot.models import LongPosition
+
+
+"""
+    In-process stand-in for python-binance's Client so the real BinanceExchange
+    code paths (order reconciliation, cancel/replace, candle ingest) can be timed
+    without touching the network.
+"""
+HOUR = 3600
+
+
+
+class FakeBinanceClient():
+    def __init__(self, fill_ratio=0.1, last_closes=None):
+        self.fill_ratio = fill_ratio
+        self.last_closes = last_closes or {}
+        self.orders = {}
+        self.trades = []
+        self.next_order_id = 9000000000
+        self.next_trade_id = 0
+        self.num_calls = 0
+
+
+    def load_open_orders(self):
+        """
+            Mirror every open LIMIT SELL in the DB as an exchange-side order. Every
+            Nth order is reported as FILLED so reconciliation has work to do.
+        """
+        every = int(1 / self.fill_ratio) if self.fill_ratio else None
+        positions = LongPosition.select(
+                LongPosition.market, LongPosition.sell_order_id, LongPosition.sell_price,
+                LongPosition.sell_quantity, LongPosition.timestamp
+            ).where(
+                LongPosition.sell_order_id.is_null(False),
+                LongPosition.sell_timestamp.is_null(True)
+            ).tuples()
+        for index, (market, order_id, price, quantity, timestamp) in enumerate(positions):
+            status = 'FILLED' if every and index % every == 0 else 'NEW'
+            self.orders[order_id] = self._order(market, order_id, price, quantity, status, timestamp)
+            if status == 'FILLED':
+                self._trade(market, order_id, price, quantity, timestamp + HOUR)
+
+
+    def _order(self, symbol, order_id, price, quantity, status, timestamp):
+        return {
+            "symbol": symbol,
+            "orderId": order_id,
+            "price": f"{price:0.8f}",
+            "origQty": str(quantity),
+            "executedQty": str(quantity) if status == 'FILLED' else "0.00000000",
+            "status": status,
+            "type": "LIMIT",
+            "side": "SELL",
+            "stopPrice": "0.00000000",
+            "time": int(timestamp * 1000),
+            "updateTime": int(timestamp * 1000) + HOUR * 1000,
+        }
+
+
+    def _trade(self, symbol, order_id, price, quantity, timestamp):
+        self.next_trade_id += 1
+        self.trades.append({
+            "symbol": symbol,
+            "id": self.next_trade_id,
+            "orderId": order_id,
+            "price": f"{price:0.8f}",
+            "qty": str(quantity),
+            "quoteQty": f"{price * quantity:0.8f}",
+            "commission": f"{price * quantity * Decimal('0.001'):0.8f}",
+            "commissionAsset": "BTC",
+            "time": int(timestamp * 1000),
+            "isBuyer": False,
+            "isMaker": True,
+        })
+
+
+    def get_my_trades(self, symbol, fromId=0, limit=500):
+        self.num_calls += 1
+        return [t for t in self.trades if t['symbol'] == symbol and t['id'] >= fromId][:limit]
+
+
+    def get_all_orders(self, symbol, orderId, limit=500):
+        self.num_calls += 1
+        results = [o for o in self.orders.values() if o['symbol'] == symbol and o['orderId'] >= orderId]
+        return sorted(results, key=lambda o: o['orderId'])[:limit]
+
+
+    def get_order(self, symbol, orderId):
+        self.num_calls += 1
+        return self.orders[orderId]
+
+
+    def cancel_order(self, symbol, orderId):
+        self.num_calls += 1
+        order = self.orders[orderId]
+        order['status'] = 'CANCELED'
+        return order
+
+
+    def order_limit_sell(self, symbol, quantity, price, **kwargs):
+        self.num_calls += 1
+        self.next_order_id += 1
+        now = time.time()
+        self.orders[self.next_order_id] = self._order(symbol, self.next_order_id, Decimal(price), quantity, 'NEW', now)
+        return {
+            "orderId": self.next_order_id,
+            "transactTime": int(now * 1000),
+        }
+
+
+    def get_klines(self, symbol, interval, startTime=None, endTime=None, limit=500):
+        self.num_calls += 1
+        price = self.last_closes.get(symbol, Decimal('0.0001'))
+        start_ms = startTime if startTime else (int(time.time()) - limit * HOUR) * 1000
+        # First candle that opens at or after startTime
+        start = -(-start_ms // (HOUR * 1000)) * HOUR
+        if endTime:
+            limit = min(limit, int((int(endTime / 1000) - start) / HOUR) + 1)
+        return [
+            [(start + i * HOUR) * 1000, f"{price:0.8f}", f"{price:0.8f}", f"{price:0.8f}", f"{price:0.8f}",
+             "0", (start + (i + 1) * HOUR) * 1000 - 1, "0", 0, "0", "0", "0"]
+            for i in range(limit)
+        ]
+
+
+    def get_order_book(self, symbol, limit=100):
+        # Each level 0.1% further from the last close, with less size the deeper it goes
+        self.num_calls += 1
+        price = self.last_closes.get(symbol, Decimal('0.0001'))
+        return {
+            "bids": [[f"{price * (1 - Decimal('0.001') * i):0.8f}", f"{100.0 / (i + 1):0.8f}"] for i in range(limit)],
+            "asks": [[f"{price * (1 + Decimal('0.001') * i):0.8f}", f"{100.0 / (i + 1):0.8f}"] for i in range(limit)],
+        }
+
+
+    def get_orderbook_tickers(self):
+        self.num_calls += 1
+        return [{
+                "symbol": symbol,
+                "bidPrice": f"{price:0.8f}",
+                "bidQty": "100.0",
+                "askPrice": f"{price:0.8f}",
+                "askQty": "100.0",
+            } for (symbol, price) in self.last_closes.items()]
+
+
+    def get_account(self):
+        self.num_calls += 1
+        balances = {symbol[:-3]: '1000000.0' for symbol in self.last_closes}
+        balances['BTC'] = '1000000.0'
+        return {"balances": [{"asset": asset, "free": free, "locked": "0.00000000"} for (asset, free) in balances.items()]}
+
+
+    def get_all_tickers(self):
+        self.num_calls += 1
+        return [{"symbol": symbol, "price": f"{price:0.8f}"} for (symbol, price) in self.last_closes.items()]
+
+
+    def get_ticker(self, symbol):
+        self.num_calls += 1
+        return {"lastPrice": f"{self.last_closes.get(symbol, Decimal('0.0001')):0.8f}"}
+
+
+
+class FakeBinanceExchange(BinanceExchange):
+    def __init__(self, watchlist, client=None):
+        AbstractExchange.__init__(self, None, None, watchlist)
+        self.client = client or FakeBinanceClient()
+
+
+    def ingest_latest_candles(self, market, interval, since=None, limit=5):
+        # Skip the real adapter's API-limit breather; it would dominate the timings
+        with no_sleep():
+            return super().ingest_latest_candles(market, interval, since=since, limit=limit)
+
+
+
+@contextmanager
+def no_sleep():
+    with mock.patch.object(binance_exchange.time, 'sleep', lambda seconds: None):
+        yield
@@ -0,0 +1,77 @@
+import argparse
+import json
+import os
+import time
+
+from selective_dca_bot import config
+
+
+"""
+    Builds a synthetic DB at a multiple of the benchmark dataset's size (50
+    markets x 2 years of hourly candles, 20k LongPositions) for load testing:
+    --scale 10 is ~8.8M candles and 200k positions, --scale 100 ~88M candles
+    and 2M positions.
+
+    Writes the same <db>.json as run_benchmarks.py, so the benchmark suite can
+    run against it with --reuse. The bot and the reports can be pointed at it
+    with SQLITE_DB_FILE.
+
+    To run (from the `src` dir):
+        python -m benchmarks.load_test_db --scale 10 --db benchmarks/load_10x.db
+        python -m benchmarks.run_benchmarks --db benchmarks/load_10x.db --reuse
+"""
+parser = argparse.ArgumentParser(description='Selective DCA Bot load test DB generator')
+
+parser.add_argument('--scale', type=float, default=10, dest="scale",
+                    help="Multiple of the benchmark dataset's markets and positions")
+
+parser.add_argument('--markets', type=int, default=None, dest="num_markets",
+                    help="Number of synthetic markets (overrides --scale)")
+
+parser.add_argument('--hours', type=int, default=2 * 365 * 24, dest="num_hours",
+                    help="Hourly candles per market")
+
+parser.add_argument('--positions', type=int, default=None, dest="num_positions",
+                    help="Number of synthetic LongPositions (overrides --scale)")
+
+parser.add_argument('--seed', type=int, default=1, dest="seed",
+                    help="Random seed; the same seed and sizes build the same DB")
+
+parser.add_argument('--db', default="benchmarks/load.db", dest="db_file",
+                    help="Where to build the synthetic SQLite db")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    num_markets = args.num_markets or int(50 * args.scale)
+    num_positions = args.num_positions or int(20000 * args.scale)
+
+    for suffix in ('', '-wal', '-shm', '.json'):
+        if os.path.exists(args.db_file + suffix):
+            os.remove(args.db_file + suffix)
+
+    # Must be set before the models are imported; they bind to the db at import time
+    config.SQLITE_DB_FILE = args.db_file
+    config.is_test = True
+    config.verbose = False
+
+    from selective_dca_bot.models import db, LongPosition
+    from .synthetic_data import generate_dataset
+
+    print(f"Generating {num_markets} markets x {args.num_hours} candles ({num_markets * args.num_hours:,}), {num_positions:,} positions")
+    start = time.perf_counter()
+    dataset = generate_dataset(num_markets=num_markets, num_hours=args.num_hours,
+                               num_positions=num_positions, seed=args.seed)
+    dataset['generation_seconds'] = time.perf_counter() - start
+
+    # Fold the WAL back in so the file size is the DB's
+    db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+    dataset['db_bytes'] = os.path.getsize(args.db_file)
+
+    num_canceled = LongPosition.select().where(LongPosition.sell_order_id.is_null(True)).count()
+    print(f"Generated in {dataset['generation_seconds']:0.1f}s: {dataset['db_bytes'] / 2**20:0.0f} MiB")
+    print(f"    {dataset['num_sold']:,} sold, {num_positions - dataset['num_sold'] - num_canceled:,} open, {num_canceled:,} with a canceled LIMIT SELL")
+
+    with open(f"{args.db_file}.json", 'w') as f:
+        json.dump(dataset, f, indent=4)
@@ -0,0 +1,134 @@
+import argparse
+import gc
+import os
+import statistics
+import time
+import tracemalloc
+
+from decimal import Decimal
+
+from selective_dca_bot import config
+
+
+"""
+    Measures the read paths' time and peak memory with full peewee model
+    instances against the lightweight rows they now read (tuples, namedtuples
+    and PositionRows, streamed with .iterator()):
+
+        * the last 200 closes for an MA (Candle.calculate_moving_average)
+        * a market's full candle history, as a back-test would load it
+        * every position, live and archived, as the reports and back-tests
+          load them (PositionHistory.get_rows)
+
+    To run (from the `src` dir):
+        python -m benchmarks.read_paths
+        python -m benchmarks.read_paths --markets 20 --hours 17520 --positions 100000
+"""
+parser = argparse.ArgumentParser(description='Selective DCA Bot read path benchmark')
+
+parser.add_argument('--markets', type=int, default=10, dest="num_markets",
+                    help="Number of synthetic markets")
+
+parser.add_argument('--hours', type=int, default=2 * 365 * 24, dest="num_hours",
+                    help="Hourly candles per market")
+
+parser.add_argument('--positions', type=int, default=50000, dest="num_positions",
+                    help="Number of synthetic LongPositions")
+
+parser.add_argument('--repeat', type=int, default=5, dest="repeat",
+                    help="Timed repetitions per read")
+
+parser.add_argument('--db', default="benchmarks/read_paths.db", dest="db_file",
+                    help="Where to build the synthetic SQLite db")
+
+
+
+def measure(func, repeat):
+    """
+        (median seconds, peak bytes allocated) for `func`, which returns what
+        the caller would hold on to.
+    """
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+        del result
+
+    gc.collect()
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return (statistics.median(timings), peak)
+
+
+
+def report(name, models, rows):
+    (model_seconds, model_peak) = models
+    (row_seconds, row_peak) = rows
+    print(f"{name}:")
+    print(f"    model instances: {model_seconds:8.4f}s | peak {model_peak / 2**20:8.2f} MiB")
+    print(f"    rows:            {row_seconds:8.4f}s | peak {row_peak / 2**20:8.2f} MiB"
+          f"  ({model_seconds / row_seconds:0.1f}x faster, {model_peak / max(row_peak, 1):0.1f}x less memory)")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db_file + suffix):
+            os.remove(args.db_file + suffix)
+
+    # Must be set before the models are imported; they bind to the db at import time
+    config.SQLITE_DB_FILE = args.db_file
+    config.is_test = True
+    config.verbose = False
+
+    from selective_dca_bot.models import Candle, Market, LongPosition, PositionHistory
+    from .synthetic_data import generate_dataset, market_name
+
+    print(f"Generating {args.num_markets} markets x {args.num_hours} candles, {args.num_positions} positions")
+    generate_dataset(num_markets=args.num_markets, num_hours=args.num_hours, num_positions=args.num_positions)
+
+    # Archive the sold ones so PositionHistory spans both tables, like a long-lived account
+    LongPosition.archive_sold()
+
+    interval = Candle.INTERVAL__1HOUR
+    markets = [market_name(i) for i in range(args.num_markets)]
+    last_candles = [Candle.get_last_candle(market, interval) for market in markets]
+
+    def ma_models():
+        mas = []
+        for candle in last_candles:
+            candles = Candle.select().where(
+                    Candle.market_id == candle.market_id,
+                    Candle.interval == interval,
+                    Candle.timestamp <= candle.timestamp
+                ).limit(200).order_by(Candle.timestamp.desc())
+            mas.append(sum((c.close for c in candles), Decimal('0.0')) / Decimal(200))
+        return mas
+
+    def ma_rows():
+        return [candle.calculate_moving_average(200) for candle in last_candles]
+
+    assert ma_models() == ma_rows()
+    report("moving averages (200 closes per market)", measure(ma_models, args.repeat), measure(ma_rows, args.repeat))
+
+    market = markets[0]
+    report(f"{market} full candle history ({args.num_hours} candles)",
+           measure(lambda: list(Candle.select().where(
+                   Candle.market_id == Market.get_id(market), Candle.interval == interval
+               ).order_by(Candle.timestamp)), args.repeat),
+           measure(lambda: list(Candle.get_rows(market, interval)), args.repeat))
+
+    report(f"position history ({args.num_positions} positions)",
+           measure(lambda: list(PositionHistory.select().order_by(PositionHistory.id)), args.repeat),
+           measure(lambda: list(PositionHistory.get_rows()), args.repeat))
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db_file + suffix):
+            os.remove(args.db_file + suffix)
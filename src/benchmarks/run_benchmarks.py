@@ -0,0 +1,243 @@
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+from contextlib import redirect_stdout
+from decimal import Decimal
+
+from selective_dca_bot import config
+
+
+"""
+    Benchmark suite for the bot's hot paths, run against a synthetic dataset.
+
+    To run (from the `src` dir):
+        python -m benchmarks.run_benchmarks
+        python -m benchmarks.run_benchmarks --markets 10 --hours 2000 --positions 2000
+        python -m benchmarks.run_benchmarks --compare benchmarks/results/<old>.json
+
+    Results are written as JSON to benchmarks/results/ keyed by the current git
+    commit so runs can be diffed against each other.
+"""
+parser = argparse.ArgumentParser(description='Selective DCA Bot benchmarks')
+
+parser.add_argument('--markets', type=int, default=50, dest="num_markets",
+                    help="Number of synthetic markets")
+
+parser.add_argument('--hours', type=int, default=2 * 365 * 24, dest="num_hours",
+                    help="Hourly candles per market")
+
+parser.add_argument('--positions', type=int, default=20000, dest="num_positions",
+                    help="Number of synthetic LongPositions")
+
+parser.add_argument('--repeat', type=int, default=5, dest="repeat",
+                    help="Timed repetitions per benchmark")
+
+parser.add_argument('--db', default="benchmarks/bench.db", dest="db_file",
+                    help="Where to build the synthetic SQLite db")
+
+parser.add_argument('--reuse', action='store_true', default=False, dest="reuse",
+                    help="Reuse an existing synthetic db instead of regenerating it")
+
+parser.add_argument('-o', '--output', default=None, dest="output",
+                    help="Results JSON file (default: benchmarks/results/<commit>.json)")
+
+parser.add_argument('--compare', default=None, dest="compare",
+                    help="Earlier results JSON to compare against")
+
+parser.add_argument('-b', '--benchmarks', default=None, dest="only",
+                    help="Comma-separated subset of benchmarks to run")
+
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+
+def timed(func, repeat, setup=None, rollback=True):
+    """
+        Time `func` `repeat` times. With `rollback` every run happens inside a
+        transaction that gets rolled back so writes don't leak into the next run.
+    """
+    from selective_dca_bot.models import db
+
+    timings = []
+    for i in range(repeat):
+        args = setup() if setup else ()
+        with db.atomic() as txn:
+            with redirect_stdout(io.StringIO()):
+                start = time.perf_counter()
+                func(*args)
+                timings.append(time.perf_counter() - start)
+            if rollback:
+                txn.rollback()
+
+    return {
+        "repeat": repeat,
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "max": max(timings),
+    }
+
+
+
+def build_benchmarks(dataset):
+    from selective_dca_bot import trading, utils
+    from selective_dca_bot.buy_decision import BuySnapshot, decide_buy
+    from selective_dca_bot.exchanges import EXCHANGE__BINANCE
+    from selective_dca_bot.models import Candle, AllTimeWatchlist, LongPosition, PortfolioSnapshot
+    from selective_dca_bot.position_book import PositionBook
+
+    from .fake_exchange import FakeBinanceClient, FakeBinanceExchange
+    from .synthetic_data import HOUR
+
+    cryptos = AllTimeWatchlist.get_watchlist(exchange=EXCHANGE__BINANCE)
+    markets = [f"{crypto}BTC" for crypto in cryptos]
+    last_candles = [Candle.get_last_candle(market, Candle.INTERVAL__1HOUR) for market in markets]
+    last_closes = {c.market: c.close for c in last_candles}
+    ma_periods = [200]
+
+    def new_exchange(fill_ratio=0.1):
+        client = FakeBinanceClient(fill_ratio=fill_ratio, last_closes=last_closes)
+        client.load_open_orders()
+        return ({EXCHANGE__BINANCE: FakeBinanceExchange(cryptos, client=client)}, )
+
+    def metrics_for(exchanges):
+        return exchanges[EXCHANGE__BINANCE].calculate_latest_metrics(
+            base_currency='BTC', interval=Candle.INTERVAL__1HOUR, ma_periods=ma_periods)
+
+    def moving_averages():
+        for candle in last_candles:
+            candle.calculate_moving_average(200)
+
+    def batch_create_candles():
+        start = dataset['end_timestamp'] + HOUR
+        candle_data = [{
+                "timestamp": start + i * HOUR,
+                "open": Decimal('0.00012345'),
+                "high": Decimal('0.00012400'),
+                "low": Decimal('0.00012300'),
+                "close": Decimal('0.00012350'),
+            } for i in range(1000)]
+        Candle.batch_create_candles("BENCHBTC", Candle.INTERVAL__1HOUR, candle_data)
+
+    (exchanges, ) = new_exchange()
+    metrics = metrics_for(exchanges)
+
+    def buy_decision():
+        snapshot = BuySnapshot.load('BTC', cryptos, metrics, PositionBook.load(), 2)
+        decide_buy(snapshot, Decimal('0.2'), seed=1)
+
+    # A 500-coin watchlist's worth of metrics, built from the real ones
+    wide_metrics = {}
+    wide_markets = {}
+    for i in range(500):
+        metric = dict(metrics[i % len(metrics)])
+        metric['market'] = f"W{i:03d}BTC"
+        metric['price_to_ma'] = metric['price_to_ma'] * (Decimal('0.9') + Decimal(i % 20) / 100)
+        wide_metrics[metric['market']] = metric
+        wide_markets[metric['market']] = f"W{i:03d}"
+    wide_snapshot = BuySnapshot('BTC', wide_markets, wide_metrics,
+                                {market: i % 7 for (i, market) in enumerate(wide_markets)}, set(list(wide_markets)[:2]))
+
+    return {
+        "calculate_moving_average": (moving_averages, None),
+        "calculate_latest_metrics": (metrics_for, new_exchange),
+        "open_positions_report": (utils.open_positions_report, None),
+        "scalped_positions_report": (utils.scalped_positions_report, None),
+        "generate_performance_report": (lambda: utils.generate_performance_report(test_iterations=100), None),
+        "batch_create_candles": (batch_create_candles, None),
+        "update_limit_sell_targets": (lambda exchanges: trading.update_limit_sell_targets(exchanges, metrics, Decimal('1.05')), new_exchange),
+        "update_order_statuses": (trading.update_order_statuses, new_exchange),
+        "sync_fills": (trading.sync_fills, new_exchange),
+        "portfolio_snapshot": (lambda: PortfolioSnapshot.take('BTC', Candle.INTERVAL__1HOUR), None),
+        "backfill_portfolio_snapshots": (lambda: utils.backfill_portfolio_snapshots('BTC'), None),
+        "archive_sold_positions": (LongPosition.archive_sold, None),
+        "buy_decision": (buy_decision, None),
+        "buy_decision_500": (lambda: decide_buy(wide_snapshot, Decimal('0.2'), seed=1), None),
+    }
+
+
+
+def compare(results, previous_file):
+    with open(previous_file) as f:
+        previous = json.load(f)
+
+    print(f"\nvs {previous['commit']} ({previous['timestamp']}):")
+    for name, result in results['benchmarks'].items():
+        if name not in previous['benchmarks']:
+            continue
+        before = previous['benchmarks'][name]['median']
+        after = result['median']
+        print(f"{name:>28}: {before:9.4f}s -> {after:9.4f}s ({(after - before) / before * 100.0:+7.2f}%)")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    if not args.reuse and os.path.exists(args.db_file):
+        os.remove(args.db_file)
+    db_exists = os.path.exists(args.db_file)
+
+    # Must be set before the models are imported; they bind to the db at import time
+    config.SQLITE_DB_FILE = args.db_file
+    config.is_test = True
+    config.verbose = False
+
+    from selective_dca_bot.models import Candle
+    from .synthetic_data import generate_dataset
+
+    config.interval = Candle.INTERVAL__1HOUR
+
+    if db_exists:
+        print(f"Reusing {args.db_file}")
+        meta_file = f"{args.db_file}.json"
+        with open(meta_file) as f:
+            dataset = json.load(f)
+    else:
+        print(f"Generating {args.num_markets} markets x {args.num_hours} candles, {args.num_positions} positions")
+        start = time.perf_counter()
+        dataset = generate_dataset(
+            num_markets=args.num_markets,
+            num_hours=args.num_hours,
+            num_positions=args.num_positions)
+        dataset['generation_seconds'] = time.perf_counter() - start
+        with open(f"{args.db_file}.json", 'w') as f:
+            json.dump(dataset, f, indent=4)
+        print(f"Generated in {dataset['generation_seconds']:0.1f}s")
+
+    benchmarks = build_benchmarks(dataset)
+    if args.only:
+        benchmarks = {k: v for k, v in benchmarks.items() if k in args.only.split(',')}
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        "python": platform.python_version(),
+        "dataset": dataset,
+        "benchmarks": {},
+    }
+    for name, (func, setup) in benchmarks.items():
+        results['benchmarks'][name] = timed(func, args.repeat, setup=setup)
+        print(f"{name:>28}: median {results['benchmarks'][name]['median']:9.4f}s | min {results['benchmarks'][name]['min']:9.4f}s")
+
+    output = args.output or os.path.join("benchmarks", "results", f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
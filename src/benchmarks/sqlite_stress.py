@@ -0,0 +1,165 @@
+import argparse
+import io
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import time
+
+from contextlib import redirect_stdout
+from decimal import Decimal
+
+
+"""
+    SQLite concurrency stress test: one writer process doing what a trading run
+    does (candle ingest, position updates) while several read-only processes run
+    reports and MA calculations against the same file. Counts "database is
+    locked" errors on each side.
+
+    To run (from the `src` dir):
+        python -m benchmarks.sqlite_stress
+        python -m benchmarks.sqlite_stress --journal-mode delete --busy-timeout 0    # old defaults, for comparison
+"""
+parser = argparse.ArgumentParser(description='Selective DCA Bot SQLite stress test')
+
+parser.add_argument('--readers', type=int, default=4, dest="num_readers",
+                    help="Number of concurrent read-only processes")
+
+parser.add_argument('--seconds', type=float, default=10, dest="seconds",
+                    help="How long to run")
+
+parser.add_argument('--journal-mode', default=None, dest="journal_mode",
+                    help="Override SQLITE_PRAGMAS journal_mode (e.g. 'delete')")
+
+parser.add_argument('--busy-timeout', type=int, default=None, dest="busy_timeout",
+                    help="Override SQLITE_PRAGMAS busy_timeout (ms)")
+
+parser.add_argument('--db', default="benchmarks/stress.db", dest="db_file",
+                    help="Where to build the synthetic SQLite db")
+
+
+
+def configure(db_file, journal_mode, busy_timeout, read_only):
+    from selective_dca_bot import config
+    config.SQLITE_DB_FILE = db_file
+    config.SQLITE_READ_ONLY = read_only
+    config.SQLITE_PRAGMAS = dict(config.SQLITE_PRAGMAS)
+    if journal_mode:
+        config.SQLITE_PRAGMAS['journal_mode'] = journal_mode
+    if busy_timeout is not None:
+        config.SQLITE_PRAGMAS['busy_timeout'] = busy_timeout
+
+
+
+def is_locked_error(e):
+    return 'locked' in str(e) or 'busy' in str(e)
+
+
+
+def writer(db_file, journal_mode, busy_timeout, seconds, results):
+    configure(db_file, journal_mode, busy_timeout, read_only=False)
+    from peewee import OperationalError
+    from selective_dca_bot.models import db, Candle, LongPosition
+    from .synthetic_data import HOUR, market_name
+
+    rng = random.Random(2)
+    last_candle = Candle.get_last_candle(market_name(0), Candle.INTERVAL__1HOUR)
+    timestamp = int(last_candle.timestamp)
+    position_ids = [p.id for p in LongPosition.select(LongPosition.id)]
+
+    num_ops = 0
+    num_locked = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        timestamp += HOUR
+        candle_data = [{
+                "timestamp": timestamp,
+                "open": last_candle.close,
+                "high": last_candle.close,
+                "low": last_candle.close,
+                "close": last_candle.close,
+            }]
+        try:
+            with db.atomic():
+                Candle.batch_create_candles(market_name(0), Candle.INTERVAL__1HOUR, candle_data)
+                LongPosition.update(
+                        sell_price=Decimal(str(round(rng.uniform(0.0001, 0.01), 8)))
+                    ).where(
+                        LongPosition.id.in_(rng.sample(position_ids, min(50, len(position_ids))))
+                    ).execute()
+            num_ops += 1
+        except (OperationalError, sqlite3.OperationalError) as e:
+            # A failed COMMIT comes straight from sqlite3
+            if not is_locked_error(e):
+                raise
+            if db.in_transaction():
+                db.rollback()
+            num_locked += 1
+
+    results.put(("writer", num_ops, num_locked))
+
+
+
+def reader(db_file, journal_mode, busy_timeout, seconds, results):
+    configure(db_file, journal_mode, busy_timeout, read_only=True)
+    from peewee import OperationalError
+    from selective_dca_bot import utils
+    from selective_dca_bot.models import Candle
+    from .synthetic_data import market_name
+
+    num_ops = 0
+    num_locked = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            with redirect_stdout(io.StringIO()):
+                utils.open_positions_report()
+            Candle.get_last_candle(market_name(0), Candle.INTERVAL__1HOUR).calculate_moving_average(200)
+            num_ops += 1
+        except (OperationalError, sqlite3.OperationalError) as e:
+            if not is_locked_error(e):
+                raise
+            num_locked += 1
+
+    results.put(("reader", num_ops, num_locked))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db_file + suffix):
+            os.remove(args.db_file + suffix)
+
+    configure(args.db_file, args.journal_mode, args.busy_timeout, read_only=False)
+    from selective_dca_bot import config
+    from selective_dca_bot.models import db
+    from .synthetic_data import generate_dataset
+
+    print(f"Generating dataset in {args.db_file}")
+    generate_dataset(num_markets=10, num_hours=2000, num_positions=2000)
+    db.close()
+    print(f"pragmas: {config.SQLITE_PRAGMAS}")
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    worker_args = (args.db_file, args.journal_mode, args.busy_timeout, args.seconds, results)
+    processes = [context.Process(target=writer, args=worker_args)]
+    processes += [context.Process(target=reader, args=worker_args) for i in range(args.num_readers)]
+    [p.start() for p in processes]
+    outcomes = [results.get() for p in processes]
+    [p.join() for p in processes]
+
+    total_locked = 0
+    for (role, num_ops, num_locked) in sorted(outcomes):
+        print(f"{role:>6}: {num_ops:6d} ops | {num_locked:4d} lock errors")
+        total_locked += num_locked
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db_file + suffix):
+            os.remove(args.db_file + suffix)
+
+    print(f"{'PASS' if total_locked == 0 else 'FAIL'}: {total_locked} lock errors")
+    sys.exit(0 if total_locked == 0 else 1)
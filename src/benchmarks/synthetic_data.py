@@ -0,0 +1,342 @@
+import math
+import time
+
+from decimal import Decimal
+
+import numpy
+
+from peewee import chunked
+
+from selective_dca_bot.exchanges import EXCHANGE__BINANCE
+from selective_dca_bot.models import (db, market_db, Candle, Market, LongPosition, MarketParams,
+                                      AllTimeWatchlist)
+
+
+"""
+    Synthetic dataset generator for the benchmark suite and load testing (see
+    load_test_db.py).
+
+    Each fake market gets a random-walk hourly price series with fat-tailed,
+    volatility-clustered returns, quantized to Binance-like tick sizes. The
+    LongPositions are bought at the ask from a rotating watchlist and carry a
+    LIMIT SELL at the profit threshold. Their states are the ones
+    update_order_statuses() writes:
+
+        * open: LIMIT SELL placed, not yet filled
+        * sold: the price later reached the LIMIT SELL, so it has its
+          sell_timestamp and scalped_quantity (net of any buy commission paid
+          in the crypto itself)
+        * canceled: the LIMIT SELL was canceled and never replaced (no
+          sell_order_id, sell_price or sell_quantity)
+
+    Markets are generated one at a time and only their candles' highs are
+    scanned for sells, so memory stays flat at tens of millions of candles;
+    everything is written with bulk_insert().
+"""
+BASE_CURRENCY = 'BTC'
+HOUR = 3600
+PROFIT_THRESHOLD = Decimal('1.05')
+
+# Rows handed to each executemany() call; only bounds memory
+INSERT_CHUNK_SIZE = 20000
+
+# Hourly volatility of a typical market, and how far each market strays from it
+VOLATILITY = 0.012
+VOLATILITY_SPREAD = 0.3
+
+# Volatility regimes: AR(1) in log volatility, with a half-life of ~3 days
+VOLATILITY_KERNEL = 0.99 ** numpy.arange(500)
+
+# Watchlist rotation, and how heavily buys lean toward the most popular markets
+WATCHLIST_SIZE = 20
+WATCHLIST_EPOCH_HOURS = 30 * 24
+POPULARITY_EXPONENT = 0.8
+
+BUY_FEE_RATE = Decimal('0.00075')           # Paid in BNB
+CRYPTO_COMMISSION_RATE = Decimal('0.001')   # Paid in the bought crypto, when out of BNB
+CRYPTO_COMMISSION_SHARE = 0.05
+CANCELED_SHARE = 0.01                       # Of the positions still open
+
+
+
+def crypto_name(index):
+    return f"C{index:03d}"
+
+
+
+def market_name(index):
+    return f"{crypto_name(index)}{BASE_CURRENCY}"
+
+
+
+def last_closed_hour():
+    # Most recent fully-closed hourly candle's open time
+    now = int(time.time())
+    return now - (now % HOUR) - HOUR
+
+
+
+def bulk_insert(model, fields, rows):
+    """
+        Insert `rows` (tuples in `fields` order) with one prepared INSERT run
+        through executemany(). Each execution binds a single row, so there's no
+        999 bound-variable limit to batch around, and it skips peewee's per-row
+        query building, which costs ~10x the insert itself at this scale.
+    """
+    columns = ", ".join(f'"{field.column_name}"' for field in fields)
+    placeholders = ", ".join("?" * len(fields))
+    sql = f'INSERT INTO "{model._meta.table_name}" ({columns}) VALUES ({placeholders})'
+
+    cursor = model._meta.database.cursor()
+    for batch in chunked(rows, INSERT_CHUNK_SIZE):
+        cursor.executemany(sql, batch)
+
+
+
+def generate_dataset(num_markets=50, num_hours=2 * 365 * 24, num_positions=20000,
+                     seed=1, end_timestamp=None, buy_amount=Decimal('0.001')):
+    rng = numpy.random.RandomState(seed)
+    if not end_timestamp:
+        end_timestamp = last_closed_hour()
+    start_timestamp = end_timestamp - (num_hours - 1) * HOUR
+
+    cryptos = [crypto_name(i) for i in range(num_markets)]
+    prices = 10 ** rng.uniform(-6.5, -1.5, num_markets)
+    volatilities = VOLATILITY * numpy.exp(rng.normal(0, VOLATILITY_SPREAD, num_markets))
+    params = [market_params(market_name(i), price) for (i, price) in enumerate(prices)]
+
+    with market_db.atomic():
+        bulk_insert(MarketParams, [
+                MarketParams.exchange, MarketParams.market, MarketParams.price_tick_size,
+                MarketParams.lot_step_size, MarketParams.min_notional, MarketParams.multiplier_up,
+                MarketParams.avg_price_minutes
+            ], ((p.exchange, p.market, p.price_tick_size, p.lot_step_size, p.min_notional,
+                 p.multiplier_up, p.avg_price_minutes) for p in params))
+    with db.atomic():
+        AllTimeWatchlist.create(exchange=EXCHANGE__BINANCE, watchlist=",".join(cryptos))
+
+    positions = schedule_positions(num_markets, num_hours, num_positions, rng)
+
+    # Filled in market by market, then written out in buy order
+    buy_closes = numpy.zeros(num_positions)
+    sell_hours = numpy.full(num_positions, -1, dtype=numpy.int64)
+
+    by_market = numpy.argsort(positions['market'], kind='mergesort')
+    bounds = numpy.searchsorted(positions['market'][by_market], numpy.arange(num_markets + 1))
+    for i in range(num_markets):
+        (open, high, low, close) = random_walk(prices[i], num_hours, rng, volatilities[i])
+        (open, high, low, close) = (quantize(series, params[i].price_tick_size) for series in (open, high, low, close))
+        with market_db.atomic():
+            generate_candles(market_name(i), start_timestamp, open, high, low, close)
+
+        indices = by_market[bounds[i]:bounds[i + 1]]
+        buy_closes[indices] = close[positions['hour'][indices] - 1]
+        for index in indices:
+            sell_price = position_fields(params[i], buy_closes[index], positions['spread'][index], buy_amount)[3]
+            sell_hours[index] = first_hit(high, positions['hour'][index], float(sell_price))
+
+    with db.atomic():
+        generate_positions(positions, buy_closes, sell_hours, params, cryptos, start_timestamp, buy_amount)
+
+    return {
+        "num_markets": num_markets,
+        "num_hours": num_hours,
+        "num_candles": num_markets * num_hours,
+        "num_positions": num_positions,
+        "num_sold": int((sell_hours >= 0).sum()),
+        "seed": seed,
+        "start_timestamp": start_timestamp,
+        "end_timestamp": end_timestamp,
+    }
+
+
+
+def market_params(market, price):
+    """
+        Binance-style filters for a BTC market trading around `price`: a tick
+        of ~5 significant digits (1 satoshi at least) and a lot step worth
+        around 0.00001 BTC.
+    """
+    tick_exponent = max(math.floor(math.log10(price)) - 4, -8)
+    lot_exponent = min(max(math.ceil(math.log10(0.00001 / price)), -4), 0)
+    return MarketParams(
+        exchange=MarketParams.EXCHANGE__BINANCE,
+        market=market,
+        price_tick_size=Decimal(10) ** tick_exponent,
+        lot_step_size=Decimal(10) ** lot_exponent,
+        min_notional=Decimal('0.0001'),
+        multiplier_up=Decimal('5'),
+        avg_price_minutes=Decimal('5')
+    )
+
+
+
+def random_walk(price, num_hours, rng, volatility=VOLATILITY):
+    """
+        (open, high, low, close) float arrays of `num_hours` candles starting
+        at `price`. Hourly log returns are Student's t (fat tails) scaled by a
+        volatility that wanders between calm and wild regimes; the wicks reach
+        past the open and close by half-normal amounts of the same volatility.
+    """
+    log_volatility = numpy.convolve(rng.normal(0, 0.06, num_hours), VOLATILITY_KERNEL)[:num_hours]
+    volatilities = volatility * numpy.exp(log_volatility)
+
+    # t with 4 degrees of freedom has variance 2
+    returns = volatilities * rng.standard_t(4, num_hours) / math.sqrt(2)
+    close = price * numpy.exp(numpy.cumsum(returns))
+    open = numpy.concatenate(([price], close[:-1]))
+    high = numpy.maximum(open, close) * numpy.exp(numpy.abs(rng.normal(0, 0.5, num_hours)) * volatilities)
+    low = numpy.minimum(open, close) * numpy.exp(-numpy.abs(rng.normal(0, 0.5, num_hours)) * volatilities)
+    return (open, high, low, close)
+
+
+
+def quantize(prices, tick_size):
+    # To the tick, never below one tick
+    tick = float(tick_size)
+    return numpy.round(numpy.maximum(numpy.round(prices / tick), 1) * tick, -1 * tick_size.as_tuple().exponent)
+
+
+
+def generate_candles(market, start_timestamp, open, high, low, close):
+    market_id = Market.get_id(market, create=True)
+    num_hours = len(close)
+    bulk_insert(Candle, [
+            Candle.market_id, Candle.interval, Candle.timestamp,
+            Candle.open, Candle.high, Candle.low, Candle.close
+        ], zip([market_id] * num_hours, [Candle.INTERVAL__1HOUR] * num_hours,
+               range(start_timestamp, start_timestamp + num_hours * HOUR, HOUR),
+               open.tolist(), high.tolist(), low.tolist(), close.tolist()))
+
+
+
+def schedule_positions(num_markets, num_hours, num_positions, rng):
+    """
+        When each position is bought (in order, after the 200-hour MA has
+        filled), from which market, and how many ticks over the last close the
+        ask was. Each watchlist epoch buys from its own popularity-weighted
+        sample of the markets, weighted the same way again within it.
+    """
+    popularity = 1.0 / numpy.arange(1, num_markets + 1) ** POPULARITY_EXPONENT
+
+    hours = numpy.sort(rng.randint(200, num_hours, num_positions))
+    markets = numpy.empty(num_positions, dtype=numpy.int64)
+    epochs = hours // WATCHLIST_EPOCH_HOURS
+    watchlists = {}
+    for epoch in numpy.unique(epochs):
+        watchlist = rng.choice(num_markets, size=min(WATCHLIST_SIZE, num_markets), replace=False,
+                               p=popularity / popularity.sum())
+        in_epoch = epochs == epoch
+        weights = popularity[watchlist]
+        markets[in_epoch] = rng.choice(watchlist, size=int(in_epoch.sum()), p=weights / weights.sum())
+        watchlists[int(epoch)] = sorted(watchlist)
+
+    return {
+        "hour": hours,
+        "market": markets,
+        "epoch": epochs,
+        "watchlists": watchlists,
+        "spread": rng.randint(1, 4, num_positions),
+        "seconds": rng.uniform(5, 120, num_positions),              # Into the hour, when the run bought
+        "sell_seconds": rng.uniform(0, HOUR, num_positions),
+        "crypto_commission": rng.random_sample(num_positions) < CRYPTO_COMMISSION_SHARE,
+        "canceled": rng.random_sample(num_positions) < CANCELED_SHARE,
+    }
+
+
+
+def position_fields(params, buy_close, spread, buy_amount):
+    """
+        (buy_quantity, purchase_price, sell_quantity, sell_price) the way
+        Bot.buy() and the LIMIT SELL placement would set them.
+    """
+    tick_size = params.price_tick_size
+    purchase_price = Decimal(str(float(buy_close))).quantize(tick_size) + tick_size * int(spread)
+
+    buy_quantity = (buy_amount / purchase_price).quantize(params.lot_step_size)
+    if buy_quantity * purchase_price < params.min_notional:
+        buy_quantity += params.lot_step_size
+    # Keep a lot step to scalp
+    buy_quantity = max(buy_quantity, params.lot_step_size * 2)
+
+    position = LongPosition(buy_quantity=buy_quantity, purchase_price=purchase_price)
+    (sell_quantity, sell_price) = position.calculate_scalp_sell_price(
+        params, (purchase_price * PROFIT_THRESHOLD).quantize(tick_size))
+    return (buy_quantity, purchase_price, sell_quantity, sell_price)
+
+
+
+def first_hit(highs, start, price):
+    """
+        First hour from `start` on whose high reaches `price`, or -1. Looks in
+        windows that grow 8x each time; most LIMIT SELLs fill within days.
+    """
+    window = 64
+    while start < len(highs):
+        hits = numpy.flatnonzero(highs[start:start + window] >= price)
+        if len(hits):
+            return start + int(hits[0])
+        start += window
+        window *= 8
+    return -1
+
+
+
+def generate_positions(positions, buy_closes, sell_hours, params, cryptos, start_timestamp, buy_amount):
+    """
+        Writes the LongPositions in buy order.
+    """
+    hours = positions['hour']
+    markets = positions['market']
+    watchlists = {epoch: ",".join(cryptos[m] for m in watchlist)
+                  for (epoch, watchlist) in positions['watchlists'].items()}
+
+    def rows():
+        for index in range(len(buy_closes)):
+            market_params = params[markets[index]]
+            lot_step_size = market_params.lot_step_size
+            (buy_quantity, purchase_price, sell_quantity, sell_price) = position_fields(
+                market_params, buy_closes[index], positions['spread'][index], buy_amount)
+            spent = buy_quantity * purchase_price
+
+            buy_commission = Decimal('0')
+            if positions['crypto_commission'][index]:
+                buy_commission = (buy_quantity * CRYPTO_COMMISSION_RATE).quantize(Decimal('0.00000001'))
+                fees = (spent * CRYPTO_COMMISSION_RATE).quantize(Decimal('0.00000001'))
+            else:
+                fees = (spent * BUY_FEE_RATE).quantize(Decimal('0.00000001'))
+
+            # Each buy's LIMIT SELL is the next order the account placed
+            buy_order_id = 10000000 + 2 * index
+            sell_order_id = buy_order_id + 1
+            sell_timestamp = None
+            scalped_quantity = None
+            if sell_hours[index] >= 0:
+                sell_timestamp = start_timestamp + int(sell_hours[index]) * HOUR + float(positions['sell_seconds'][index])
+                scalped_quantity = (buy_quantity - buy_commission - sell_quantity).quantize(lot_step_size)
+            elif positions['canceled'][index]:
+                (sell_order_id, sell_quantity, sell_price) = (None, None, None)
+
+            yield (
+                EXCHANGE__BINANCE,
+                market_params.market,
+                buy_order_id,
+                buy_quantity,
+                purchase_price,
+                fees,
+                start_timestamp + int(hours[index]) * HOUR + float(positions['seconds'][index]),
+                watchlists[int(positions['epoch'][index])],
+                sell_order_id,
+                sell_quantity,
+                sell_price,
+                sell_timestamp,
+                scalped_quantity,
+            )
+
+    bulk_insert(LongPosition, [
+            LongPosition.exchange, LongPosition.market, LongPosition.buy_order_id,
+            LongPosition.buy_quantity, LongPosition.purchase_price, LongPosition.fees,
+            LongPosition.timestamp, LongPosition.watchlist, LongPosition.sell_order_id,
+            LongPosition.sell_quantity, LongPosition.sell_price, LongPosition.sell_timestamp,
+            LongPosition.scalped_quantity
+        ], rows())
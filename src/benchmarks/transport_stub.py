@@ -0,0 +1,283 @@
+import json
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+
+"""
+    Verifies the pooled exchange transport (selective_dca_bot/exchanges/transport.py)
+    against a local HTTPS stub of the Binance REST API.
+
+    Checks that connections are reused (one TLS handshake for many calls), that
+    concurrent calls stay within the pool size, that idempotent calls are retried
+    through 5xx responses, that order placement is NOT retried after a read
+    timeout but is instead looked up by its client order id, and that an
+    endpoint's circuit breaker opens after repeated failures and closes again
+    once it recovers.
+
+    Needs the `openssl` CLI to mint a throwaway self-signed cert. To run (from the
+    `src` dir):
+        python -m benchmarks.transport_stub
+"""
+
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, context):
+        super().__init__(address, StubHandler)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+        self.lock = threading.Lock()
+        self.num_connections = 0
+        self.requests = []
+        self.failures = {}      # path -> number of 503s left to return
+        self.delays = {}        # (method, path) -> seconds to stall before responding
+        self.orders = {}        # clientOrderId -> order
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up on a stalled response is expected here
+        pass
+
+    def get_request(self):
+        request = super().get_request()
+        with self.lock:
+            self.num_connections += 1
+        return request
+
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'      # keep-alive
+    disable_nagle_algorithm = True     # Headers and body go out in separate writes
+
+    def log_message(self, *args):
+        pass
+
+    def _order(self, method, params):
+        client_order_id = params.get('newClientOrderId') or params.get('origClientOrderId')
+        if method == 'GET':
+            if client_order_id not in self.server.orders:
+                return (400, {"code": -2013, "msg": "Order does not exist."})
+            return (200, self.server.orders[client_order_id])
+
+        if client_order_id in self.server.orders:
+            return (400, {"code": -2010, "msg": "Duplicate order sent."})
+        now = int(time.time() * 1000)
+        order = {
+            "symbol": params.get('symbol'),
+            "orderId": len(self.server.orders) + 1,
+            "clientOrderId": client_order_id,
+            "origQty": params.get('quantity'),
+            "executedQty": "0.00000000",
+            "status": "NEW",
+            "time": now,
+            "updateTime": now,
+        }
+        self.server.orders[client_order_id or str(order["orderId"])] = order
+        return (200, dict(order, transactTime=now))
+
+    def _respond(self, method):
+        url = urlparse(self.path)
+        path = url.path
+        length = int(self.headers.get('Content-Length') or 0)
+        content = self.rfile.read(length).decode() if length else ''
+        params = {k: v[0] for (k, v) in parse_qs(url.query or content).items()}
+
+        with self.server.lock:
+            self.server.requests.append((method, path))
+            fail = self.server.failures.get(path, 0)
+            if fail:
+                self.server.failures[path] = fail - 1
+
+            # The order is on the books even if the response never makes it back
+            order = self._order(method, params) if path == '/api/v3/order' and not fail else None
+
+        if (method, path) in self.server.delays:
+            time.sleep(self.server.delays[(method, path)])
+
+        if fail:
+            status, body = 503, {"code": -1001, "msg": "stub outage"}
+        elif path == '/api/v1/ticker/24hr':
+            status, body = 200, {"symbol": "EOSBTC", "lastPrice": "0.00105770"}
+        elif path == '/api/v1/klines':
+            status, body = 200, []
+        elif order:
+            status, body = order
+        else:
+            status, body = 200, {}
+
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('x-mbx-used-weight-1m', str(len(self.server.requests)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._respond('GET')
+
+    def do_POST(self):
+        self._respond('POST')
+
+    def do_DELETE(self):
+        self._respond('DELETE')
+
+
+
+def make_cert(directory):
+    cert = os.path.join(directory, 'stub.pem')
+    key = os.path.join(directory, 'stub.key')
+    subprocess.check_call([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost',
+        '-keyout', key, '-out', cert
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (cert, key)
+
+
+
+def check(name, passed, detail):
+    print(f"{'PASS' if passed else 'FAIL'}: {name} ({detail})")
+    return passed
+
+
+
+if __name__ == '__main__':
+    from selective_dca_bot import config
+    from selective_dca_bot.exchanges import transport
+    from selective_dca_bot.exchanges.binance_exchange import PooledClient
+    from selective_dca_bot.tracing import tracer
+
+    # Measure the transport itself, not the per-key rate limiter
+    config.RATE_LIMITS = {}
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        (cert, key) = make_cert(directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+
+        server = StubServer(('localhost', 0), context)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"https://localhost:{server.server_address[1]}"
+
+        # Trust the stub's self-signed cert
+        os.environ['REQUESTS_CA_BUNDLE'] = cert
+
+        class StubClient(PooledClient):
+            API_URL = f"{base_url}/api"
+
+        # Sequential calls over the pooled transport
+        client = StubClient('key', 'secret')
+        start = time.perf_counter()
+        for i in range(50):
+            client.get_ticker(symbol='EOSBTC')
+        pooled_seconds = time.perf_counter() - start
+        results.append(check("pooled sequential calls reuse one connection",
+                             server.num_connections == 1,
+                             f"{server.num_connections} connections for 51 calls, {pooled_seconds:0.3f}s"))
+
+        # Same thing with a fresh connection per call, for comparison
+        before = server.num_connections
+        start = time.perf_counter()
+        for i in range(50):
+            requests.get(f"{base_url}/api/v1/ticker/24hr", params={"symbol": "EOSBTC"}, headers={"Connection": "close"})
+        fresh_seconds = time.perf_counter() - start
+        print(f"      fresh connections: {server.num_connections - before} for 50 calls, {fresh_seconds:0.3f}s ({fresh_seconds / pooled_seconds:0.1f}x slower)")
+
+        # Concurrent calls share the pool without exceeding its size
+        before = server.num_connections
+        server.delays[('GET', '/api/v1/ticker/24hr')] = 0.05
+        threads = [threading.Thread(target=lambda: [client.get_ticker(symbol='EOSBTC') for j in range(5)])
+                   for i in range(32)]
+        [t.start() for t in threads]
+        [t.join() for t in threads]
+        del server.delays[('GET', '/api/v1/ticker/24hr')]
+        opened = server.num_connections - before
+        results.append(check("concurrent calls stay within the pool",
+                             opened <= transport.get_adapter()._pool_maxsize,
+                             f"{opened} new connections for 160 calls from 32 threads, pool_maxsize {transport.get_adapter()._pool_maxsize}"))
+
+        # Idempotent GETs ride out transient 5xx responses
+        server.failures['/api/v1/klines'] = 2
+        retries_before = tracer.counters["retries.binance"]
+        client.get_klines(symbol='EOSBTC', interval='1h', limit=5)
+        results.append(check("GET retried through 503s",
+                             tracer.counters["retries.binance"] - retries_before == 2,
+                             f"{tracer.counters['retries.binance'] - retries_before:0.0f} retries"))
+
+        # Orders are never resent after the request may have reached the exchange
+        client.session.policies = dict(transport.ENDPOINT_POLICIES)
+        client.session.policies['/api/v3/order'] = transport.EndpointPolicy(read_timeout=0.5, retries=3)
+        server.delays[('POST', '/api/v3/order')] = 1.5
+        try:
+            client.order_limit_sell(symbol='EOSBTC', quantity=1, price='0.00110000')
+            timed_out = False
+        except requests.exceptions.ReadTimeout:
+            timed_out = True
+        time.sleep(2)
+        num_posts = len([r for r in server.requests if r == ('POST', '/api/v3/order')])
+        results.append(check("order POST not retried after read timeout",
+                             timed_out and num_posts == 1,
+                             f"timed out: {timed_out}, POSTs received: {num_posts}"))
+
+        # An order whose response was lost is found by its client order id, not resent
+        from benchmarks.fake_exchange import FakeBinanceExchange
+        exchange = FakeBinanceExchange([], client=tracer.trace_client(client, 'binance'))
+        before = len([r for r in server.requests if r == ('POST', '/api/v3/order')])
+        response = exchange._place_order(exchange.client.order_limit_sell, 'EOSBTC', quantity=1, price='0.00110000')
+        time.sleep(1)
+        num_posts = len([r for r in server.requests if r == ('POST', '/api/v3/order')]) - before
+        placed = [o for o in server.orders.values() if o["clientOrderId"] == response.get("clientOrderId")]
+        results.append(check("timed out order reconciled by client order id",
+                             num_posts == 1 and len(placed) == 1 and placed[0]["orderId"] == response["orderId"],
+                             f"POSTs received: {num_posts}, reconciled: {tracer.counters['orders_reconciled.binance']:0.0f}"))
+        del server.delays[('POST', '/api/v3/order')]
+
+        # ...and one that definitely wasn't placed is resent under the same id
+        server.failures['/api/v3/order'] = 1
+        before = len(server.orders)
+        response = exchange._place_order(exchange.client.order_limit_sell, 'EOSBTC', quantity=1, price='0.00110000')
+        results.append(check("order resent after a 503 it never executed",
+                             len(server.orders) - before == 1 and tracer.counters['order_retries.binance'] == 1,
+                             f"orders placed: {len(server.orders) - before}, resends: {tracer.counters['order_retries.binance']:0.0f}"))
+
+        # A failing endpoint fails fast once its circuit opens, then recovers
+        config.CIRCUIT_BREAKER_THRESHOLD = 3
+        config.CIRCUIT_BREAKER_COOLDOWN = 1
+        transport._circuit_breakers.clear()
+        client.session.policies['/api/v1/klines'] = transport.EndpointPolicy(retries=0)
+        server.failures['/api/v1/klines'] = 100
+        before = len([r for r in server.requests if r[1] == '/api/v1/klines'])
+        num_open = 0
+        for i in range(10):
+            try:
+                client.get_klines(symbol='EOSBTC', interval='1h', limit=5)
+            except transport.CircuitOpenError:
+                num_open += 1
+            except Exception:
+                pass
+        num_sent = len([r for r in server.requests if r[1] == '/api/v1/klines']) - before
+        server.failures['/api/v1/klines'] = 0
+        time.sleep(config.CIRCUIT_BREAKER_COOLDOWN)
+        client.get_klines(symbol='EOSBTC', interval='1h', limit=5)
+        closed = not transport.get_circuit_breaker('binance', '/api/v1/klines').is_open
+        results.append(check("circuit breaker opens on repeated failures and closes on recovery",
+                             num_sent == 3 and num_open == 7 and closed,
+                             f"{num_sent} of 10 calls sent, {num_open} failed fast, closed after cooldown: {closed}"))
+
+        print(f"      peak API weight seen: {tracer.gauges.get('api_peak_weight.binance')}")
+        server.shutdown()
+
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,61 @@
+import argparse
+
+from selective_dca_bot import config
+
+
+"""
+    Export candles, positions, portfolio snapshots, per-run metrics and fills for analysis.
+
+    Each run writes one new file per table with just the rows added (or, for
+    positions, sold) since the previous export to the same dir:
+        python export.py -o exports
+        python export.py -o exports -t candles -f parquet --full
+"""
+parser = argparse.ArgumentParser(description='Selective DCA (Dollar Cost Averaging) Bot: data export')
+
+parser.add_argument('-o', '--output',
+                    default="exports",
+                    dest="output_dir",
+                    help="Directory to write the export files to")
+
+parser.add_argument('-t', '--tables',
+                    default="candles,positions,snapshots,metrics,fills",
+                    dest="tables",
+                    help="Comma-separated list of tables to export")
+
+parser.add_argument('-f', '--format',
+                    default="csv",
+                    dest="format",
+                    help="csv, jsonl or parquet")
+
+parser.add_argument('-m', '--market',
+                    default=None,
+                    dest="market",
+                    help="Only export this market (doesn't move the watermarks)")
+
+parser.add_argument('--full',
+                    action='store_true',
+                    default=False,
+                    dest="full",
+                    help="Ignore the watermarks and export everything")
+
+parser.add_argument('--db',
+                    default=None,
+                    dest="db_file",
+                    help="Override the default SQLite db file")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.db_file:
+        config.SQLITE_DB_FILE = args.db_file
+
+    from selective_dca_bot.export import export_table
+
+    for table in [t.strip() for t in args.tables.split(',') if t.strip()]:
+        (path, num_rows) = export_table(table, args.output_dir, format=args.format, full=args.full, market=args.market)
+        if path:
+            print(f"{table}: {num_rows} rows -> {path}")
+        else:
+            print(f"{table}: nothing new")
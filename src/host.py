@@ -0,0 +1,70 @@
+import argparse
+import configparser
+import shlex
+import traceback
+
+from selective_dca_bot import config
+
+
+"""
+    Runs several portfolios (accounts) in one process.
+
+    Each account keeps its own settings, API keys and positions DB; candles,
+    CandleGaps and MarketParams all go in one shared market data DB so each
+    market is only downloaded once per run, no matter how many accounts watch
+    it. Exchange calls share the pooled transport and are throttled per API key.
+
+    See hosts.conf.example. To run:
+        python host.py -c hosts.conf
+"""
+parser = argparse.ArgumentParser(description='Selective DCA (Dollar Cost Averaging) Bot: multi-portfolio host')
+
+parser.add_argument('-c', '--hosts',
+                    default="hosts.conf",
+                    dest="hosts_config",
+                    help="Override default hosts config file location")
+
+parser.add_argument('-a', '--accounts',
+                    default=None,
+                    dest="accounts",
+                    help="Comma-separated list of accounts to run (default: all)")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    hosts_config = configparser.ConfigParser()
+    hosts_config.read(args.hosts_config)
+
+    accounts = hosts_config.sections()
+    if args.accounts:
+        accounts = [a.strip() for a in args.accounts.split(',') if a.strip()]
+
+    # Must be set before the models are imported
+    config.MARKET_DATA_DB_FILE = hosts_config.get('DEFAULT', 'MARKET_DATA_DB_FILE')
+    config.SQLITE_DB_FILE = hosts_config.get(accounts[0], 'DB')
+
+    import main as bot
+    from selective_dca_bot.models import use_account_db
+    from selective_dca_bot.tracing import tracer
+
+    for account in accounts:
+        use_account_db(hosts_config.get(account, 'DB'))
+        tracer.reset()
+
+        argv = shlex.split(hosts_config.get(account, 'ARGS'))
+        argv += ['-c', hosts_config.get(account, 'SETTINGS')]
+        argv += ['-p', hosts_config.get(account, 'PORTFOLIO')]
+
+        print(f"Running account '{account}'")
+        status = "ok"
+        try:
+            bot.main(argv)
+        except Exception:
+            # Don't let one account's failure stop the rest
+            traceback.print_exc()
+            status = "error"
+
+        tracer.tags["account"] = account
+        bot.write_run_trace(status=status)
@@ -1,29 +1,39 @@
 import argparse
+import atexit
 import boto3
 import configparser
 import datetime
-import random
+import sys
 import time
 
 from decimal import Decimal, ROUND_UP
 from datetime import timedelta
 
-from selective_dca_bot import config, utils
+from selective_dca_bot import config, models, trading, utils
 from selective_dca_bot.exchanges import (
     BinanceExchange, ExchangesManager, EXCHANGE__BINANCE, EXCHANGE__BITTREX)
-from selective_dca_bot.models import Candle, LongPosition, MarketParams, AllTimeWatchlist
+from selective_dca_bot.buy_decision import BuySnapshot, decide_buy
+from selective_dca_bot.depth_recorder import DepthRecorder
+from selective_dca_bot.models import (
+    Candle, CandleGap, LongPosition, MarketParams, AllTimeWatchlist, PortfolioSnapshot, MetricsHistory)
+from selective_dca_bot.position_book import PositionBook
+from selective_dca_bot.scheduler import RunLock
+from selective_dca_bot.status import publish_reports, publish_run
+from selective_dca_bot.tracing import tracer
 
 
 parser = argparse.ArgumentParser(description='Selective DCA (Dollar Cost Averaging) Bot')
 
 
 # Required positional arguments
-parser.add_argument('buy_amount', type=Decimal,
-                    help="The quantity of the crypto to spend (e.g. 0.05)")
+parser.add_argument('buy_amount',
+                    help="""The quantity of the crypto to spend (e.g. 0.05). Comma-separated
+                        to give each base_currency its own amount (e.g. 0.001,0.05,20)""")
 
 parser.add_argument('base_currency',
                     help="""The ticker of the currency to spend (e.g. 'BTC',
-                        'ETH', 'USD', etc)""")
+                        'ETH', 'USD', etc). Comma-separated to run several in one
+                        pass (e.g. BTC,ETH,USDT)""")
 
 
 # Optional switches
@@ -48,6 +58,13 @@ parser.add_argument('-l', '--live',
                     dest="live_mode",
                     help="""Submit live orders. When omitted runs in simulation mode""")
 
+parser.add_argument('--paper',
+                    action='store_true',
+                    default=False,
+                    dest="paper_mode",
+                    help="""Paper trade: real market data, but buys and LIMIT SELLs are
+                        simulated in the DB and filled against later candles""")
+
 parser.add_argument('-u', '--update_order_status',
                     action='store_true',
                     default=False,
@@ -60,277 +77,411 @@ parser.add_argument('-r', '--performance_report',
                     dest="performance_report",
                     help="""Compare purchase decisions against random portfolio selections""")
 
+parser.add_argument('-s', '--backfill_snapshots',
+                    action='store_true',
+                    default=False,
+                    dest="backfill_snapshots",
+                    help="""Rebuild the full PortfolioSnapshot history from the stored positions and candles""")
+
+parser.add_argument('--seed',
+                    type=int,
+                    default=None,
+                    dest="seed",
+                    help="""Seed the buy lottery so a run's selection can be reproduced""")
+
+parser.add_argument('-g', '--rebuild_gap_index',
+                    action='store_true',
+                    default=False,
+                    dest="rebuild_gap_index",
+                    help="""Re-scan all stored candles for missing ranges""")
+
+
+def parse_buys(buy_amounts, base_currencies):
+    """
+        Pair up the comma-separated buy amounts and base currencies. A single
+        amount applies to every base currency (e.g. 0 for a report-only run).
+    """
+    base_currencies = [b.strip().upper() for b in base_currencies.split(',') if b.strip()]
+    buy_amounts = [Decimal(a.strip()) for a in buy_amounts.split(',') if a.strip()]
+    if len(buy_amounts) == 1:
+        buy_amounts = buy_amounts * len(base_currencies)
+    if len(buy_amounts) != len(base_currencies):
+        raise Exception(f"Got {len(buy_amounts)} buy amounts for {len(base_currencies)} base currencies")
+    return list(zip(base_currencies, buy_amounts))
+
+
+def get_base_currency(market, base_currencies):
+    # Longest match first so e.g. 'USDT' wins over 'USD'
+    return next((b for b in sorted(base_currencies, key=len, reverse=True) if market.endswith(b)), None)
+
 
 def get_timestamp():
     ts = time.time()
     return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
 
 
-if __name__ == '__main__':
-    print(f"{'*' * 90}")
-    print(f"* {get_timestamp()}")
-    args = parser.parse_args()
-    buy_amount = args.buy_amount
-    base_currency = args.base_currency
-    live_mode = args.live_mode
-    update_order_status = args.update_order_status
-    config.is_test = not live_mode
-    performance_report = args.performance_report
-    exchange_list = args.exchanges.split(',')
-
-    # Read settings
-    arg_config = configparser.ConfigParser()
-    arg_config.read(args.settings_config)
-
-    binance_key = arg_config.get('API', 'BINANCE_KEY')
-    binance_secret = arg_config.get('API', 'BINANCE_SECRET')
+def write_run_trace(status=None):
+    # Registered with atexit so runs that blow up still get logged
+    if status is None:
+        status = "error" if getattr(sys, 'last_value', None) else "ok"
+    tracer.finish(status=status)
+    if config.RUN_LOG_FILE:
+        tracer.write_run_log(config.RUN_LOG_FILE)
+    if config.PROMETHEUS_TEXTFILE:
+        tracer.write_prometheus(config.PROMETHEUS_TEXTFILE)
+    if not config.SQLITE_READ_ONLY:
+        publish_run(tracer.to_dict())
+
+
+def report(metrics):
+    """
+        Build the position reports and refresh the status API's snapshots
+        from the same data.
+    """
+    open_summary = utils.open_positions_summary()
+    scalped_summary = utils.scalped_positions_summary()
+    publish_reports(open_summary, scalped_summary, metrics)
+    return (utils.open_positions_report(open_summary), utils.scalped_positions_report(scalped_summary))
+
+
+class Bot():
+    """
+        One account's settings, exchange clients, latest metrics and
+        PositionBook, with a method per phase of a run. main() builds one and
+        runs the phases once, in order; scheduler.py keeps one alive and runs
+        each phase on its own cadence.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.buys = parse_buys(args.buy_amount, args.base_currency)
+        self.base_currencies = [base_currency for (base_currency, buy_amount) in self.buys]
+        self.live_mode = args.live_mode
+        self.paper_mode = args.paper_mode
+        if self.live_mode and self.paper_mode:
+            raise Exception("--live and --paper can't be combined")
+        self.update_order_status = args.update_order_status
+        config.is_test = not self.live_mode
+        self.exchange_list = args.exchanges.split(',')
+
+        # Read settings
+        arg_config = configparser.ConfigParser()
+        arg_config.read(args.settings_config)
+
+        if arg_config.has_section('TRACING'):
+            config.RUN_LOG_FILE = arg_config.get('TRACING', 'RUN_LOG_FILE', fallback=config.RUN_LOG_FILE)
+            config.PROMETHEUS_TEXTFILE = arg_config.get('TRACING', 'PROMETHEUS_TEXTFILE', fallback=config.PROMETHEUS_TEXTFILE)
+
+        self.tags = {
+            "base_currency": ",".join(self.base_currencies),
+            "buy_amount": ",".join(str(buy_amount) for (base_currency, buy_amount) in self.buys),
+            "live_mode": self.live_mode,
+            "paper_mode": self.paper_mode,
+            "update_order_status": self.update_order_status,
+        }
+        tracer.tags = dict(self.tags)
+
+        self.binance_key = arg_config.get('API', 'BINANCE_KEY')
+        self.binance_secret = arg_config.get('API', 'BINANCE_SECRET')
+
+        try:
+            self.bittrex_key = arg_config.get('API', 'BITTREX_KEY')
+            self.bittrex_secret = arg_config.get('API', 'BITTREX_SECRET')
+        except configparser.NoOptionError:
+            self.bittrex_key = None
+            self.bittrex_secret = None
+
+        self.max_crypto_holdings_percentage = Decimal(arg_config.get('CONFIG', 'MAX_CRYPTO_HOLDINGS_PERCENTAGE'))
+        self.max_consecutive_buys = Decimal(arg_config.get('CONFIG', 'MAX_CONSECUTIVE_BUYS'))
+        self.profit_threshold = Decimal(arg_config.get('CONFIG', 'PROFIT_THRESHOLD'))
+        config.PRICE_SNAPSHOT_MAX_AGE = int(arg_config.get('CONFIG', 'PRICE_SNAPSHOT_MAX_AGE', fallback=config.PRICE_SNAPSHOT_MAX_AGE))
+        config.BALANCE_SNAPSHOT_MAX_AGE = int(arg_config.get('CONFIG', 'BALANCE_SNAPSHOT_MAX_AGE', fallback=config.BALANCE_SNAPSHOT_MAX_AGE))
+        config.GAP_REPAIR_MAX_REQUESTS = int(arg_config.get('CONFIG', 'GAP_REPAIR_MAX_REQUESTS', fallback=config.GAP_REPAIR_MAX_REQUESTS))
+        config.GAP_REPAIR_SLEEP = float(arg_config.get('CONFIG', 'GAP_REPAIR_SLEEP', fallback=config.GAP_REPAIR_SLEEP))
+        config.PAPER_FEE_RATE = Decimal(arg_config.get('CONFIG', 'PAPER_FEE_RATE', fallback=str(config.PAPER_FEE_RATE)))
+        paper_starting_balances = arg_config.get('CONFIG', 'PAPER_STARTING_BALANCES', fallback=None)
+        if paper_starting_balances:
+            # e.g. "BTC:0.05, USDT:1000"
+            config.PAPER_STARTING_BALANCES = {
+                asset.strip(): Decimal(amount.strip())
+                for (asset, amount) in (entry.split(':') for entry in paper_starting_balances.split(','))
+            }
+        config.DEPTH_RECORDER = arg_config.getboolean('CONFIG', 'DEPTH_RECORDER', fallback=config.DEPTH_RECORDER)
+        config.DEPTH_DIR = arg_config.get('CONFIG', 'DEPTH_DIR', fallback=config.DEPTH_DIR)
+
+        try:
+            self.sns_topic = arg_config.get('AWS', 'SNS_TOPIC')
+            aws_access_key_id = arg_config.get('AWS', 'AWS_ACCESS_KEY_ID')
+            aws_secret_access_key = arg_config.get('AWS', 'AWS_SECRET_ACCESS_KEY')
+
+            # Prep boto SNS client for email notifications
+            self.sns = boto3.client(
+                "sns",
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name="us-east-1"     # N. Virginia
+            )
+        except configparser.NoSectionError:
+            self.sns_topic = None
+            self.sns = None
 
-    try:
-        bittrex_key = arg_config.get('API', 'BITTREX_KEY')
-        bittrex_secret = arg_config.get('API', 'BITTREX_SECRET')
-    except configparser.NoOptionError:
-        bittrex_key = None
-        bittrex_secret = None
+        params = {
+            # "num_buys": num_buys,
+        }
 
+        # Setup package-wide settings
+        config.params = params
+        config.interval = Candle.INTERVAL__1HOUR
 
+        # If multiple MA periods are passed, will calculate the price-to-MA with the lowest MA
+        self.ma_periods = [200]
 
-    max_crypto_holdings_percentage = Decimal(arg_config.get('CONFIG', 'MAX_CRYPTO_HOLDINGS_PERCENTAGE'))
-    max_consecutive_buys = Decimal(arg_config.get('CONFIG', 'MAX_CONSECUTIVE_BUYS'))
-    profit_threshold = Decimal(arg_config.get('CONFIG', 'PROFIT_THRESHOLD'))
+        self.exchanges = None
+        self.metrics = []
+        self.metrics_run_timestamp = None
+        self.book = None
+        self.depth_recorders = {}
 
-    try:
-        sns_topic = arg_config.get('AWS', 'SNS_TOPIC')
-        aws_access_key_id = arg_config.get('AWS', 'AWS_ACCESS_KEY_ID')
-        aws_secret_access_key = arg_config.get('AWS', 'AWS_SECRET_ACCESS_KEY')
 
-        # Prep boto SNS client for email notifications
-        sns = boto3.client(
-            "sns",
-            aws_access_key_id=aws_access_key_id,
-            aws_secret_access_key=aws_secret_access_key,
-            region_name="us-east-1"     # N. Virginia
-        )
-    except configparser.NoSectionError:
-        sns_topic = None
+    @property
+    def buying(self):
+        return any(buy_amount != Decimal('0.0') for (base_currency, buy_amount) in self.buys)
 
-    if performance_report:
-        from selective_dca_bot.models import LongPosition, Candle
-        results = LongPosition.get_performance_report()
-        exit()
 
-    # Read crypto watchlist
-    arg_config = configparser.ConfigParser()
-    arg_config.read(args.portfolio_config)
+    def connect(self):
+        """
+            Read the watchlist and set up the exchange clients and PositionBook.
+        """
+        # Read crypto watchlist
+        arg_config = configparser.ConfigParser()
+        arg_config.read(self.args.portfolio_config)
+
+        self.watchlist = []
+        binance_watchlist = [x.strip() for x in arg_config.get('WATCHLIST', 'BINANCE').split(',') if x != '']
+        bittrex_watchlist = [x.strip() for x in arg_config.get('WATCHLIST', 'BITTREX').split(',') if x != '']
+
+        self.watchlist.extend(binance_watchlist)
+        self.watchlist.extend(bittrex_watchlist)
+
+        exchanges_data = []
+        if EXCHANGE__BINANCE in self.exchange_list and binance_watchlist:
+            exchanges_data.append(
+                {
+                    'name': EXCHANGE__BINANCE,
+                    'key': self.binance_key,
+                    'secret': self.binance_secret,
+                    'watchlist': binance_watchlist,
+                }
+            )
 
-    watchlist = []
-    binance_watchlist = [x.strip() for x in arg_config.get('WATCHLIST', 'BINANCE').split(',') if x != '']
-    bittrex_watchlist = [x.strip() for x in arg_config.get('WATCHLIST', 'BITTREX').split(',') if x != '']
+        if EXCHANGE__BITTREX in self.exchange_list and bittrex_watchlist:
+            exchanges_data.append(
+                {
+                    'name': EXCHANGE__BITTREX,
+                    'key': self.bittrex_key,
+                    'secret': self.bittrex_secret,
+                    'watchlist': bittrex_watchlist,
+                }
+            )
 
-    watchlist.extend(binance_watchlist)
-    watchlist.extend(bittrex_watchlist)
+        # One set of exchange clients (and price snapshots) shared by every base currency
+        self.exchanges = ExchangesManager.get_exchanges(exchanges_data, paper=self.paper_mode)
 
+        # Every open LongPosition, loaded once and kept current from then on
+        self.book = PositionBook.load()
 
-    params = {
-        # "num_buys": num_buys,
-    }
+        if config.DEPTH_RECORDER:
+            for (name, exchange) in self.exchanges.items():
+                # Internal CRYPTO+BASE names, like the candles and positions; skip the
+                #   pairs the exchange doesn't list, their depth requests would only fail
+                markets = [f"{crypto}{base_currency}" for base_currency in self.base_currencies
+                           for crypto in exchange.watchlist if crypto != base_currency]
+                markets = [market for market in markets if exchange.has_market(market)]
+                self.depth_recorders[name] = DepthRecorder(exchange, markets)
 
-    # Setup package-wide settings
-    config.params = params
-    config.interval = Candle.INTERVAL__1HOUR
 
-    # If multiple MA periods are passed, will calculate the price-to-MA with the lowest MA
-    ma_periods = [200]
+    def candles_fingerprint(self):
+        # Changes whenever any market's latest candle does
+        return tuple((m['exchange'], m['market'], m['timestamp']) for m in self.metrics)
 
 
     #------------------------------------------------------------------------------------
     # UPDATE latest candles
-    exchanges_data = []
-    if EXCHANGE__BINANCE in exchange_list and binance_watchlist:
-        exchanges_data.append(
-            {
-                'name': EXCHANGE__BINANCE,
-                'key': binance_key,
-                'secret': binance_secret,
-                'watchlist': binance_watchlist,
-            }
-        )
-
-    if EXCHANGE__BITTREX in exchange_list and bittrex_watchlist:
-        exchanges_data.append(
-            {
-                'name': EXCHANGE__BITTREX,
-                'key': bittrex_key,
-                'secret': bittrex_secret,
-                'watchlist': bittrex_watchlist,
-            }
-        )
+    def ingest(self):
+        metrics = []
+        for name, exchange in self.exchanges.items():
+            for base_currency in self.base_currencies:
+                metrics.extend(exchange.calculate_latest_metrics(base_currency=base_currency, interval=config.interval, ma_periods=self.ma_periods))
+            """
+                metrics = [{
+                        'exchange': self.exchange_name,
+                        'market': market,
+                        'timestamp': last_candle.timestamp,
+                        'close': last_candle.close,
+                        'ma_period': min_ma_period,
+                        'ma': min_ma,
+                        'price_to_ma': min_price_to_ma,
+                        'ma_reliable': ma_reliable
+                    }, {...}, {...}]
+            """
+        previous_fingerprint = self.candles_fingerprint()
+        self.metrics = metrics
+        if self.candles_fingerprint() == previous_fingerprint:
+            # No new candles (the scheduler ingests every minute); the rows
+            #   recorded at metrics_run_timestamp still hold
+            return
+
+        # Keep every run's decision inputs for later analysis
+        self.metrics_run_timestamp = tracer.started
+        MetricsHistory.record(self.metrics_run_timestamp, metrics)
 
-    exchanges = ExchangesManager.get_exchanges(exchanges_data)
-    metrics = []
-    for name, exchange in exchanges.items():
-        metrics.extend(exchange.calculate_latest_metrics(base_currency=base_currency, interval=config.interval, ma_periods=ma_periods))
-        """
-            metrics = [{
-                    'exchange': self.exchange_name,
-                    'market': market,
-                    'close': last_candle.close,
-                    'ma_period': min_ma_period,
-                    'ma': min_ma,
-                    'price_to_ma': min_price_to_ma
-                }, {...}, {...}]
-        """
+
+    #------------------------------------------------------------------------------------
+    #  Sample the order books (only with DEPTH_RECORDER)
+    def record_depth(self):
+        with tracer.span('depth_sample'):
+            for recorder in self.depth_recorders.values():
+                recorder.sample()
 
 
     #------------------------------------------------------------------------------------
     #  Check the status of open LongPositions
-    if update_order_status:
-        recently_sold = ""
-        num_positions_sold = 0
-        for exchange_name, exchange in exchanges.items():
-            markets = [lp.market for lp in LongPosition.select(
-                    LongPosition.market
-                ).where(
-                    LongPosition.exchange == exchange_name,
-                    LongPosition.sell_timestamp.is_null(True)
-                ).distinct()]
-
-            for market in markets:
-                positions = LongPosition.select(
-                        ).where(
-                            LongPosition.exchange == exchange_name,
-                            LongPosition.market == market,
-                            LongPosition.sell_order_id.is_null(False),
-                            LongPosition.sell_timestamp.is_null(True)
-                        ).order_by(
-                            LongPosition.sell_order_id
-                        )
-
-                positions_sold = exchange.update_order_statuses(market, positions)
-
-                for position in positions_sold:
-                    num_positions_sold += 1
-                    recently_sold += f"{position.market}: sold {'{:f}'.format(position.sell_quantity.normalize())} | recouped {'{:f}'.format((position.sell_quantity * position.sell_price).quantize(Decimal('0.00000001')))} {base_currency} | scalped {'{:f}'.format(position.scalped_quantity.normalize())}\n"
-
-        if live_mode and num_positions_sold > 0:
-            subject = f"SOLD {num_positions_sold} positions"
-            print(recently_sold)
-            message = recently_sold
-            sns.publish(
-                TopicArn=sns_topic,
-                Subject=subject,
-                Message=message
-            )
+    def reconcile(self):
+        with tracer.span('order_reconciliation'):
+            num_fills = trading.sync_fills(self.exchanges, self.book)
+            if num_fills:
+                print(f"Synced {num_fills} new fills")
+
+            positions_sold = trading.update_order_statuses(self.exchanges, self.book)
+
+            recently_sold = ""
+            for position in positions_sold:
+                recently_sold += f"{position.market}: sold {'{:f}'.format(position.sell_quantity.normalize())} | recouped {'{:f}'.format((position.sell_quantity * position.sell_price).quantize(Decimal('0.00000001')))} {get_base_currency(position.market, self.base_currencies) or ''} | scalped {'{:f}'.format(position.scalped_quantity.normalize())}\n"
+
+            if self.live_mode and len(positions_sold) > 0:
+                subject = f"SOLD {len(positions_sold)} positions"
+                print(recently_sold)
+                message = recently_sold
+                self.sns.publish(
+                    TopicArn=self.sns_topic,
+                    Subject=subject,
+                    Message=message
+                )
 
 
     #------------------------------------------------------------------------------------
     #  Update the LIMIT SELL targets of open LongPositions
-    if update_order_status:
-        for exchange_name, exchange in exchanges.items():
-            markets = [lp.market for lp in LongPosition.select(
-                    LongPosition.market
-                ).where(
-                    LongPosition.exchange == exchange_name,
-                    LongPosition.scalped_quantity.is_null(True)
-                ).distinct()]
-
-            for market in markets:
-                market_params = MarketParams.get_market(market)
-                metric = next(m for m in metrics if m['exchange'] == exchange_name and m['market'] == market)
-                current_price = metric['close'].quantize(market_params.price_tick_size)
-                current_ma = metric['ma'].quantize(market_params.price_tick_size)
-
-                # Get this market's open positions
-                positions = LongPosition.select(
-                        ).where(
-                            LongPosition.exchange == exchange_name,
-                            LongPosition.market == market,
-                            LongPosition.sell_timestamp.is_null(True),
-                        ).order_by(
-                            LongPosition.purchase_price.desc(),
-                            LongPosition.id
-                        )
-
-                if positions.count() == 0:
+    def reprice(self):
+        with tracer.span('limit_sell_repricing'):
+            trading.update_limit_sell_targets(self.exchanges, self.metrics, self.profit_threshold, self.book)
+
+
+    def record_portfolio(self):
+        #------------------------------------------------------------------------------------
+        #  Record the portfolio's value as of the latest candle
+        with tracer.span('portfolio_snapshot'):
+            for base_currency in self.base_currencies:
+                PortfolioSnapshot.take(base_currency, config.interval)
+
+        #------------------------------------------------------------------------------------
+        #  Move sold positions out of the live LongPosition table
+        with tracer.span('position_archive'):
+            num_archived = LongPosition.archive_sold()
+            if num_archived:
+                print(f"Archived {num_archived} sold positions")
+
+
+    #------------------------------------------------------------------------------------
+    #  BUY the next target for each base currency based on the most favorable price_to_ma ratio
+    def buy(self):
+        purchases = []
+        for (base_currency, buy_amount) in self.buys:
+            if buy_amount == Decimal('0.0'):
+                continue
+
+            with tracer.span('buy_selection', base_currency=base_currency):
+                snapshot = BuySnapshot.load(base_currency, self.watchlist, self.metrics, self.book, self.max_consecutive_buys)
+                if not snapshot.metrics:
+                    print(f"No {base_currency} markets to buy.")
                     continue
 
-                last_target_price = None
-                for index, position in enumerate(positions):
-                    if index >= int(len(positions) * 0.75) and last_target_price:
-                        # Hold the last 1/4 of the stash at the 75th percentile's target price
-                        target_price = last_target_price
-
-                        if position.sell_order_id and position.sell_price and target_price == position.sell_price.quantize(market_params.price_tick_size):
-                            # This position is already at its min profit. Just have to keep holding
-                            # print(f"Keeping {market} {position.id:3d} {position.purchase_price:0.8f} at {target_price:0.8f}")
-                            continue
-
-                    else:
-                        min_sell_price = (position.purchase_price * profit_threshold).quantize(market_params.price_tick_size)
-
-                        # Account for cryptos like LTC with high-value price_tick_sizes
-                        (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, min_sell_price)
-                        last_target_price = target_price
-                        if target_price > current_ma:
-                            # position.sell_price could be None if it was a partially-canceled error position
-                            if position.sell_order_id and position.sell_price and target_price == position.sell_price.quantize(market_params.price_tick_size):
-                                # This position is already at its min profit. Just have to keep holding
-                                # print(f"Keeping {market} {position.id:3d} {position.purchase_price.quantize(market_params.price_tick_size):0.8f} at {target_price:0.8f}")
-                                continue
-                            else:
-                                # Update to the target_price we just calculated.
-                                pass
-
-                        else:
-                            (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, (min_sell_price + current_ma)/Decimal('2.0'))
-                            last_target_price = target_price
-
-                            # If the MA has just barely changed, don't bother chasing the tiny difference
-                            diff = (max([position.sell_price, target_price]) - min([position.sell_price, target_price])) / min([position.sell_price, target_price])
-                            if diff < Decimal('0.0025'):
-                                # Current sell_price is close enough
-                                print(f"Not going to bother updating {market} {position.id:3d} ({position.purchase_price.quantize(market_params.price_tick_size):0.8f}): {position.sell_price:0.8f} to {target_price:0.8f} ({diff * Decimal('100.0'):.2f}%)")
-                                continue
-            
-                        print(f"Revise  {market} {position.id:3d} {position.purchase_price.quantize(market_params.price_tick_size):0.8f} to: {target_price:0.8f} | {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
-
-                    # Factor in the max percent price range allowed for API orders
-                    max_price = (current_price * market_params.multiplier_up).quantize(market_params.price_tick_size)
-                    if target_price > max_price:
-                        print(f"{market} {position.id:3d} New price {target_price:0.8f} most likely exceeds PERCENT_PRICE {max_price:0.8f}")
-                        # So for now set the LIMIT SELL price for the whole lot at nearly the PERCENT_PRICE limit
-                        #   (this will most likely get re-set once the price gets closer).
-                        target_price = (max_price * Decimal('0.99')).quantize(market_params.price_tick_size)
-                        sell_quantity = position.buy_quantity
-
-                        if target_price == position.sell_price:
-                            # Nothing to change
-                            continue
-
-                    if target_price * sell_quantity < market_params.min_notional:
-                        print(f"{market} {position.id:3d} sell order for {sell_quantity} @ {target_price:0.8f} ({target_price * sell_quantity:0.4f}) is below MIN_NOTIONAL ({market_params.min_notional})")
+                # Lower price-to-MA increases odds of being selected
+                decision = decide_buy(snapshot, self.max_crypto_holdings_percentage, seed=self.args.seed)
+                print(decision.ma_ratios)
+
+                if not decision.metric:
+                    print(f"No {base_currency} buy candidates found.")
+                    continue
+
+                for candidate in decision.candidates:
+                    print(f"candidate: {candidate['market']} | {candidate['entries']:4d} entries")
+                MetricsHistory.record_lottery(self.metrics_run_timestamp, decision.candidates, decision.weights, decision.metric)
+
+                target_metric = decision.metric
+                ma_ratios = decision.ma_ratios
+                market = decision.market
+                crypto = decision.crypto
+                exchange_name = decision.exchange
+                exchange = self.exchanges[exchange_name]
+                ma_period = target_metric['ma_period']
+                price_to_ma = target_metric['price_to_ma']
+
+            with tracer.span('order_placement', base_currency=base_currency):
+                current_price = exchange.get_current_ask(market)
+
+                quantity = buy_amount / current_price
+
+                market_params = exchange.get_market_params(market)
+                quantized_buy_qty = quantity.quantize(market_params.lot_step_size)
+
+                if quantized_buy_qty * current_price < market_params.min_notional:
+                    # Final order size isn't big enough
+                    print(f"Must increase quantized_buy_qty: {quantized_buy_qty} * {current_price} < {market_params.min_notional}")
+                    quantized_buy_qty += market_params.lot_step_size
+
+                print(f"Buy: {'{:f}'.format(quantized_buy_qty.normalize())} {crypto} @ {current_price:0.8f} {base_currency}\n")
+
+                if self.live_mode or self.paper_mode:
+                    if not exchange.has_balance(base_currency, quantized_buy_qty * current_price):
+                        print(f"Insufficient {base_currency} balance to buy {quantized_buy_qty} {crypto}")
                         continue
 
-                    # All clean records should have a sell_order_id, but we specifically catch
-                    #   bad cases in AbstractExchange.update_order_statuses() so should deal with
-                    #   them here.
-                    if position.sell_order_id:
-                        (success, result) = exchange.cancel_order(market, position.sell_order_id)
+                    # What the latest recorded book says this buy should cost
+                    depth_estimate = None
+                    if exchange_name in self.depth_recorders:
+                        depth_estimate = self.depth_recorders[exchange_name].estimate_buy(market, quantized_buy_qty * current_price)
 
-                        if not success:
-                            print(f"ERROR CANCELING: {json.dumps(result, indent=4)}")
+                    results = exchange.buy(market, quantized_buy_qty)
 
-                        # Save changes in our local DB here so that it'll be easy to spot if the next step fails.
-                        position.sell_order_id = None
-                        position.save()
-                    else:
-                        # If there's no sell_order_id, it's already been canceled
-                        pass
+                    slippage = results['price'] / current_price - Decimal('1')
+                    tracer.gauge(f"buy_slippage.{market}", float(slippage))
+                    if depth_estimate:
+                        print(f"Filled at {results['price']:0.8f} ({slippage * Decimal('100.0'):0.3f}% over the ask) | depth estimate: {depth_estimate['vwap']:0.8f} ({depth_estimate['slippage'] * 100.0:0.3f}%)")
 
-                    results = exchange.limit_sell(
+                    position = LongPosition.create(
+                        exchange=exchange_name,
                         market=market,
-                        quantity=sell_quantity,
-                        bid_price=target_price
+                        buy_order_id=results['order_id'],
+                        buy_quantity=results['quantity'],
+                        purchase_price=results['price'],
+                        fees=results['fees'],
+                        timestamp=results['timestamp'],
+                        watchlist=",".join(self.watchlist),
                     )
+                    self.book.add(position)
+
+                    # Immediately place a LIMIT SELL order for this position.
+                    #   Initial sell price will be aggressive: avg of the current MA and the min profit target.
+                    #   This will get adjusted down later if the MA continues to drop. But if the current MA
+                    #   is less than the min profit target, we'll use that instead.
+                    min_profit_price = (position.purchase_price * self.profit_threshold).quantize(market_params.price_tick_size, rounding=ROUND_UP)
+                    target_price = ((target_metric['ma'] + min_profit_price)/Decimal('2.0')).quantize(market_params.price_tick_size, rounding=ROUND_UP)
+
+                    if target_price < min_profit_price:
+                        target_price = min_profit_price
+
+                    (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, target_price)
+
+                    results = exchange.limit_sell(market, sell_quantity, target_price)
                     """
                         {
                             "order_id": order_id,
@@ -338,173 +489,99 @@ if __name__ == '__main__':
                             "quantity": quantized_qty
                         }
                     """
-                    if results:
-                        print(f"LIMIT SELL ORDER: {results}\n")
-                        print(f"Revised {market} sell target = {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
-                        position.sell_order_id = results['order_id']
-                        position.sell_price = target_price
-                        position.sell_quantity = sell_quantity
-                        position.save()
+                    print(f"LIMIT SELL ORDER: {results}\n")
+                    print(f"Sell target = {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
+                    position.sell_order_id = results['order_id']
+                    position.sell_price = results['price']
+                    position.save()
+
+                    if self.live_mode:
+                        purchases.append({
+                            "subject": f"Bought {'{:f}'.format(quantized_buy_qty)} {crypto} ({price_to_ma*Decimal('100.0'):0.2f}% of {ma_period}-hr MA)",
+                            "ma_ratios": ma_ratios,
+                        })
+        return purchases
+
+
+    # Report out status of holdings
+    def report(self, purchases=None):
+        with tracer.span('reporting'):
+            (current_positions, scalped_positions) = report(self.metrics)
+            print(current_positions)
+            print("\n" + scalped_positions)
+
+            for purchase in purchases or []:
+                # Send SNS message
+                print(purchase['subject'])
+                message = purchase['ma_ratios']
+                message += "\n\n" + current_positions
+                message += "\n\n" + scalped_positions
+
+                self.sns.publish(
+                    TopicArn=self.sns_topic,
+                    Subject=purchase['subject'],
+                    Message=message
+                )
+
+
+
+def main(argv=None):
+    print(f"{'*' * 90}")
+    print(f"* {get_timestamp()}")
+    args = parser.parse_args(argv)
+    bot = Bot(args)
+
+    if args.performance_report:
+        # Read-only, so it can run alongside a live trading run
+        models.configure_db(read_only=True)
+        for base_currency in bot.base_currencies:
+            utils.generate_performance_report(base_pair=base_currency)
+        return
+
+    if args.backfill_snapshots:
+        for base_currency in bot.base_currencies:
+            num_snapshots = utils.backfill_portfolio_snapshots(base_currency, interval=config.interval)
+            print(f"{base_currency}: {num_snapshots} snapshots")
+        return
+
+    if args.rebuild_gap_index:
+        markets = [c.market for c in Candle.select(Candle.market_id).where(Candle.interval == config.interval).distinct()]
+        for market in markets:
+            gaps = CandleGap.rebuild_index(market, config.interval)
+            print(f"{market}: {len(gaps)} gaps")
+        return
+
+    # Don't overlap a still-running cron run or the resident scheduler
+    lock = RunLock()
+    if not lock.acquire():
+        print(f"{lock.path} is held by another run; exiting")
+        tracer.tags["skipped"] = True
+        return
 
+    try:
+        bot.connect()
+        bot.ingest()
 
-    if buy_amount == Decimal('0.0'):
-        # Report out status of current holdings, then we're done.
-        current_positions = utils.open_positions_report()
-        print(current_positions)
+        if bot.depth_recorders:
+            bot.record_depth()
 
-        scalped_positions = utils.scalped_positions_report()
-        print("\n" + scalped_positions)
-        exit()
+        if bot.update_order_status:
+            bot.reconcile()
+            bot.reprice()
 
+        bot.record_portfolio()
 
-    #------------------------------------------------------------------------------------
-    #  BUY the next target based on the most favorable price_to_ma ratio
-
-    # Don't allow too many consecutive buys
-    recent_positions = LongPosition.get_last_positions(max_consecutive_buys)
-    recent_markets = {p.market for p in recent_positions}
-
-    # Are we too heavily weighted on a crypto on our watchlist?
-    over_positioned = []
-    num_positions = {}
-    total_positions = LongPosition.get_open_positions().count()
-    for crypto in watchlist:
-        market = f"{crypto}{base_currency}"
-        num_positions[crypto] = LongPosition.get_open_positions(market).count()
-        if total_positions > 0 and Decimal(num_positions[crypto] / total_positions) >= max_crypto_holdings_percentage:
-            over_positioned.append(crypto)
-
-    ma_ratios = ""
-    buy_candidates = []
-    total_entries = Decimal('0')
-    max_price_to_ma = max(metrics, key=lambda m:m['price_to_ma'])['price_to_ma']
-    for metric in sorted(metrics, key = lambda i: i['price_to_ma']):
-        market = metric['market']
-        crypto = metric['market'][:(-1 * len(base_currency))]
-        if crypto not in watchlist:
-            # This is a historical crypto being updated
-            continue
-
-        price_to_ma = metric['price_to_ma']
-        ma_ratios += f"{crypto}: price-to-MA: {price_to_ma:0.4f} | positions: {num_positions[crypto]}\n"
-
-        # Consider any crypto that isn't overpositioned and hasn't had too many
-        #   consecutive buys.
-        #   Calculate a number of entries for a lottery selection process, based on
-        #   price-to-MA distance to max_price_to_ma.
-        if (crypto not in over_positioned
-                and (market not in recent_markets or len(recent_markets) > 1)):
-            # Use a cubed distance function to more heavily weight the lower price-to-MAs
-            entries = (((max_price_to_ma - price_to_ma) * Decimal('100.0')) ** Decimal('3')).quantize(Decimal('1'))
-            total_entries += entries
-
-            buy_candidates.append({
-                'market': market,
-                'price_to_ma': price_to_ma,
-                'entries': entries
-            })
-    print(ma_ratios)
-
-    if len(buy_candidates) == 0:
-        # They're all overpositioned or their price-to-MA is pumping!
-        print(f"No buy candidates found.")
-        exit()
-
-    # Now build random odds list based on buy candidates and their price-to-MA;
-    #   lower price-to-MA increases odds of being selected.
-    lottery_markets = []
-    lottery_weights = []
-    for candidate in buy_candidates:
-        print(f"candidate: {candidate['market']} | {int(candidate['entries']):4d} entries")
-        lottery_markets.append(candidate['market'])
-        lottery_weights.append(float(candidate['entries'] / total_entries))
-
-    target_market = random.choices( population=lottery_markets,
-                                    weights=lottery_weights,
-                                    k=1)[0]
-    target_metric = next(metric for metric in metrics if metric['market'] == target_market)
-
-    # Set up a market buy for the first result that isn't overpositioned
-    market = target_metric['market']
-    crypto = market[:(-1 * len(base_currency))]
-    exchange_name = target_metric['exchange']
-    exchange = exchanges[exchange_name]
-    ma_period = target_metric['ma_period']
-    price_to_ma = target_metric['price_to_ma']
-
-    current_price = exchange.get_current_ask(market)
-
-    quantity = buy_amount / current_price
-
-    market_params = MarketParams.get_market(market)
-    quantized_buy_qty = quantity.quantize(market_params.lot_step_size)
-
-    if quantized_buy_qty * current_price < market_params.min_notional:
-        # Final order size isn't big enough
-        print(f"Must increase quantized_buy_qty: {quantized_buy_qty} * {current_price} < {market_params.min_notional}")
-        quantized_buy_qty += market_params.lot_step_size
-
-    print(f"Buy: {'{:f}'.format(quantized_buy_qty.normalize())} {crypto} @ {current_price:0.8f} {base_currency}\n")
-
-    if live_mode:
-        results = exchange.buy(market, quantized_buy_qty)
-
-        position = LongPosition.create(
-            exchange=exchange_name,
-            market=market,
-            buy_order_id=results['order_id'],
-            buy_quantity=results['quantity'],
-            purchase_price=results['price'],
-            fees=results['fees'],
-            timestamp=results['timestamp'],
-            watchlist=",".join(watchlist),
-        )
-
-        # Immediately place a LIMIT SELL order for this position.
-        #   Initial sell price will be aggressive: avg of the current MA and the min profit target.
-        #   This will get adjusted down later if the MA continues to drop. But if the current MA
-        #   is less than the min profit target, we'll use that instead.
-        min_profit_price = (position.purchase_price * profit_threshold).quantize(market_params.price_tick_size, rounding=ROUND_UP)
-        target_price = ((target_metric['ma'] + min_profit_price)/Decimal('2.0')).quantize(market_params.price_tick_size, rounding=ROUND_UP)
-
-        if target_price < min_profit_price:
-            target_price = min_profit_price
-
-        (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, target_price)
-
-        results = exchange.limit_sell(market, sell_quantity, target_price)
-        """
-            {
-                "order_id": order_id,
-                "price": bid_price,
-                "quantity": quantized_qty
-            }
-        """
-        print(f"LIMIT SELL ORDER: {results}\n")
-        print(f"Sell target = {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
-        position.sell_order_id = results['order_id']
-        position.sell_price = results['price']
-        position.save()
-
-    # Report out status of updated holdings
-    current_positions = utils.open_positions_report()
-    print(current_positions)
-
-    scalped_positions = utils.scalped_positions_report()
-    print("\n" + scalped_positions)
-
-    if live_mode:
-        # Send SNS message
-        subject = f"Bought {'{:f}'.format(quantized_buy_qty)} {crypto} ({price_to_ma*Decimal('100.0'):0.2f}% of {ma_period}-hr MA)"
-        print(subject)
-        message = ma_ratios
-        message += "\n\n" + current_positions
-        message += "\n\n" + scalped_positions
-
-        sns.publish(
-            TopicArn=sns_topic,
-            Subject=subject,
-            Message=message
-        )
+        if not bot.buying:
+            # Report out status of current holdings, then we're done.
+            bot.report()
+            return
+
+        bot.report(bot.buy())
+    finally:
+        lock.release()
 
 
+
+if __name__ == '__main__':
+    atexit.register(write_run_trace)
+    main()
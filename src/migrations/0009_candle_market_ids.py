@@ -0,0 +1,47 @@
+import sys
+
+from playhouse.migrate import *
+
+"""
+    Moves the candles into a WITHOUT ROWID table keyed by
+    (market_id, interval, timestamp) with the market names interned in a new
+    `market` table, then VACUUMs to hand the freed pages back.
+
+    Pass the market data DB if it isn't ../data.db (see MARKET_DATA_DB_FILE).
+"""
+my_db = SqliteDatabase(sys.argv[1] if len(sys.argv) > 1 else '../data.db')
+
+with my_db.atomic():
+    my_db.execute_sql('''
+        CREATE TABLE IF NOT EXISTS "market" (
+            "id" INTEGER NOT NULL PRIMARY KEY,
+            "name" VARCHAR(255) NOT NULL)''')
+    my_db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "market_name" ON "market" ("name")')
+    my_db.execute_sql('''
+        INSERT OR IGNORE INTO "market" ("name")
+            SELECT DISTINCT "market" FROM "candle" ORDER BY "market"''')
+
+    my_db.execute_sql('''
+        CREATE TABLE "candle_new" (
+            "market_id" INTEGER NOT NULL,
+            "interval" INTEGER NOT NULL,
+            "timestamp" INTEGER NOT NULL,
+            "open" DECIMAL(10, 5) NOT NULL,
+            "high" DECIMAL(10, 5) NOT NULL,
+            "low" DECIMAL(10, 5) NOT NULL,
+            "close" DECIMAL(10, 5) NOT NULL,
+            "rsi_1min" DECIMAL(10, 5),
+            PRIMARY KEY ("market_id", "interval", "timestamp")) WITHOUT ROWID''')
+
+    # Inserting in key order appends to the clustered index instead of splitting pages
+    my_db.execute_sql('''
+        INSERT OR IGNORE INTO "candle_new"
+            SELECT m."id", c."interval", CAST(c."timestamp" AS INTEGER),
+                   c."open", c."high", c."low", c."close", c."rsi_1min"
+            FROM "candle" c JOIN "market" m ON m."name" = c."market"
+            ORDER BY m."id", c."interval", CAST(c."timestamp" AS INTEGER)''')
+
+    my_db.execute_sql('DROP TABLE "candle"')
+    my_db.execute_sql('ALTER TABLE "candle_new" RENAME TO "candle"')
+
+my_db.execute_sql('VACUUM')
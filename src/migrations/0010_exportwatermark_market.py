@@ -0,0 +1,35 @@
+import sys
+
+from playhouse.migrate import *
+
+"""
+    Adds exportwatermark.market so candles keep an export watermark per market,
+    and replaces each destination's single candles watermark with one per
+    market at the same point.
+
+    Pass the DB if it isn't ../data.db, and the market data DB after it if
+    that's a separate file (see MARKET_DATA_DB_FILE).
+"""
+db_file = sys.argv[1] if len(sys.argv) > 1 else '../data.db'
+my_db = SqliteDatabase(db_file)
+market_db = SqliteDatabase(sys.argv[2] if len(sys.argv) > 2 else db_file)
+migrator = SqliteMigrator(my_db)
+
+markets = [name for (name, ) in market_db.execute_sql('SELECT "name" FROM "market"').fetchall()]
+
+with my_db.atomic():
+    migrate(
+        migrator.drop_index('exportwatermark', 'exportwatermark_table_destination'),
+        migrator.add_column('exportwatermark', 'market', CharField(default='')),
+        migrator.add_index('exportwatermark', ('table', 'destination', 'market'), True),
+    )
+
+    marks = my_db.execute_sql('''
+        SELECT "destination", "watermark", "exported_at" FROM "exportwatermark"
+            WHERE "table" = 'candles' AND "market" = \'\'''').fetchall()
+    for (destination, watermark, exported_at) in marks:
+        for market in markets:
+            my_db.execute_sql('''
+                INSERT INTO "exportwatermark" ("table", "destination", "market", "watermark", "exported_at", "num_rows")
+                    VALUES ('candles', ?, ?, ?, ?, 0)''', (destination, market, watermark, exported_at))
+    my_db.execute_sql('''DELETE FROM "exportwatermark" WHERE "table" = 'candles' AND "market" = \'\'''')
@@ -0,0 +1,56 @@
+import main
+
+from selective_dca_bot import config
+from selective_dca_bot.scheduler import Scheduler
+
+
+"""
+    Runs the bot as a resident process instead of from cron: candle ingest,
+    order reconciliation, repricing, portfolio snapshots, order book depth
+    samples (with DEPTH_RECORDER) and buys each run on their own cadence
+    (SCHEDULE in config.py), with the exchange clients and PositionBook kept
+    warm between ticks.
+
+    Repricing and the portfolio snapshots are skipped until there's a new
+    candle or a position was bought or sold; buys are skipped until there's a
+    new candle. Every phase takes the same lock as main.py, so a leftover cron
+    entry can't trade on the account at the same time.
+
+    Takes the same arguments as main.py. To run:
+        python scheduler.py 0.001 BTC -l -u
+"""
+
+
+
+if __name__ == '__main__':
+    args = main.parser.parse_args()
+    bot = main.Bot(args)
+    bot.connect()
+
+    def portfolio():
+        bot.record_portfolio()
+        bot.report()
+
+    def buy():
+        bot.report(bot.buy())
+
+    def positions_fingerprint():
+        return (bot.candles_fingerprint(), bot.book.version)
+
+    schedule = config.SCHEDULE
+    scheduler = Scheduler(tags=bot.tags, on_finish=main.write_run_trace)
+    scheduler.add('ingest', bot.ingest, schedule['ingest'])
+    if bot.update_order_status:
+        scheduler.add('reconcile', bot.reconcile, schedule['reconcile'])
+        scheduler.add('reprice', bot.reprice, schedule['reprice'], fingerprint=positions_fingerprint)
+    scheduler.add('portfolio', portfolio, schedule['portfolio'], fingerprint=positions_fingerprint)
+    if bot.depth_recorders:
+        scheduler.add('depth', bot.record_depth, schedule['depth'])
+    if bot.buying:
+        scheduler.add('buy', buy, schedule['buy'], fingerprint=bot.candles_fingerprint)
+
+    print(f"Scheduling {', '.join(job.name for job in scheduler.jobs)}")
+    try:
+        scheduler.run_forever()
+    except KeyboardInterrupt:
+        pass
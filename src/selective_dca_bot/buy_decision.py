@@ -0,0 +1,135 @@
+import numpy
+
+from .models import LongPosition
+
+
+
+class BuySnapshot():
+    """
+        Everything one base currency's buy decision looks at, loaded up front:
+        the markets' latest metrics, their open position counts and which of
+        them got the most recent buys. Back-tests can build one straight from
+        their own state instead of calling load().
+    """
+    def __init__(self, base_currency, markets, metrics, open_positions, recent_markets):
+        self.base_currency = base_currency
+        self.markets = markets                  # {market: crypto}
+        self.metrics = metrics                  # {market: metric}
+        self.open_positions = open_positions    # {market: num open positions}
+        self.recent_markets = recent_markets    # markets bought in the last max_consecutive_buys
+
+
+    @staticmethod
+    def load(base_currency, watchlist, metrics, book, max_consecutive_buys):
+        markets = {f"{crypto}{base_currency}": crypto for crypto in watchlist if crypto != base_currency}
+        counts = book.counts()
+        recent_positions = LongPosition.get_last_positions(max_consecutive_buys, markets=list(markets))
+        return BuySnapshot(
+            base_currency,
+            markets,
+            {m['market']: m for m in metrics if m['market'] in markets},
+            {market: counts.get(market, 0) for market in markets},
+            {p.market for p in recent_positions}
+        )
+
+
+
+class BuyDecision():
+    """
+        The outcome of one buy lottery. `metric` is the winner's metric dict, or
+        None if every market was over-positioned, recently bought or had an
+        incomplete MA.
+    """
+    def __init__(self, snapshot, candidates, weights, metric, seed, ma_ratios):
+        self.snapshot = snapshot
+        self.candidates = candidates
+        self.weights = weights
+        self.metric = metric
+        self.seed = seed
+        self.ma_ratios = ma_ratios
+
+
+    @property
+    def market(self):
+        return self.metric['market'] if self.metric else None
+
+
+    @property
+    def exchange(self):
+        return self.metric['exchange'] if self.metric else None
+
+
+    @property
+    def crypto(self):
+        return self.snapshot.markets[self.metric['market']] if self.metric else None
+
+
+
+def decide_buy(snapshot, max_crypto_holdings_percentage, seed=None):
+    """
+        Scores every market in the snapshot at once and draws the one to buy.
+
+        Each eligible market gets ((max_price_to_ma - price_to_ma) * 100)^3
+        lottery entries so the lower price-to-MAs are heavily favored. A market
+        is ineligible if its MA is incomplete, it already holds at least
+        max_crypto_holdings_percentage of the open positions, or it took the
+        only recent buys. The same snapshot and seed always draw the same market.
+    """
+    metrics = sorted(snapshot.metrics.values(), key=lambda m: m['price_to_ma'])
+    if not metrics:
+        return BuyDecision(snapshot, [], [], None, seed, "")
+
+    price_to_ma = numpy.array([float(m['price_to_ma']) for m in metrics])
+    reliable = numpy.array([m['ma_reliable'] for m in metrics], dtype=bool)
+    num_positions = numpy.array([snapshot.open_positions.get(m['market'], 0) for m in metrics])
+    recent = numpy.array([m['market'] in snapshot.recent_markets for m in metrics], dtype=bool)
+
+    # Are we too heavily weighted on a crypto on our watchlist?
+    total_positions = sum(snapshot.open_positions.values())
+    if total_positions > 0:
+        over_positioned = num_positions / total_positions >= float(max_crypto_holdings_percentage)
+    else:
+        over_positioned = numpy.zeros(len(metrics), dtype=bool)
+
+    # Don't allow too many consecutive buys
+    if len(snapshot.recent_markets) > 1:
+        recent[:] = False
+
+    eligible = reliable & ~over_positioned & ~recent
+
+    # Use a cubed distance function to more heavily weight the lower price-to-MAs
+    entries = numpy.round(((price_to_ma.max() - price_to_ma) * 100.0) ** 3)
+
+    ma_ratios = ""
+    for (i, metric) in enumerate(metrics):
+        crypto = snapshot.markets[metric['market']]
+        ma_ratios += f"{crypto}: price-to-MA: {metric['price_to_ma']:0.4f} | positions: {num_positions[i]}"
+        if not reliable[i]:
+            # Its MA window still has missing candles; don't buy on a bad MA
+            ma_ratios += " | MA incomplete"
+        ma_ratios += "\n"
+
+    indices = numpy.flatnonzero(eligible)
+    if not len(indices):
+        # They're all overpositioned or their price-to-MA is pumping!
+        return BuyDecision(snapshot, [], [], None, seed, ma_ratios)
+
+    candidate_entries = entries[indices]
+    total_entries = candidate_entries.sum()
+    if total_entries > 0:
+        weights = candidate_entries / total_entries
+    else:
+        # Every candidate is at the max price-to-MA; give them even odds
+        weights = numpy.full(len(indices), 1.0 / len(indices))
+
+    candidates = [{
+        'exchange': metrics[i]['exchange'],
+        'market': metrics[i]['market'],
+        'price_to_ma': metrics[i]['price_to_ma'],
+        'entries': int(entries[i]),
+    } for i in indices]
+
+    draw = numpy.random.RandomState(seed).random_sample()
+    winner = min(int(numpy.searchsorted(numpy.cumsum(weights), draw, side='right')), len(indices) - 1)
+
+    return BuyDecision(snapshot, candidates, weights.tolist(), metrics[indices[winner]], seed, ma_ratios)
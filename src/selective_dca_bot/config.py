@@ -1,7 +1,93 @@
+from decimal import Decimal
+
 
 class Config:
     SQLITE_DB_FILE = 'data.db'
 
+    # Optional separate DB for candles and MarketParams, shared across portfolios
+    MARKET_DATA_DB_FILE = None
+
+    # SQLite connection pragmas. WAL lets reports and back-tests read while the
+    #   bot is writing; busy_timeout (ms) waits out the brief write locks.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',        # Safe with WAL; only fsyncs at checkpoints
+        'cache_size': -16 * 1024,       # Negative = KiB, i.e. 16MB page cache
+        'mmap_size': 64 * 1024 * 1024,
+        'busy_timeout': 10 * 1000,
+    }
+
+    # Open the DBs read-only (reports, back-tests); see models.configure_db()
+    SQLITE_READ_ONLY = False
+
+    # Run tracing output (both off unless set); see tracing.py. The run log
+    #   gets a line per run and per scheduler tick and isn't rotated.
+    RUN_LOG_FILE = None
+    PROMETHEUS_TEXTFILE = None
+
+    # Read-only JSON status API; see status.py
+    STATUS_HOST = '127.0.0.1'
+    STATUS_PORT = 8080
+    STATUS_REFRESH_SECONDS = 5      # How often the server checks for new snapshots
+    STATUS_RECENT_RUNS = 20
+
+    # Max seconds to trust the bulk bid/ask/last price snapshot before re-fetching
+    PRICE_SNAPSHOT_MAX_AGE = 60
+
+    # Max seconds to trust the bulk account balances (kept current locally
+    #   as orders are placed) before re-fetching
+    BALANCE_SNAPSHOT_MAX_AGE = 10 * 60
+
+    # Per-run budget for re-fetching holes in the stored candles; see CandleGap
+    GAP_REPAIR_MAX_REQUESTS = 10
+    GAP_REPAIR_SLEEP = 1            # Seconds between gap repair requests
+
+    # PaperExchange (--paper) simulated fees and opening balances, e.g. {'BTC': 1}
+    PAPER_FEE_RATE = Decimal('0.001')
+    PAPER_STARTING_BALANCES = {}
+
+    BITTREX_API_URL = 'https://api.bittrex.com/v3'
+
+    # Optional order book depth recorder; see depth_recorder.py. Each market
+    #   keeps its last DEPTH_SAMPLES samples of the top DEPTH_LEVELS bids/asks.
+    DEPTH_RECORDER = False
+    DEPTH_DIR = None                # Default: <market data DB>.depth
+    DEPTH_LEVELS = 20
+    DEPTH_SAMPLES = 7 * 24 * 12     # A week at the default 5 minute cadence
+
+    # Sold positions moved to the archive per transaction; see LongPosition.archive_sold()
+    ARCHIVE_BATCH_SIZE = 500
+
+    # Resident scheduler (scheduler.py): seconds between each phase's runs
+    SCHEDULE = {
+        'ingest': 60,
+        'reconcile': 5 * 60,
+        'reprice': 5 * 60,
+        'portfolio': 15 * 60,       # PortfolioSnapshot, archiving, status reports
+        'buy': 60 * 60,
+        'depth': 5 * 60,            # Only with DEPTH_RECORDER
+    }
+    SCHEDULE_JITTER = 0.1           # Up to this fraction of the interval is added to each wait
+
+    # Shared exchange HTTP connection pools; see exchanges/transport.py
+    HTTP_POOL_CONNECTIONS = 10      # Number of hosts to keep pools for
+    HTTP_POOL_MAXSIZE = 16          # Max concurrent connections per host
+
+    # Per-API-key request budget: (requests per second, burst)
+    RATE_LIMITS = {
+        'binance': (10, 20),
+        'bittrex': (1, 1),
+    }
+
+    # An endpoint that fails this many times in a row (connection errors,
+    #   timeouts, 5xx, 429) fails fast for CIRCUIT_BREAKER_COOLDOWN seconds
+    CIRCUIT_BREAKER_THRESHOLD = 5
+    CIRCUIT_BREAKER_COOLDOWN = 60
+
+    # Resends of an order whose outcome was unknown, after looking it up by
+    #   its client order id
+    ORDER_RETRIES = 3
+
     interval = None
     update_candles = True
     update_candles_since = "5 hours ago"
@@ -0,0 +1,182 @@
+import os
+import time
+
+import numpy
+
+from . import config
+from .tracing import tracer
+
+
+"""
+    Optional order book depth recorder for slippage analysis (DEPTH_RECORDER in
+    settings.conf). Samples the top DEPTH_LEVELS bids and asks of every watched
+    market and keeps each market's last DEPTH_SAMPLES samples in a fixed-size
+    ring buffer on disk, so a week of 5-minute samples for a whole watchlist
+    stays in the low megabytes.
+
+    estimate_buy() walks a recorded book to price a market buy of a given size:
+    the bot logs it next to each actual fill, and back-tests can apply it to
+    their simulated buys.
+"""
+
+
+
+def depth_dtype(levels):
+    return numpy.dtype([
+        ('timestamp', '<i8'),
+        ('bids', '<f4', (levels, 2)),       # (price, quantity), best first; zero-padded
+        ('asks', '<f4', (levels, 2)),
+    ])
+
+
+
+def to_levels(book_side, levels):
+    side = numpy.zeros((levels, 2), dtype='<f4')
+    for (i, (price, quantity)) in enumerate(book_side[:levels]):
+        side[i] = (float(price), float(quantity))
+    return side
+
+
+
+def estimate_buy(asks, quote_amount):
+    """
+        Fill a market buy spending `quote_amount` against `asks` ((price,
+        quantity) rows, best first). Returns (vwap, quantity), or None if the
+        levels can't absorb the whole buy.
+    """
+    asks = numpy.asarray(asks, dtype=float)
+    asks = asks[asks[:, 1] > 0]
+    quote_amount = float(quote_amount)
+    if not len(asks) or quote_amount <= 0:
+        return None
+
+    spent = numpy.cumsum(asks[:, 0] * asks[:, 1])
+    if spent[-1] < quote_amount:
+        return None
+
+    # The level the buy finishes in, and what's left to spend when it gets there
+    last = int(numpy.searchsorted(spent, quote_amount))
+    remaining = quote_amount - (spent[last - 1] if last else 0.0)
+    quantity = float(asks[:last, 1].sum() + remaining / asks[last, 0])
+    return (quote_amount / quantity, quantity)
+
+
+
+class DepthRing():
+    """
+        One market's depth samples in a fixed-size, memory-mapped .npy ring
+        buffer. Empty slots have a zero timestamp and the newest sample has the
+        highest one, so the write position is recovered from the data itself.
+    """
+    def __init__(self, path, levels, capacity):
+        self.path = path
+        self.levels = levels
+        self.capacity = capacity
+
+        dtype = depth_dtype(levels)
+        samples = numpy.load(path, mmap_mode='r+') if os.path.exists(path) else None
+        if samples is not None and (samples.dtype != dtype or len(samples) != capacity):
+            print(f"{path} was recorded with different DEPTH_LEVELS/DEPTH_SAMPLES; starting it over")
+            del samples
+            samples = None
+        if samples is None:
+            samples = numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(capacity, ))
+        self.samples = samples
+
+        timestamps = self.samples['timestamp']
+        self.head = (int(numpy.argmax(timestamps)) + 1) % capacity if timestamps.any() else 0
+
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.samples['timestamp']))
+
+
+    def append(self, timestamp, bids, asks):
+        self.samples[self.head] = (int(timestamp), to_levels(bids, self.levels), to_levels(asks, self.levels))
+        self.head = (self.head + 1) % self.capacity
+
+
+    def flush(self):
+        self.samples.flush()
+
+
+    def at(self, timestamp=None):
+        """
+            The latest sample at or before `timestamp` (default: the latest one),
+            or None.
+        """
+        timestamps = self.samples['timestamp']
+        recorded = timestamps > 0
+        if timestamp is not None:
+            recorded &= timestamps <= timestamp
+        if not recorded.any():
+            return None
+        return self.samples[int(numpy.argmax(numpy.where(recorded, timestamps, 0)))]
+
+
+
+class DepthRecorder():
+    """
+        Samples `markets` on `exchange` into one DepthRing each, under
+        `directory` (default: DEPTH_DIR, or `<market data DB>.depth`).
+    """
+    def __init__(self, exchange, markets, directory=None, levels=None, capacity=None):
+        self.exchange = exchange
+        self.markets = markets
+        self.directory = directory or config.DEPTH_DIR or f"{config.MARKET_DATA_DB_FILE or config.SQLITE_DB_FILE}.depth"
+        self.levels = levels or config.DEPTH_LEVELS
+        self.capacity = capacity or config.DEPTH_SAMPLES
+        self._rings = {}
+
+
+    def ring(self, market):
+        if market not in self._rings:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{self.exchange.exchange_name}-{market}.npy")
+            self._rings[market] = DepthRing(path, self.levels, self.capacity)
+        return self._rings[market]
+
+
+    def sample(self, now=None):
+        """
+            Record one sample per market; returns how many were recorded.
+        """
+        now = int(now or time.time())
+        num_sampled = 0
+        for market in self.markets:
+            book = self.exchange.get_market_depth(market, limit=self.levels)
+            if not book:
+                continue
+            ring = self.ring(market)
+            ring.append(now, book['bids'], book['asks'])
+            ring.flush()
+            num_sampled += 1
+        tracer.incr(f"depth_samples.{self.exchange.exchange_name}", num_sampled)
+        return num_sampled
+
+
+    def estimate_buy(self, market, quote_amount, timestamp=None):
+        """
+            Expected fill of a market buy spending `quote_amount`, against the
+            book sampled at or before `timestamp` (default: the latest):
+                {'timestamp', 'best_ask', 'vwap', 'quantity', 'slippage'}
+            with slippage as a fraction of the best ask. None if there's no
+            sample or its levels can't absorb the buy.
+        """
+        sample = self.ring(market).at(timestamp)
+        if sample is None:
+            return None
+
+        estimate = estimate_buy(sample['asks'], quote_amount)
+        if not estimate:
+            return None
+
+        (vwap, quantity) = estimate
+        best_ask = float(sample['asks'][0][0])
+        return {
+            "timestamp": int(sample['timestamp']),
+            "best_ask": best_ask,
+            "vwap": vwap,
+            "quantity": quantity,
+            "slippage": vwap / best_ask - 1.0,
+        }
@@ -1,6 +1,7 @@
 from .abstract_exchange import AbstractExchange
 from .binance_exchange import BinanceExchange
 from .bittrex_exchange import BittrexExchange
+from .paper_exchange import PaperExchange
 from .exchanges_manager import ExchangesManager
 from .constants import EXCHANGE__BINANCE
 from .constants import EXCHANGE__BITTREX
@@ -1,34 +1,105 @@
 from abc import ABC, abstractmethod     # ABC = Abstract Base Class
 from decimal import Decimal
 
+from .balance_snapshot import BalanceSnapshot
+from .price_snapshot import PriceSnapshot
+
 
 
 class AbstractExchange(ABC):
     _exchange_name = None
+    _max_candles_per_request = 500
+    _market_params_exchange = None      # MarketParams.exchange code
 
 
     def __init__(self, api_key, api_secret, watchlist):
         super().__init__()
         self.watchlist = watchlist
+        self._price_snapshot = None
+        self._balance_snapshot = None
 
     @property
     def exchange_name(self):
         return self._exchange_name
 
+    @property
+    def price_snapshot(self):
+        """
+            Run-wide cache of every symbol's bid/ask/last price; see PriceSnapshot.
+        """
+        from .. import config
+        if not self._price_snapshot:
+            self._price_snapshot = PriceSnapshot(self.fetch_price_snapshot, config.PRICE_SNAPSHOT_MAX_AGE)
+        return self._price_snapshot
+
+    @property
+    def balance_snapshot(self):
+        """
+            Run-wide view of the account's balances; see BalanceSnapshot.
+        """
+        from .. import config
+        if not self._balance_snapshot:
+            self._balance_snapshot = BalanceSnapshot(self.fetch_balances, config.BALANCE_SNAPSHOT_MAX_AGE)
+        return self._balance_snapshot
+
+
+    def fetch_balances(self):
+        """
+            Bulk-fetch {asset: {'free': ..., 'locked': ...}} for the whole
+            account, or None if the exchange can't.
+        """
+        return None
+
+
+    def has_balance(self, asset, amount):
+        return self.balance_snapshot.has_free(asset, amount)
+
     @abstractmethod
     def build_market_name(self, crypto, base_currency):
         pass
 
+
+    def get_market_params(self, market):
+        from ..models import MarketParams
+        return MarketParams.get_market(market, exchange=self._market_params_exchange)
+
     @abstractmethod
     def initialize_market(self, crypto, base_currency):
         pass
 
 
+    @abstractmethod
+    def fetch_price_snapshot(self):
+        """
+            Bulk-fetch {market: {'bid': ..., 'ask': ..., 'last': ...}} for every
+            market on the exchange.
+        """
+        pass
+
+
     @abstractmethod
     def get_current_ask(self, market):
         pass
 
 
+    def get_current_price(self, market):
+        return self.price_snapshot.last(market)
+
+
+    def has_market(self, market):
+        # Every symbol the exchange lists is in the price snapshot
+        return self.price_snapshot.has(market)
+
+
+    def get_market_depth(self, market, limit=20):
+        """
+            Top `limit` levels of the order book, best first:
+                {'bids': [(price, quantity), ...], 'asks': [(price, quantity), ...]}
+            or None if the exchange doesn't provide it.
+        """
+        return None
+
+
     @abstractmethod
     def buy(self, market, quantity):
         pass
@@ -62,60 +133,169 @@ class AbstractExchange(ABC):
         pass
 
 
+    def get_fills(self, market, after_trade_id=None):
+        """
+            The account's trades in `market` newer than `after_trade_id` (all of
+            them if None), oldest first:
+                [{'trade_id': ..., 'order_id': ..., 'side': 'BUY'|'SELL', 'price': ...,
+                  'quantity': ..., 'quote_quantity': ..., 'commission': ...,
+                  'commission_asset': ..., 'timestamp': ...}, ...]
+
+            Returns None for exchanges that don't have a trade list to sync from.
+        """
+        return None
+
+
+    def replace_limit_sells(self, market, orders):
+        """
+            Cancel each order's current LIMIT SELL (if any) and place a new one:
+                orders = [{'order_id': ..., 'quantity': ..., 'price': ...}, ...]
+
+            Yields a (cancel_order() result or None, limit_sell() result) pair per
+            order, in order, as each completes. No new LIMIT SELL is placed if
+            the old one couldn't be canceled (it may still be open, or have just
+            filled). Exchanges with a batch order endpoint override this.
+        """
+        for order in orders:
+            canceled = self.cancel_order(market, order['order_id']) if order['order_id'] else None
+            if canceled and not canceled[0]:
+                yield (canceled, None)
+                continue
+            yield (canceled, self.limit_sell(market, order['quantity'], order['price']))
+
+
     @abstractmethod
     def ingest_latest_candles(self, market, interval, since=None, limit=5):
         pass
 
 
+    @abstractmethod
+    def ingest_candle_range(self, market, interval, start, end):
+        """
+            Fetch and store the candles from `start` through `end` (inclusive, unix
+            timestamps). Returns the timestamp of the last candle the exchange sent.
+        """
+        pass
+
+
+    def repair_candle_gaps(self, market, interval, max_requests):
+        """
+            Re-fetch the open CandleGaps for this market, most recent first, with
+            at most `max_requests` API calls. Returns the number of calls made.
+        """
+        import time
+        from .. import config
+        from ..models import Candle, CandleGap
+        from ..tracing import tracer
+
+        step = Candle.INTERVAL_SECONDS[interval]
+        num_requests = 0
+        for gap in list(CandleGap.get_open_gaps(market, interval)):
+            start = gap.start_timestamp
+            while start <= gap.end_timestamp:
+                if num_requests >= max_requests:
+                    return num_requests
+
+                if num_requests > 0 and config.GAP_REPAIR_SLEEP:
+                    # Same courtesy as the regular ingest so we don't get API limited
+                    time.sleep(config.GAP_REPAIR_SLEEP)
+                    tracer.incr("rate_limit_sleep_seconds", config.GAP_REPAIR_SLEEP)
+
+                end = min(gap.end_timestamp, start + (self._max_candles_per_request - 1) * step)
+                print(f"{market} repairing gap: {start} - {end}")
+                self.ingest_candle_range(market, interval, start, end)
+                num_requests += 1
+                tracer.incr(f"gap_repair_requests.{self.exchange_name}")
+
+                gap.update_after_fetch(end)
+                if end >= gap.end_timestamp:
+                    break
+
+                # Carry on with whatever is left of this gap
+                gap = CandleGap.get(
+                    CandleGap.market == market,
+                    CandleGap.interval == interval,
+                    CandleGap.start_timestamp == end + step)
+                start = gap.start_timestamp
+
+        return num_requests
+
+
     def calculate_latest_metrics(self, base_currency, interval, ma_periods):
-        from ..models import Candle, AllTimeWatchlist
+        from .. import config
+        from ..models import Candle, CandleGap, AllTimeWatchlist
+        from ..tracing import tracer
 
         metrics = []
 
         # update ALL cryptos ever watched for this exchange (to support historical back testing)
         for crypto in AllTimeWatchlist.get_watchlist(exchange=self.exchange_name):
-            if not crypto:
+            if not crypto or crypto == base_currency:
                 continue
                 
             market = f"{crypto}{base_currency}"
-            self.initialize_market(crypto, base_currency)
-
-            # How many candles do we need to catch up on?
-            last_candle = Candle.get_last_candle(market, interval)
-            timestamp = None
-            if last_candle:
-                num_candles = last_candle.num_periods_from_now()
-                if num_candles > max(ma_periods):
-                    num_candles = max(ma_periods)
-                timestamp = last_candle.timestamp
-            else:
-                num_candles = max(ma_periods) + 1
-
-            self.ingest_latest_candles(market, interval, since=timestamp, limit=num_candles)
-
-            # Calculate the metrics for the current candle
-            last_candle = Candle.get_last_candle(market, interval)
-
-            min_ma_period = None
-            min_ma = Decimal('99999999.0')
-            min_price_to_ma = None
-            for ma_period in ma_periods:
-                ma = last_candle.calculate_moving_average(ma_period)
-                price_to_ma = last_candle.close / ma
-
-                # use the lowest MA across all supplied ma_periods
-                if ma < min_ma:
-                    min_price_to_ma = price_to_ma
-                    min_ma_period = ma_period
-                    min_ma = ma
+            if not self.has_market(market):
+                # e.g. an alt that only trades against BTC, in a run that also buys with USDT
+                print(f"{self.exchange_name} has no {market} market; skipping it")
+                continue
+
+            with tracer.span('candle_ingest', exchange=self.exchange_name, market=market):
+                self.initialize_market(crypto, base_currency)
+
+                # How many candles do we need to catch up on?
+                last_candle = Candle.get_last_candle(market, interval)
+                timestamp = None
+                if last_candle:
+                    num_candles = last_candle.num_periods_from_now()
+                    timestamp = last_candle.timestamp
+                    if num_candles > max(ma_periods):
+                        # Too far behind to catch up in one call. Grab the latest
+                        #   candles and leave the hole to the gap repair below.
+                        num_candles = max(ma_periods) + 1
+                        timestamp = None
+                else:
+                    num_candles = max(ma_periods) + 1
+
+                self.ingest_latest_candles(market, interval, since=timestamp, limit=num_candles)
+
+                if last_candle and timestamp is None:
+                    new_last_candle = Candle.get_last_candle(market, interval)
+                    CandleGap.index_range(market, interval, last_candle.timestamp, new_last_candle.timestamp)
+
+            with tracer.span('gap_repair', exchange=self.exchange_name, market=market):
+                self.repair_candle_gaps(market, interval, max_requests=config.GAP_REPAIR_MAX_REQUESTS)
+
+            with tracer.span('metrics', exchange=self.exchange_name, market=market):
+                # Calculate the metrics for the current candle
+                last_candle = Candle.get_last_candle(market, interval)
+
+                min_ma_period = None
+                min_ma = Decimal('99999999.0')
+                min_price_to_ma = None
+                for ma_period in ma_periods:
+                    ma = last_candle.calculate_moving_average(ma_period)
+                    price_to_ma = last_candle.close / ma
+
+                    # use the lowest MA across all supplied ma_periods
+                    if ma < min_ma:
+                        min_price_to_ma = price_to_ma
+                        min_ma_period = ma_period
+                        min_ma = ma
+
+                # Don't trust an MA whose window still has holes in it
+                ma_reliable = last_candle.is_ma_reliable(min_ma_period)
+                if not ma_reliable:
+                    print(f"{market} {min_ma_period}-period MA has missing candles")
 
             metrics.append({
                 'exchange': self.exchange_name,
                 'market': market,
+                'timestamp': last_candle.timestamp,
                 'close': last_candle.close,
                 'ma_period': min_ma_period,
                 'ma': min_ma,
-                'price_to_ma': min_price_to_ma
+                'price_to_ma': min_price_to_ma,
+                'ma_reliable': ma_reliable
             })
 
             # print(f"{last_candle.market}: close: {last_candle.close:0.8f} | 200H_MA: {ma:0.8f} | price-to-MA: {price_to_ma:0.4f}")
@@ -0,0 +1,112 @@
+import time
+
+from decimal import Decimal
+
+
+
+class BalanceSnapshot():
+    """
+        Free and locked balance of every asset in the account, fetched with one
+        bulk call and then kept current locally as orders are placed, canceled
+        and filled, so orders the account can't cover are caught before they're
+        sent. Re-fetched once it's older than `max_age` seconds.
+
+        `fetch` returns {asset: {'free': Decimal, 'locked': Decimal}}, or None if
+        the exchange can't report balances; every check then passes.
+    """
+    def __init__(self, fetch, max_age):
+        self._fetch = fetch
+        self.max_age = max_age
+        self.balances = None
+        self.fetched_at = None
+
+
+    @property
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.max_age
+
+
+    def refresh(self):
+        self.balances = self._fetch()
+        self.fetched_at = time.time()
+
+
+    def _get_balances(self):
+        if self.is_stale:
+            self.refresh()
+        return self.balances
+
+
+    def free(self, asset):
+        balances = self._get_balances()
+        if balances is None:
+            return None
+        return balances.get(asset, {}).get('free', Decimal('0'))
+
+
+    def has_free(self, asset, amount):
+        free = self.free(asset)
+        return free is None or free >= amount
+
+
+    def can_sell(self, market, quantity):
+        if self._get_balances() is None:
+            return True
+        (crypto, base_currency) = self.split_market(market)
+        return crypto is None or self.has_free(crypto, quantity)
+
+
+    def split_market(self, market):
+        """
+            (crypto, base_currency) for a CRYPTO+BASE market name, matching the
+            longest asset in the account the market ends with.
+        """
+        for asset in sorted(self.balances or {}, key=len, reverse=True):
+            if market.endswith(asset) and len(market) > len(asset):
+                return (market[:-len(asset)], asset)
+        return (None, None)
+
+
+    # The updates below only touch balances that have already been fetched;
+    #   there's no point fetching them just to keep them current.
+    def adjust(self, asset, free=Decimal('0'), locked=Decimal('0')):
+        if self.balances is None or asset is None:
+            return
+        balance = self.balances.setdefault(asset, {'free': Decimal('0'), 'locked': Decimal('0')})
+        balance['free'] += free
+        balance['locked'] += locked
+
+
+    def adjust_commissions(self, commissions):
+        for (asset, amount) in commissions.items():
+            self.adjust(asset, free=-amount)
+
+
+    def lock(self, market, quantity):
+        # A LIMIT SELL was placed
+        (crypto, base_currency) = self.split_market(market)
+        self.adjust(crypto, free=-quantity, locked=quantity)
+
+
+    def unlock(self, market, quantity):
+        # A LIMIT SELL was canceled
+        (crypto, base_currency) = self.split_market(market)
+        self.adjust(crypto, free=quantity, locked=-quantity)
+
+
+    def bought(self, market, quantity, spent, commissions=None):
+        (crypto, base_currency) = self.split_market(market)
+        self.adjust(crypto, free=quantity)
+        self.adjust(base_currency, free=-spent)
+        self.adjust_commissions(commissions or {})
+
+
+    def sold(self, market, quantity, recouped, commissions=None, locked=True):
+        # `locked`: the quantity was held by a LIMIT SELL rather than sold at market
+        (crypto, base_currency) = self.split_market(market)
+        if locked:
+            self.adjust(crypto, locked=-quantity)
+        else:
+            self.adjust(crypto, free=-quantity)
+        self.adjust(base_currency, free=recouped)
+        self.adjust_commissions(commissions or {})
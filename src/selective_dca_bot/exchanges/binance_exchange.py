@@ -2,23 +2,43 @@ import binance
 import decimal
 import json
 import random
+import requests
 import time
+import uuid
 
 from binance.client import Client
 from decimal import Decimal
 from termcolor import cprint
 
+from . import transport
 from .constants import EXCHANGE__BINANCE
 from .abstract_exchange import AbstractExchange
 
 from .. import config
-from ..models import Candle, MarketParams
+from ..models import Candle, Fill, MarketParams
+from ..tracing import tracer
+
+
+
+class PooledClient(Client):
+    """
+        python-binance Client that talks through the shared, pooled transport
+        instead of building its own requests session.
+    """
+    def _init_session(self):
+        return transport.new_session(EXCHANGE__BINANCE, headers={
+            'Accept': 'application/json',
+            'User-Agent': 'binance/python',
+            'X-MBX-APIKEY': self.API_KEY
+        }, api_key=self.API_KEY)
 
 
 
 class BinanceExchange(AbstractExchange):
     _exchange_name = EXCHANGE__BINANCE
     _exchange_token = 'BNB'
+    _max_candles_per_request = 1000
+    _market_params_exchange = MarketParams.EXCHANGE__BINANCE
     _intervals = {
         Candle.INTERVAL__1MINUTE: Client.KLINE_INTERVAL_1MINUTE,
         Candle.INTERVAL__5MINUTE: Client.KLINE_INTERVAL_5MINUTE,
@@ -29,7 +49,7 @@ class BinanceExchange(AbstractExchange):
 
     def __init__(self, api_key, api_secret, watchlist):
         super().__init__(api_key, api_secret, watchlist)
-        self.client = Client(api_key, api_secret)
+        self.client = tracer.trace_client(PooledClient(api_key, api_secret), self.exchange_name)
 
 
 
@@ -154,6 +174,7 @@ class BinanceExchange(AbstractExchange):
         # Give the exchange a breather so we don't get API limited
         if limit > 10:
             time.sleep(3)
+            tracer.incr("rate_limit_sleep_seconds", 3)
 
         if since:
             # Convert Unix timestamp to binance's millisecond timestamp
@@ -166,6 +187,24 @@ class BinanceExchange(AbstractExchange):
         Candle.batch_create_candles(market, interval, self._format_candles(raw_data[:-1]))
 
 
+    def ingest_candle_range(self, market, interval, start, end):
+        """
+            Targeted fetch of up to 1000 candles from `start` through `end` (unix
+            timestamps); used to fill CandleGaps.
+        """
+        raw_data = self.client.get_klines(
+            symbol=market,
+            interval=self._intervals[interval],
+            startTime=int(start * 1000),
+            endTime=int(end * 1000),
+            limit=self._max_candles_per_request
+        )
+
+        candles = self._format_candles(raw_data)
+        Candle.batch_create_candles(market, interval, candles)
+        return candles[-1]['timestamp'] if candles else None
+
+
     def load_historical_candles(self, market, interval, since):
         """
             This is a historical batch update of all candles from 'since' to now.
@@ -203,8 +242,25 @@ class BinanceExchange(AbstractExchange):
         return results
 
 
+    def fetch_balances(self):
+        """
+            One account call for every asset (get_asset_balance() fetches the
+            whole account anyway, just to pick one asset out of it):
+                {
+                    "balances": [{
+                        "asset": "BTC",
+                        "free": "4723846.89208129",
+                        "locked": "0.00000000"
+                    }, {...}],
+                    ...
+                }
+        """
+        account = self.client.get_account()
+        return {b["asset"]: {"free": Decimal(b["free"]), "locked": Decimal(b["locked"])} for b in account["balances"]}
+
+
     def get_current_balance(self, asset='BTC'):
-        return Decimal(self.client.get_asset_balance(asset=asset)["free"])
+        return self.balance_snapshot.free(asset)
 
 
     def get_current_balances(self):
@@ -250,8 +306,9 @@ class BinanceExchange(AbstractExchange):
             }
         """
         try:
-            buy_order_response = self.client.order_market_buy(
-                symbol=market,
+            buy_order_response = self._place_order(
+                self.client.order_market_buy,
+                market,
                 quantity=quantized_qty,
                 newOrderRespType=Client.ORDER_RESP_TYPE_FULL    # Need the full details to get 'commission' (aka fees).
             )
@@ -279,6 +336,7 @@ class BinanceExchange(AbstractExchange):
             total_spent = Decimal(0.0)
             total_qty = Decimal(0.0)
             total_commission = Decimal(0.0)
+            commissions = {}
             for fill in buy_order_response["fills"]:
                 """ {
                         "price": "4000.00000000",
@@ -290,8 +348,10 @@ class BinanceExchange(AbstractExchange):
                 total_spent += Decimal(fill["price"]) * Decimal(fill["qty"])
                 total_qty += Decimal(fill["qty"])
                 total_commission += Decimal(fill["commission"])
+                commissions[fill["commissionAsset"]] = commissions.get(fill["commissionAsset"], Decimal('0')) + Decimal(fill["commission"])
 
             purchase_price = total_spent / total_qty
+            self.balance_snapshot.bought(market, total_qty, total_spent, commissions)
 
             return {
                 "order_id": order_id,
@@ -302,6 +362,92 @@ class BinanceExchange(AbstractExchange):
             }
 
 
+    def _outcome_unknown(self, e):
+        """
+            True if a failed order request may still have reached Binance, and
+            so may have been executed.
+        """
+        if isinstance(e, binance.exceptions.BinanceAPIException):
+            # -1006/-1007: Binance itself doesn't know whether it went through
+            return e.status_code >= 500 or e.code in (-1006, -1007)
+        if isinstance(e, binance.exceptions.BinanceRequestException):
+            return True
+        if isinstance(e, requests.exceptions.RequestException):
+            return not transport.never_sent(e)
+        return False
+
+
+    def _lookup_order(self, market, **order_id):
+        """
+            get_order() by orderId or origClientOrderId; None if Binance has no
+            such order.
+        """
+        try:
+            return self.client.get_order(symbol=market, **order_id)
+        except binance.exceptions.BinanceAPIException as e:
+            if e.code == -2013:     # Order does not exist.
+                return None
+            raise e
+
+
+    def _order_response(self, market, order):
+        """
+            Rebuild a FULL order response from a get_order() lookup and the
+            order's trades.
+        """
+        fills = []
+        if Decimal(order["executedQty"]) > Decimal('0'):
+            fills = [{
+                "price": trade["price"],
+                "qty": trade["qty"],
+                "commission": trade["commission"],
+                "commissionAsset": trade["commissionAsset"],
+            } for trade in self.client.get_my_trades(symbol=market, orderId=order["orderId"])]
+        return dict(order, transactTime=order["time"], fills=fills)
+
+
+    def _place_order(self, order_func, market, **params):
+        """
+            Send a new order under its own client order id so it can be retried
+            without being placed twice. After an attempt whose outcome is unknown
+            (timed out, 5xx, Binance's "send status unknown") the order is looked
+            up by that id before anything is resent; Binance only rejects
+            duplicate ids among *open* orders, so a filled market order has to
+            be found this way. Definite rejections (e.g. MIN_NOTIONAL) and an
+            open circuit are raised straight away.
+        """
+        client_order_id = f"sdca-{uuid.uuid4().hex[:30]}"
+        policy = transport.ENDPOINT_POLICIES.get('/api/v3/order', transport.DEFAULT_POLICY)
+        attempt = 0
+        while True:
+            try:
+                return order_func(symbol=market, newClientOrderId=client_order_id, **params)
+            except (binance.exceptions.BinanceAPIException, binance.exceptions.BinanceRequestException, requests.exceptions.RequestException) as e:
+                duplicate = isinstance(e, binance.exceptions.BinanceAPIException) and e.code == -2010 and 'Duplicate' in e.message
+                unknown = duplicate or self._outcome_unknown(e)
+                if isinstance(e, transport.CircuitOpenError) or not (unknown or transport.never_sent(e)):
+                    raise e
+
+                if attempt >= config.ORDER_RETRIES and not unknown:
+                    raise e
+
+                # Give the exchange a moment to settle before asking what happened
+                seconds = policy.backoff_seconds(attempt)
+                print(f"{market} order {client_order_id} failed ({e}); checking again in {seconds:0.2f}s")
+                time.sleep(seconds)
+
+                if unknown:
+                    order = self._lookup_order(market, origClientOrderId=client_order_id)
+                    if order:
+                        tracer.incr(f"orders_reconciled.{self.exchange_name}")
+                        return self._order_response(market, order)
+                    if attempt >= config.ORDER_RETRIES:
+                        raise e
+
+                tracer.incr(f"order_retries.{self.exchange_name}")
+                attempt += 1
+
+
     def reload_exchange_token(self, quantity):
         print(f"Reloading {quantity:.4f} {self.exchange_token} exchange tokens")
         market = f'{self.exchange_token}BTC'
@@ -314,8 +460,9 @@ class BinanceExchange(AbstractExchange):
         quantized_qty = quantity.quantize(market_params.lot_step_size)
 
         try:
-            response = self.client.order_market_sell(
-                symbol=market,
+            response = self._place_order(
+                self.client.order_market_sell,
+                market,
                 quantity=quantized_qty,
                 newOrderRespType=Client.ORDER_RESP_TYPE_FULL    # Need the full details to get 'commission' (aka fees).
             )
@@ -343,6 +490,7 @@ class BinanceExchange(AbstractExchange):
             total_made = Decimal('0.0')
             total_qty = Decimal(response["executedQty"])
             total_commission = Decimal('0.0')
+            commissions = {}
             for fill in response["fills"]:
                 """ {
                         "price": "4000.00000000",
@@ -353,8 +501,10 @@ class BinanceExchange(AbstractExchange):
                 """
                 total_made += Decimal(fill["price"]) * Decimal(fill["qty"])
                 total_commission += Decimal(fill["commission"])
+                commissions[fill["commissionAsset"]] = commissions.get(fill["commissionAsset"], Decimal('0')) + Decimal(fill["commission"])
 
             sell_price = total_made / total_qty
+            self.balance_snapshot.sold(market, total_qty, total_made, commissions, locked=False)
 
             return {
                 "order_id": order_id,
@@ -374,13 +524,24 @@ class BinanceExchange(AbstractExchange):
         quantized_qty = quantity.quantize(market_params.lot_step_size)
         bid_price = bid_price.quantize(market_params.price_tick_size)
 
+        if not self.balance_snapshot.can_sell(market, quantized_qty):
+            # Would only come back as insufficient balance; don't spend the request
+            cprint(f"Insufficent balance for {market} LIMIT SELL {quantized_qty}")
+            return None
+
         try:
-            response = self.client.order_limit_sell(
-                symbol=market,
+            response = self._place_order(
+                self.client.order_limit_sell,
+                market,
                 quantity=quantized_qty,
                 price=f"{bid_price:0.8f}",  # Pass as string to ensure input accuracy and format
                 newOrderRespType=Client.ORDER_RESP_TYPE_FULL    # Need the full details to get 'commission' (aka fees).
             )
+        except transport.CircuitOpenError as e:
+            # Never sent, so there's no order to lose track of; try again next run
+            cprint(f"Not placing {market} LIMIT SELL {quantized_qty}: {e}", "red")
+            return None
+
         except Exception as e:
             error_msg = (f"LIMIT SELL ORDER: {market}" +
                          f" | quantized_qty: {quantized_qty}" +
@@ -409,6 +570,7 @@ class BinanceExchange(AbstractExchange):
 
         order_id = response["orderId"]
         timestamp = response["transactTime"] / 1000
+        self.balance_snapshot.lock(market, quantized_qty)
 
         return {
             "order_id": order_id,
@@ -499,7 +661,23 @@ class BinanceExchange(AbstractExchange):
               "side": "SELL"
             }
         """
-        result = self.client.cancel_order(symbol=market, orderId=order_id)
+        try:
+            result = self.client.cancel_order(symbol=market, orderId=order_id)
+        except binance.exceptions.BinanceAPIException as e:
+            # The transport already retried it. A retry whose first attempt did
+            #   cancel comes back as -2011 (Unknown order sent.), as does an order
+            #   that just filled; look up what it became.
+            if e.code != -2011 and not self._outcome_unknown(e):
+                return (False, {"orderId": order_id, "code": e.code, "msg": e.message})
+            result = self._lookup_order(market, orderId=order_id)
+            if not result:
+                return (False, {"orderId": order_id, "code": e.code, "msg": e.message})
+        except requests.exceptions.RequestException as e:
+            # Still unknown; the next reconcile will see what became of it
+            return (False, {"orderId": order_id, "error": str(e)})
+
+        if result['status'] == 'CANCELED':
+            self.balance_snapshot.unlock(market, Decimal(result['origQty']) - Decimal(result['executedQty']))
         return (result['status'] == 'CANCELED', result)
 
 
@@ -523,6 +701,50 @@ class BinanceExchange(AbstractExchange):
             )
 
 
+    def get_fills(self, market, after_trade_id=None):
+        """
+            Pages through the account trade list from `after_trade_id` on (from
+            the first trade if None).
+        """
+        from_id = int(after_trade_id) + 1 if after_trade_id is not None else 0
+        fills = []
+        while True:
+            trades = self.client.get_my_trades(symbol=market, fromId=from_id, limit=1000)
+            """
+                [{
+                    "symbol": "BNBBTC",
+                    "id": 28457,
+                    "orderId": 100234,
+                    "price": "4.00000100",
+                    "qty": "12.00000000",
+                    "quoteQty": "48.000012",
+                    "commission": "10.10000000",
+                    "commissionAsset": "BNB",
+                    "time": 1499865549590,
+                    "isBuyer": true,
+                    "isMaker": false,
+                    "isBestMatch": true
+                }, {...}]
+            """
+            for trade in trades:
+                fills.append({
+                    "trade_id": trade["id"],
+                    "order_id": trade["orderId"],
+                    "side": Fill.SIDE__BUY if trade["isBuyer"] else Fill.SIDE__SELL,
+                    "price": Decimal(trade["price"]),
+                    "quantity": Decimal(trade["qty"]),
+                    "quote_quantity": Decimal(trade["quoteQty"]),
+                    "commission": Decimal(trade["commission"]),
+                    "commission_asset": trade["commissionAsset"],
+                    "timestamp": trade["time"] / 1000,
+                })
+
+            if len(trades) < 1000:
+                return fills
+            from_id = trades[-1]["id"] + 1
+
+
+
     def get_sell_order(self, position):
         try:
             if not position.sell_order_id:
@@ -567,19 +789,19 @@ class BinanceExchange(AbstractExchange):
             price = Decimal(response["stopPrice"]) if Decimal(response["stopPrice"]) != Decimal('0.0') else Decimal(response["price"])
             quantity = Decimal(response["executedQty"])
 
-            # TODO: How to get the 'commission' fees?
-
-            # Calculating unofficial fees for now
-            # fees = self._calculate_fees(price, quantity)
-
             # Sell order is done!
-            return {
+            result = {
                 "status": response["status"],
                 "sell_price": price,
                 "quantity": quantity,
-                # "fees": fees,
                 "timestamp": response["time"] / 1000,
             }
+
+            # Exact fees once its fills have been synced (see trading.sync_fills())
+            fills = Fill.get_order_summaries(self.exchange_name, [position.sell_order_id]).get(position.sell_order_id)
+            if fills:
+                result["fees"] = sum(fills["commissions"].values(), Decimal('0'))
+            return result
         else:
             return {
                 "status": response["status"]
@@ -590,7 +812,7 @@ class BinanceExchange(AbstractExchange):
         """
             Batch update open positions by market.
         """
-        if positions.count() == 0:
+        if len(positions) == 0:
             return []
 
         market_params = MarketParams.get_market(market, exchange=MarketParams.EXCHANGE__BINANCE)
@@ -622,7 +844,14 @@ class BinanceExchange(AbstractExchange):
                 "isWorking": true
             }, {...}, {...}]
         """
-        print(f"{market} orders retrieved: {len(orders)} | positions: {positions.count()}")
+        print(f"{market} orders retrieved: {len(orders)} | positions: {len(positions)}")
+
+        # Synced fills (see trading.sync_fills()) give the exact sold quantity,
+        #   average price and commissions without another call per order.
+        order_ids = [p.sell_order_id for p in positions if p.sell_order_id is not None]
+        order_ids += [p.buy_order_id for p in positions]
+        fills = Fill.get_order_summaries(self.exchange_name, order_ids)
+
         positions_sold = []
         orders_processed = []
         for position in positions:
@@ -645,12 +874,27 @@ class BinanceExchange(AbstractExchange):
                 continue
 
             elif result['status'] == 'FILLED':
-                position.sell_price = Decimal(result['price']).quantize(market_params.price_tick_size)
-                position.sell_quantity = Decimal(result['executedQty']).quantize(market_params.lot_step_size)
+                sell_fills = fills.get(position.sell_order_id)
+                if sell_fills and sell_fills['quantity'] == Decimal(result['executedQty']):
+                    # Every fill is in; the order's own price isn't what it averaged
+                    position.sell_price = sell_fills['price'].quantize(market_params.price_tick_size)
+                    position.sell_quantity = sell_fills['quantity'].quantize(market_params.lot_step_size)
+                else:
+                    position.sell_price = Decimal(result['price']).quantize(market_params.price_tick_size)
+                    position.sell_quantity = Decimal(result['executedQty']).quantize(market_params.lot_step_size)
                 position.sell_timestamp = result['updateTime']/1000
-                position.scalped_quantity = (position.buy_quantity - position.sell_quantity).quantize(market_params.lot_step_size)
+
+                # Commission paid in the bought crypto itself never reached the account
+                buy_fills = fills.get(position.buy_order_id)
+                buy_commission = Decimal('0')
+                if buy_fills:
+                    buy_commission = sum((amount for (asset, amount) in buy_fills['commissions'].items() if market.startswith(asset)), Decimal('0'))
+                position.scalped_quantity = (position.buy_quantity - buy_commission - position.sell_quantity).quantize(market_params.lot_step_size)
                 position.save()
 
+                self.balance_snapshot.sold(market, position.sell_quantity, position.sell_quantity * position.sell_price,
+                                           sell_fills['commissions'] if sell_fills else None)
+
                 positions_sold.append(position)
 
             elif result['status'] == 'CANCELED':
@@ -728,10 +972,12 @@ class BinanceExchange(AbstractExchange):
             if response["status"] == 'FILLED':
                 print(f"ORDER STATUS: FILLED: {response}")
 
-                # TODO: How to get the 'commission' fees?
-
-                # Calculate unofficial fees for now
-                fees = self._calculate_fees(position.purchase_price, position.buy_quantity)
+                fills = Fill.get_order_summaries(self.exchange_name, [position.buy_order_id]).get(position.buy_order_id)
+                if fills:
+                    fees = sum(fills["commissions"].values(), Decimal('0'))
+                else:
+                    # Not synced yet; estimate them
+                    fees = self._calculate_fees(position.purchase_price, position.buy_quantity)
 
                 return {
                     "status": response["status"],
@@ -745,20 +991,58 @@ class BinanceExchange(AbstractExchange):
 
 
     def _calculate_fees(self, price, quantity):
-        fees = price * quantity / self.get_current_price(f"{self.exchange_token}BTC") * Decimal('0.0005')
+        fees = price * quantity / self.get_current_price(f"{self._exchange_token}BTC") * Decimal('0.0005')
         return fees.quantize(Decimal('0.00000001'), rounding=decimal.ROUND_DOWN)
 
 
-    def get_current_price(self, market):
-        return Decimal(self.client.get_ticker(symbol=market)["lastPrice"])
+    def fetch_price_snapshot(self):
+        """
+            Two bulk calls (instead of a ticker or order book per symbol):
+                [{
+                    "symbol": "LTCBTC",
+                    "bidPrice": "4.00000000",
+                    "bidQty": "431.00000000",
+                    "askPrice": "4.00000200",
+                    "askQty": "9.00000000"
+                }, {...}]
+
+                [{
+                    "symbol": "LTCBTC",
+                    "price": "4.00000200"
+                }, {...}]
+        """
+        prices = {}
+        for ticker in self.client.get_orderbook_tickers():
+            prices[ticker["symbol"]] = {
+                "bid": Decimal(ticker["bidPrice"]),
+                "ask": Decimal(ticker["askPrice"]),
+                "last": None,
+            }
+        for ticker in self.client.get_all_tickers():
+            if ticker["symbol"] in prices:
+                prices[ticker["symbol"]]["last"] = Decimal(ticker["price"])
+        return prices
 
 
     def get_current_ask(self, market):
-        return Decimal(self.client.get_order_book(symbol=market).get('asks')[0][0])
+        return self.price_snapshot.ask(market)
 
 
-    def get_market_depth(self, market):
-        return self.client.get_order_book(symbol=market)
+    def get_market_depth(self, market, limit=20):
+        """
+            {
+                "lastUpdateId": 1027024,
+                "bids": [["4.00000000", "431.00000000"], ...],
+                "asks": [["4.00000200", "12.00000000"], ...]
+            }
+        """
+        # Only certain depths are accepted (and weighted accordingly)
+        depth = next((d for d in (5, 10, 20, 50, 100, 500, 1000) if d >= limit), 1000)
+        book = self.client.get_order_book(symbol=market, limit=depth)
+        return {
+            "bids": [(Decimal(price), Decimal(quantity)) for (price, quantity) in book["bids"][:limit]],
+            "asks": [(Decimal(price), Decimal(quantity)) for (price, quantity) in book["asks"][:limit]],
+        }
 
 
     def get_moving_average(self, market, interval, since):
@@ -1,162 +1,731 @@
-import decimal
+import datetime
+import hashlib
+import hmac
 import json
-import random
 import time
+import uuid
 
-from bittrex.bittrex import Bittrex
+from dateutil import parser as dateparser
 from decimal import Decimal
+from peewee import chunked
 from termcolor import cprint
+from urllib.parse import quote, urlencode
 
+from . import transport
 from .constants import EXCHANGE__BITTREX
 from .abstract_exchange import AbstractExchange
+from .price_snapshot import decimal_or_none
 
 from .. import config
 from ..models import Candle, MarketParams, ONE_SATOSHI
+from ..tracing import tracer
+
+
+
+class BittrexAPIError(Exception):
+    def __init__(self, status_code, code):
+        super().__init__(f"Bittrex API error {status_code}: {code}")
+        self.status_code = status_code
+        self.code = code
+
+
+
+class BittrexClient():
+    """
+        Bittrex v3 REST client on the shared, pooled transport. Requests to the
+        account/order endpoints are signed per the v3 spec: HMAC-SHA512 over
+        timestamp + full URI + method + SHA512 of the body.
+    """
+    def __init__(self, api_key, api_secret, api_url=None):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.api_url = (api_url or config.BITTREX_API_URL).rstrip('/')
+        self.session = transport.new_session(EXCHANGE__BITTREX, headers={
+            'Accept': 'application/json',
+        }, api_key=api_key)
+
+
+    def _request(self, method, path, params=None, body=None, signed=False):
+        uri = self.api_url + path
+        if params:
+            params = {k: v for (k, v) in params.items() if v is not None}
+            if params:
+                uri += '?' + urlencode(params)
+
+        content = json.dumps(body) if body is not None else ''
+        headers = {}
+        if body is not None:
+            headers['Content-Type'] = 'application/json'
+
+        if signed:
+            timestamp = str(int(time.time() * 1000))
+            content_hash = hashlib.sha512(content.encode('utf-8')).hexdigest()
+            pre_sign = timestamp + uri + method + content_hash
+            headers.update({
+                'Api-Key': self.api_key,
+                'Api-Timestamp': timestamp,
+                'Api-Content-Hash': content_hash,
+                'Api-Signature': hmac.new(self.api_secret.encode('utf-8'), pre_sign.encode('utf-8'), hashlib.sha512).hexdigest(),
+            })
+
+        response = self.session.request(method, uri, data=content or None, headers=headers)
+        if response.status_code >= 400:
+            try:
+                code = response.json().get('code')
+            except ValueError:
+                code = response.text
+            raise BittrexAPIError(response.status_code, code)
+
+        return response.json() if response.content else None
+
+
+    def get_markets(self):
+        return self._request('GET', '/markets')
+
+
+    def get_tickers(self):
+        return self._request('GET', '/markets/tickers')
+
+
+    def get_recent_candles(self, symbol, interval):
+        return self._request('GET', f"/markets/{quote(symbol)}/candles/{interval}/recent")
+
+
+    def get_historical_candles(self, symbol, interval, year, month=None, day=None):
+        path = f"/markets/{quote(symbol)}/candles/{interval}/historical/{year}"
+        if month:
+            path += f"/{month}"
+            if day:
+                path += f"/{day}"
+        return self._request('GET', path)
+
+
+    def get_orderbook(self, symbol, depth=25):
+        return self._request('GET', f"/markets/{quote(symbol)}/orderbook", params={"depth": depth})
+
+
+    def get_open_orders(self, symbol):
+        return self._request('GET', '/orders/open', params={"marketSymbol": symbol}, signed=True)
+
+
+    def get_closed_orders(self, symbol, start_date=None, next_page_token=None, page_size=200):
+        return self._request('GET', '/orders/closed', params={
+            "marketSymbol": symbol,
+            "startDate": start_date,
+            "nextPageToken": next_page_token,
+            "pageSize": page_size,
+        }, signed=True)
+
+
+    def get_order(self, order_id):
+        return self._request('GET', f"/orders/{order_id}", signed=True)
+
+
+    def place_order(self, **order):
+        return self._request('POST', '/orders', body=order, signed=True)
+
+
+    def cancel_order(self, order_id):
+        return self._request('DELETE', f"/orders/{order_id}", signed=True)
+
+
+    def batch(self, operations):
+        return self._request('POST', '/batch', body=operations, signed=True)
+
+
+    def get_balances(self):
+        return self._request('GET', '/balances', signed=True)
+
+
+
+def parse_timestamp(value):
+    # v3 timestamps are ISO 8601 UTC, e.g. "2021-01-01T00:00:00.12Z"
+    return dateparser.isoparse(value).timestamp()
 
 
 
 class BittrexExchange(AbstractExchange):
     _exchange_name = EXCHANGE__BITTREX
     _exchange_token = None
-    # _intervals = {
-    #     Candle.INTERVAL__1MINUTE: Client.KLINE_INTERVAL_1MINUTE,
-    #     Candle.INTERVAL__5MINUTE: Client.KLINE_INTERVAL_5MINUTE,
-    #     Candle.INTERVAL__15MINUTE: Client.KLINE_INTERVAL_15MINUTE,
-    #     Candle.INTERVAL__1HOUR: Client.KLINE_INTERVAL_1HOUR
-    # }
+    _market_params_exchange = MarketParams.EXCHANGE__BITTREX
+
+    # One month of hourly candles; the most one historical candle call returns
+    _max_candles_per_request = 31 * 24
+
+    # Bittrex doesn't document a cap; keep each batch request modest
+    _max_batch_operations = 20
+
+    # Most closed orders one page can hold
+    _closed_orders_page_size = 200
+
+    _intervals = {
+        Candle.INTERVAL__1MINUTE: 'MINUTE_1',
+        Candle.INTERVAL__5MINUTE: 'MINUTE_5',
+        Candle.INTERVAL__1HOUR: 'HOUR_1',
+    }
+
+    # How far back the 'recent' candles endpoint goes for each interval
+    _recent_seconds = {
+        Candle.INTERVAL__1MINUTE: 24 * 3600,
+        Candle.INTERVAL__5MINUTE: 24 * 3600,
+        Candle.INTERVAL__1HOUR: 31 * 24 * 3600,
+    }
 
 
     def __init__(self, api_key, api_secret, watchlist):
         super().__init__(api_key, api_secret, watchlist)
-        self.client = Bittrex(api_key, api_secret)
+        self.client = tracer.trace_client(BittrexClient(api_key, api_secret), self.exchange_name)
+
+        # All markets' details, fetched once per run
+        self._markets = None
 
 
     def build_market_name(self, crypto, base_currency):
-        # Bittrex uses BTC-HYDRO format
-        return f"{base_currency}-{crypto}"
+        # Bittrex v3 uses HYDRO-BTC format
+        return f"{crypto}-{base_currency}"
+
+
+    def _load_markets(self):
+        """
+            {internal market name: market details} for every market, from one call:
+                [{
+                    "symbol": "LTC-BTC",
+                    "baseCurrencySymbol": "LTC",
+                    "quoteCurrencySymbol": "BTC",
+                    "minTradeSize": "0.01686767",
+                    "precision": 8,
+                    "status": "ONLINE",
+                    "createdAt": "2014-02-13T00:00:00Z",
+                    ...
+                }, {...}]
+        """
+        if self._markets is None:
+            self._markets = {
+                f"{m['baseCurrencySymbol']}{m['quoteCurrencySymbol']}": m
+                for m in self.client.get_markets()
+            }
+        return self._markets
+
+
+    def _symbol(self, market):
+        # Our LTCBTC -> Bittrex's LTC-BTC
+        return self._load_markets()[market]['symbol']
 
 
     def initialize_market(self, crypto, base_currency, recheck=False):
         """
             Make sure we have MarketParams for the given market
         """
-        market = self.build_market_name(crypto, base_currency)
-        params = MarketParams.get_market(market, exchange=MarketParams.EXCHANGE__BITTREX)
-        if not params or recheck:
-            # Have to query the API and get all markets...
-            """
-                 {
-                    "success": true,
-                    "message": "",
-                    "result": [
-                        {
-                            "MarketCurrency": "LTC",
-                            "BaseCurrency": "BTC",
-                            "MarketCurrencyLong": "Litecoin",
-                            "BaseCurrencyLong": "Bitcoin",
-                            "MinTradeSize": 0.01686767,
-                            "MarketName": "BTC-LTC",
-                            "IsActive": true,
-                            "IsRestricted": false,
-                            "Created": "2014-02-13T00:00:00",
-                            "Notice": null,
-                            "IsSponsored": null,
-                            "LogoUrl": "https://bittrexblobstorage.blob.core.windows.net/public/6defbc41-582d-47a6-bb2e-d0fa88663524.png"
-                        },
-                        ...
-                    ]
-                }
+        market = f"{crypto}{base_currency}"
+        params = self.get_market_params(market)
+        if params and not recheck:
+            return
+
+        market_details = self._load_markets().get(market)
+        if not market_details:
+            raise Exception(f"{market} not found on Bittrex")
+
+        min_trade_size = Decimal(market_details["minTradeSize"])
+        price = self.get_current_price(market) or self.get_current_ask(market)
+
+        tick_size = Decimal('1').scaleb(-int(market_details["precision"]))
+        step_size = ONE_SATOSHI
+        min_notional = (min_trade_size * price).quantize(ONE_SATOSHI)
+        multiplier_up = None
+        avg_price_minutes = None
+
+        if params:
+            params.price_tick_size = tick_size
+            params.lot_step_size = step_size
+            params.min_notional = min_notional
+            params.multiplier_up = multiplier_up
+            params.avg_price_minutes = avg_price_minutes
+            params.save()
+
+            print(f"Re-loaded MarketParams for {market}")
+        else:
+            MarketParams.create(
+                exchange=MarketParams.EXCHANGE__BITTREX,
+                market=market,
+                price_tick_size=tick_size,
+                lot_step_size=step_size,
+                min_notional=min_notional,
+                multiplier_up=multiplier_up,
+                avg_price_minutes=avg_price_minutes
+            )
+
+            print(f"Loaded MarketParams for {market}")
+
+
+    def _format_candles(self, candles):
+        """
+            [{
+                "startsAt": "2021-01-01T00:00:00Z",
+                "open": "0.00412000",
+                "high": "0.00414000",
+                "low": "0.00411000",
+                "close": "0.00413000",
+                "volume": "1234.5",
+                "quoteVolume": "5.1"
+            }, {...}]
+        """
+        results = []
+        for candle in candles:
+            results.append({
+                "timestamp": parse_timestamp(candle["startsAt"]),
+                "open": Decimal(candle["open"]),
+                "high": Decimal(candle["high"]),
+                "low": Decimal(candle["low"]),
+                "close": Decimal(candle["close"])
+            })
 
-            """
-            result = self.client.get_markets()
-            if not "success" in result:
-                raise Exception("Couldn't retrieve markets from Bittrex")
+        return results
 
-            market_details = next(x for x in result["result"] if x["MarketCurrency"] == crypto and x["BaseCurrency"] == base_currency)
-            min_trade_size = Decimal(market_details["MinTradeSize"]).quantize(ONE_SATOSHI)
 
-            # Also have to query current market price of the target market
-            """
-                {
-                    "success": true,
-                    "message": "",
-                    "result": {
-                        "Bid": 0.01259751,
-                        "Ask": 0.012607,
-                        "Last": 0.01260665
-                    }
-                }
-            """
-            ticker = self.client.get_ticker(self.build_market_name(crypto, base_currency))
-            if not "success" in result:
-                raise Exception(f"Couldn't retrieve current ticker for {self.build_market_name(crypto, base_currency)} Bittrex")
+    def _closed_candles(self, candles, interval):
+        # Never ingest the most recent (still-open) candle
+        cutoff = time.time() - Candle.INTERVAL_SECONDS[interval]
+        return [c for c in self._format_candles(candles) if c['timestamp'] <= cutoff]
 
-            price = Decimal(ticker["result"]["Last"]).quantize(ONE_SATOSHI)
 
-            # Note: The minimum BTC trade value for orders is 50,000 Satoshis (0.0005)
-            tick_size = ONE_SATOSHI
-            step_size = ONE_SATOSHI
-            min_notional = (min_trade_size * price).quantize(ONE_SATOSHI)   # Varies from about 0.0001 - 0.0002 BTC
-            multiplier_up = None
-            avg_price_minutes = None
+    def ingest_latest_candles(self, market, interval, since=None, limit=5):
+        """
+            One call returns the whole 'recent' window (31 days of hourly
+            candles), so catching up never takes more than a single request.
+        """
+        if limit == 1:
+            # Never ingest the most recent (still-open) candle
+            return
 
-            if params:
-                params.tick_size = tick_size
-                params.step_size = step_size
-                params.min_notional = min_notional
-                params.multiplier_up = multiplier_up
-                params.avg_price_minutes = avg_price_minutes
-                params.save()
-
-                print(f"Re-loaded MarketParams for {market}")
-            else:
-                MarketParams.create(
-                    exchange=MarketParams.EXCHANGE__BITTREX,
-                    market=market,
-                    price_tick_size=tick_size,
-                    lot_step_size=step_size,
-                    min_notional=min_notional,
-                    multiplier_up=multiplier_up,
-                    avg_price_minutes=avg_price_minutes
-                )
+        print(f"{market} candles: {limit} | {since}")
+        candles = self._closed_candles(self.client.get_recent_candles(self._symbol(market), self._intervals[interval]), interval)
+        if since:
+            candles = [c for c in candles if c['timestamp'] > since]
+        else:
+            candles = candles[-limit:]
 
-                print(f"Loaded MarketParams for {market}")
+        Candle.batch_create_candles(market, interval, candles)
 
 
-    def ingest_latest_candles(self, market, interval, since=None, limit=5):
-        # Dead-end here until python library is updated to support Bittrex's v3 API
-        raise Exception("Bittrex v3 API not yet supported")
+    def _historical_periods(self, interval, start, end):
+        """
+            (year, month, day) for each historical candles call covering `start`
+            through `end`: one per month for hourly candles, one per day for the
+            minute intervals.
+        """
+        day = datetime.datetime.utcfromtimestamp(start).date()
+        last_day = datetime.datetime.utcfromtimestamp(end).date()
+        periods = []
+        while day <= last_day:
+            if interval == Candle.INTERVAL__1HOUR:
+                periods.append((day.year, day.month, None))
+                day = (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+            else:
+                periods.append((day.year, day.month, day.day))
+                day += datetime.timedelta(days=1)
+        return periods
 
 
+    def ingest_candle_range(self, market, interval, start, end):
+        """
+            Targeted fetch of the candles from `start` through `end` (unix
+            timestamps); used to fill CandleGaps. Anything inside the 'recent'
+            window comes from that one call, older candles from the historical
+            endpoint one month (or day) at a time.
+        """
+        symbol = self._symbol(market)
+        recent_start = time.time() - self._recent_seconds[interval]
+
+        raw_data = []
+        if start < recent_start:
+            for (year, month, day) in self._historical_periods(interval, start, min(end, recent_start)):
+                try:
+                    raw_data.extend(self.client.get_historical_candles(symbol, self._intervals[interval], year, month, day))
+                except BittrexAPIError as e:
+                    # Periods before the market listed (or not yet closed) aren't there
+                    if e.status_code != 404:
+                        raise
+        if end >= recent_start:
+            raw_data.extend(self.client.get_recent_candles(symbol, self._intervals[interval]))
+
+        candles = [c for c in self._closed_candles(raw_data, interval) if start <= c['timestamp'] <= end]
+        Candle.batch_create_candles(market, interval, candles)
+        return max(c['timestamp'] for c in candles) if candles else None
+
+
+    def fetch_price_snapshot(self):
+        """
+            One call for every market's ticker:
+                [{
+                    "symbol": "LTC-BTC",
+                    "lastTradeRate": "0.01260665",
+                    "bidRate": "0.01259751",
+                    "askRate": "0.01260700"
+                }, {...}]
+        """
+        prices = {}
+        for ticker in self.client.get_tickers():
+            prices[ticker["symbol"].replace('-', '')] = {
+                "bid": decimal_or_none(ticker.get("bidRate")),
+                "ask": decimal_or_none(ticker.get("askRate")),
+                "last": decimal_or_none(ticker.get("lastTradeRate")),
+            }
+        return prices
+
 
     def get_current_ask(self, market):
-        pass
+        return self.price_snapshot.ask(market)
+
+
+    def get_market_depth(self, market, limit=20):
+        """
+            {
+                "bid": [{"quantity": "431.00000000", "rate": "0.00400000"}, ...],
+                "ask": [{"quantity": "12.00000000", "rate": "0.00400020"}, ...]
+            }
+        """
+        # Only 1, 25 or 500 levels are offered
+        depth = next((d for d in (1, 25, 500) if d >= limit), 500)
+        book = self.client.get_orderbook(self._symbol(market), depth=depth)
+        return {
+            "bids": [(Decimal(b["rate"]), Decimal(b["quantity"])) for b in book["bid"][:limit]],
+            "asks": [(Decimal(a["rate"]), Decimal(a["quantity"])) for a in book["ask"][:limit]],
+        }
+
+
+    def _order_request(self, market, direction, order_type, quantity, limit=None):
+        """
+            {
+                "marketSymbol": "LTC-BTC",
+                "direction": "SELL",
+                "type": "LIMIT",
+                "quantity": "1.25000000",
+                "limit": "0.01300000",
+                "timeInForce": "GOOD_TIL_CANCELLED",
+                "clientOrderId": "..."
+            }
+        """
+        order = {
+            "marketSymbol": self._symbol(market),
+            "direction": direction,
+            "type": order_type,
+            "quantity": f"{quantity:f}",
+            "timeInForce": "GOOD_TIL_CANCELLED" if order_type == 'LIMIT' else "IMMEDIATE_OR_CANCEL",
+            "clientOrderId": str(uuid.uuid4()),
+        }
+        if limit is not None:
+            order["limit"] = f"{limit:f}"
+        return order
+
+
+    def _base_currency(self, order):
+        # Commission is always charged in the market's base currency
+        return order["marketSymbol"].split('-')[1]
+
+
+    def _fill_results(self, order):
+        """
+            {
+                "id": "...",
+                "marketSymbol": "LTC-BTC",
+                "direction": "BUY",
+                "type": "MARKET",
+                "quantity": "1.25000000",
+                "fillQuantity": "1.25000000",
+                "commission": "0.00000937",
+                "proceeds": "0.01575000",
+                "status": "CLOSED",
+                "createdAt": "...",
+                "closedAt": "..."
+            }
+        """
+        quantity = Decimal(order["fillQuantity"])
+        return {
+            "order_id": order["id"],
+            "price": Decimal(order["proceeds"]) / quantity,
+            "quantity": quantity,
+            "fees": Decimal(order["commission"]),
+            "timestamp": parse_timestamp(order.get("closedAt") or order["createdAt"])
+        }
+
+
+    def _market_order(self, market, direction, quantity):
+        market_params = self.get_market_params(market)
+        quantized_qty = quantity.quantize(market_params.lot_step_size)
+
+        try:
+            order = self.client.place_order(**self._order_request(market, direction, 'MARKET', quantized_qty))
+        except Exception as e:
+            print(f"-------------- MARKET {direction} EXCEPTION!! --------------" +
+                  f" | {market}" +
+                  f" | quantized_qty: {quantized_qty}"
+                )
+
+            # Throw it back up to bomb us out
+            raise e
+
+        if config.verbose:
+            print(f"MARKET {direction} ORDER: {json.dumps(order, sort_keys=True, indent=4)}")
+
+        if order["status"] != 'CLOSED' or Decimal(order["fillQuantity"]) == Decimal('0'):
+            # TODO: handle unfilled market orders
+            raise Exception(f"Market {direction} order not filled\n{order}")
+
+        results = self._fill_results(order)
+        commissions = {self._base_currency(order): results["fees"]}
+        if direction == 'BUY':
+            self.balance_snapshot.bought(market, results["quantity"], Decimal(order["proceeds"]), commissions)
+        else:
+            self.balance_snapshot.sold(market, results["quantity"], Decimal(order["proceeds"]), commissions, locked=False)
+        return results
 
 
     def buy(self, market, quantity):
-        pass
+        return self._market_order(market, 'BUY', quantity)
 
 
     def market_sell(self, market, quantity):
-        pass
+        return self._market_order(market, 'SELL', quantity)
+
+
+    def _limit_sell_error(self, market, quantity, bid_price, code):
+        """
+            True if a rejected LIMIT SELL should just be skipped rather than
+            bombing out the run.
+        """
+        if code in ('MIN_TRADE_REQUIREMENT_NOT_MET', 'DUST_TRADE_DISALLOWED_MIN_VALUE'):
+            cprint(f"Attempted to set a notional value ({bid_price} * {quantity}) below the {market} minimum", "red")
+            return True
+
+        if code == 'INSUFFICIENT_FUNDS':
+            cprint(f"Insufficent balance for {market} LIMIT SELL {quantity}")
+            return True
+
+        return False
 
 
     def limit_sell(self, market, quantity, bid_price):
-        pass
+        market_params = self.get_market_params(market)
+        quantized_qty = quantity.quantize(market_params.lot_step_size)
+        bid_price = bid_price.quantize(market_params.price_tick_size)
+
+        if not self.balance_snapshot.can_sell(market, quantized_qty):
+            # Would only come back as INSUFFICIENT_FUNDS; don't spend the request
+            self._limit_sell_error(market, quantized_qty, bid_price, 'INSUFFICIENT_FUNDS')
+            return None
+
+        try:
+            order = self.client.place_order(**self._order_request(market, 'SELL', 'LIMIT', quantized_qty, bid_price))
+        except BittrexAPIError as e:
+            if self._limit_sell_error(market, quantized_qty, bid_price, e.code):
+                return None
+
+            cprint(f"LIMIT SELL ORDER: {market} | quantized_qty: {quantized_qty} | bid_price: {bid_price}\n{e}", "red")
+            raise e
+
+        if config.verbose:
+            print(f"LIMIT SELL ORDER: {order}")
+
+        self.balance_snapshot.lock(market, quantized_qty)
+
+        return {
+            "order_id": order["id"],
+            "price": bid_price,
+            "quantity": quantized_qty
+        }
+
+
+    def cancel_order(self, market, order_id):
+        try:
+            result = self.client.cancel_order(order_id)
+        except BittrexAPIError as e:
+            # e.g. ORDER_NOT_OPEN if it already filled
+            return (False, {"id": order_id, "code": e.code})
+        self._canceled(market, result)
+        return (result["status"] == 'CLOSED', result)
+
+
+    def _canceled(self, market, order):
+        if order["status"] == 'CLOSED':
+            self.balance_snapshot.unlock(market, Decimal(order["quantity"]) - Decimal(order["fillQuantity"]))
+
+
+    def replace_limit_sells(self, market, orders):
+        """
+            Cancel + replace LIMIT SELLs through the batch endpoint, several orders
+            per request: one batch of DELETEs, then one of POSTs for just the
+            orders whose cancel went through (or that had nothing to cancel).
+        """
+        market_params = self.get_market_params(market)
+        for batch in chunked(orders, self._max_batch_operations):
+            """
+                One {"status": <HTTP status>, "payload": <order or error>} per
+                operation, in the same order.
+            """
+            to_cancel = [order for order in batch if order['order_id']]
+            responses = iter(self.client.batch([
+                {"resource": "ORDER", "operation": "DELETE", "payload": {"id": order['order_id']}}
+                for order in to_cancel])) if to_cancel else iter([])
+
+            cancels = []
+            for order in batch:
+                canceled = None
+                if order['order_id']:
+                    response = next(responses)
+                    if response["status"] < 300:
+                        self._canceled(market, response["payload"])
+                        canceled = (response["payload"]["status"] == 'CLOSED', response["payload"])
+                    else:
+                        # e.g. ORDER_NOT_OPEN if it already filled
+                        canceled = (False, {"id": order['order_id'], "code": response["payload"].get("code")})
+                cancels.append(canceled)
+
+            # Never replace an order that may still be open or have just filled
+            placements = []
+            for (order, canceled) in zip(batch, cancels):
+                if canceled and not canceled[0]:
+                    placements.append(None)
+                    continue
+                placements.append((order['quantity'].quantize(market_params.lot_step_size),
+                                   order['price'].quantize(market_params.price_tick_size)))
+
+            to_place = [placement for placement in placements if placement]
+            responses = iter(self.client.batch([
+                {"resource": "ORDER", "operation": "POST",
+                 "payload": self._order_request(market, 'SELL', 'LIMIT', quantity, price)}
+                for (quantity, price) in to_place])) if to_place else iter([])
+
+            for (canceled, placement) in zip(cancels, placements):
+                if not placement:
+                    yield (canceled, None)
+                    continue
+
+                (quantity, price) = placement
+                response = next(responses)
+                if response["status"] < 300:
+                    self.balance_snapshot.lock(market, quantity)
+                    yield (canceled, {
+                        "order_id": response["payload"]["id"],
+                        "price": price,
+                        "quantity": quantity
+                    })
+                else:
+                    code = response["payload"].get("code")
+                    if not self._limit_sell_error(market, quantity, price, code):
+                        cprint(f"LIMIT SELL ORDER: {market} | quantized_qty: {quantity} | bid_price: {price} | {code}", "red")
+                    yield (canceled, None)
+
+
+    def fetch_balances(self):
+        """
+            One call for every currency in the account:
+                [{
+                    "currencySymbol": "BTC",
+                    "total": "0.01500000",
+                    "available": "0.01200000",
+                    "updatedAt": "..."
+                }, {...}]
+        """
+        return {
+            b["currencySymbol"]: {
+                "free": Decimal(b["available"]),
+                "locked": Decimal(b["total"]) - Decimal(b["available"])
+            } for b in self.client.get_balances()
+        }
 
 
     def get_current_balance(self, asset):
-        pass
+        return self.balance_snapshot.free(asset)
 
 
     def get_sell_order_status(self, position):
-        pass
+        order = self.client.get_order(position.sell_order_id)
+
+        if order["status"] == 'CLOSED' and Decimal(order["fillQuantity"]) > Decimal('0'):
+            # Sell order is done!
+            results = self._fill_results(order)
+            return {
+                "status": 'FILLED',
+                "sell_price": results["price"],
+                "quantity": results["quantity"],
+                "timestamp": results["timestamp"],
+            }
+        else:
+            return {
+                "status": 'NEW' if order["status"] == 'OPEN' else 'CANCELED'
+            }
+
+
+    def _get_closed_orders(self, symbol, order_ids, since):
+        """
+            Page back through the market's closed orders (newest first) until
+            every one of `order_ids` has turned up.
+        """
+        start_date = datetime.datetime.utcfromtimestamp(since).strftime('%Y-%m-%dT%H:%M:%SZ')
+        found = {}
+        next_page_token = None
+        while True:
+            page = self.client.get_closed_orders(symbol, start_date=start_date, next_page_token=next_page_token, page_size=self._closed_orders_page_size)
+            for order in page:
+                if order["id"] in order_ids:
+                    found[order["id"]] = order
+
+            if len(found) == len(order_ids) or len(page) < self._closed_orders_page_size:
+                return found
+            next_page_token = page[-1]["id"]
 
 
     def update_order_statuses(self, market, positions):
-        pass
+        """
+            Batch update open positions by market: one call for the market's
+            open orders, then just the closed orders needed to account for the
+            rest.
+        """
+        if len(positions) == 0:
+            return []
 
+        market_params = self.get_market_params(market)
+        symbol = self._symbol(market)
 
-    def cancel_order(self, market, order_id):
-        pass
+        open_order_ids = {o["id"] for o in self.client.get_open_orders(symbol)}
+        closed = [p for p in positions if p.sell_order_id is not None and p.sell_order_id not in open_order_ids]
+        print(f"{market} open orders: {len(open_order_ids)} | positions: {len(positions)} | closed: {len(closed)}")
+        if not closed:
+            return []
 
+        orders = self._get_closed_orders(symbol, {p.sell_order_id for p in closed}, since=min(p.timestamp for p in closed))
+
+        positions_sold = []
+        for position in closed:
+            order = orders.get(position.sell_order_id)
+            if not order:
+                cprint(f"orderId {position.sell_order_id} not found for position {position.id}: {market}", "red")
+
+                # Assume the order can be found individually and proceed
+                order = self.client.get_order(position.sell_order_id)
+
+            if order["status"] == 'OPEN':
+                continue
+
+            elif Decimal(order["fillQuantity"]) > Decimal('0'):
+                results = self._fill_results(order)
+                position.sell_price = results["price"].quantize(market_params.price_tick_size)
+                position.sell_quantity = results["quantity"].quantize(market_params.lot_step_size)
+                position.sell_timestamp = results["timestamp"]
+                position.scalped_quantity = (position.buy_quantity - position.sell_quantity).quantize(market_params.lot_step_size)
+                position.save()
+
+                self.balance_snapshot.sold(market, results["quantity"], Decimal(order["proceeds"]),
+                                           {self._base_currency(order): results["fees"]})
+
+                positions_sold.append(position)
+
+            else:
+                # Closed without a fill: canceled, but that never made it into the DB.
+                print(f"CANCELED order not properly updated in DB: {market} {position.id}")
+                position.sell_order_id = None
+                position.sell_price = None
+                position.sell_quantity = None
+                position.save()
+
+        return positions_sold
@@ -1,11 +1,15 @@
-from . import BinanceExchange, BittrexExchange
+from . import BinanceExchange, BittrexExchange, PaperExchange
 from .constants import EXCHANGE__BINANCE, EXCHANGE__BITTREX
 
 
 class ExchangesManager():
 
     @staticmethod
-    def get_exchanges(exchanges):
+    def get_exchanges(exchanges, paper=False):
+        """
+            With `paper` every exchange is wrapped in a PaperExchange: real market
+            data, simulated orders.
+        """
         from ..models import AllTimeWatchlist
         ex = {}
         for exchange in exchanges:
@@ -18,6 +22,9 @@ class ExchangesManager():
             else:
                 raise Exception("Exchange not implemented")
 
+            if paper:
+                ex[exchange['name']] = PaperExchange(ex[exchange['name']])
+
 
             # Also update the exchange's all-time watchlist
             if not AllTimeWatchlist.get_watchlist(exchange=exchange['name']):
@@ -0,0 +1,353 @@
+import decimal
+import time
+
+from decimal import Decimal
+from heapq import heappush, heappop
+from peewee import chunked, fn
+from termcolor import cprint
+
+from .abstract_exchange import AbstractExchange
+from .balance_snapshot import BalanceSnapshot
+
+from .. import config
+from ..models import db, Candle, Market, PaperOrder
+from ..tracing import tracer
+
+
+
+class PaperExchange(AbstractExchange):
+    """
+        Forward-testing stand-in for a real exchange. Market data (candles,
+        prices, MarketParams) still comes from the wrapped exchange's public
+        endpoints, but orders only ever go into the PaperOrder table.
+
+        Market orders fill at the current bid/ask. LIMIT SELLs fill at their
+        price once a candle that opened after they were placed trades at or
+        above it; each open order is only matched against candles it hasn't
+        seen yet, and a whole market's orders are matched in one pass.
+
+        Balances start from PAPER_STARTING_BALANCES and follow the paper
+        orders, so buys the paper account can't cover are skipped.
+
+        Paper positions are regular LongPositions, so run paper mode against its
+        own DB (e.g. as a separate account under host.py).
+    """
+    def __init__(self, exchange):
+        super().__init__(None, None, exchange.watchlist)
+        self.exchange = exchange
+        self._exchange_name = exchange.exchange_name
+        self._max_candles_per_request = exchange._max_candles_per_request
+        self._market_params_exchange = exchange._market_params_exchange
+
+
+    @property
+    def price_snapshot(self):
+        return self.exchange.price_snapshot
+
+
+    def build_market_name(self, crypto, base_currency):
+        return self.exchange.build_market_name(crypto, base_currency)
+
+
+    def initialize_market(self, crypto, base_currency):
+        return self.exchange.initialize_market(crypto, base_currency)
+
+
+    def fetch_price_snapshot(self):
+        return self.exchange.fetch_price_snapshot()
+
+
+    def get_current_ask(self, market):
+        return self.exchange.get_current_ask(market)
+
+
+    def get_market_depth(self, market, limit=20):
+        return self.exchange.get_market_depth(market, limit=limit)
+
+
+    def ingest_latest_candles(self, market, interval, since=None, limit=5):
+        return self.exchange.ingest_latest_candles(market, interval, since=since, limit=limit)
+
+
+    def ingest_candle_range(self, market, interval, start, end):
+        return self.exchange.ingest_candle_range(market, interval, start, end)
+
+
+    def _calculate_fees(self, price, quantity):
+        fees = price * quantity * config.PAPER_FEE_RATE
+        return fees.quantize(Decimal('0.00000001'), rounding=decimal.ROUND_DOWN)
+
+
+    def _fill_market_order(self, market, side, quantity, price):
+        market_params = self.get_market_params(market)
+        quantized_qty = quantity.quantize(market_params.lot_step_size)
+        fees = self._calculate_fees(price, quantized_qty)
+        now = time.time()
+
+        order = PaperOrder.create(
+            exchange=self.exchange_name,
+            market=market,
+            side=side,
+            order_type=PaperOrder.TYPE__MARKET,
+            status=PaperOrder.STATUS__FILLED,
+            quantity=quantized_qty,
+            price=price,
+            fees=fees,
+            timestamp=now,
+            fill_timestamp=now
+        )
+        print(f"PAPER {side} ORDER: {order}")
+
+        if side == PaperOrder.SIDE__BUY:
+            self.balance_snapshot.bought(market, quantized_qty, quantized_qty * price + fees)
+        else:
+            self.balance_snapshot.sold(market, quantized_qty, quantized_qty * price - fees, locked=False)
+
+        return {
+            "order_id": order.id,
+            "price": price,
+            "quantity": quantized_qty,
+            "fees": fees,
+            "timestamp": now
+        }
+
+
+    def buy(self, market, quantity):
+        return self._fill_market_order(market, PaperOrder.SIDE__BUY, quantity, self.get_current_ask(market))
+
+
+    def market_sell(self, market, quantity):
+        return self._fill_market_order(market, PaperOrder.SIDE__SELL, quantity, self.price_snapshot.bid(market))
+
+
+    def limit_sell(self, market, quantity, bid_price):
+        market_params = self.get_market_params(market)
+        quantized_qty = quantity.quantize(market_params.lot_step_size)
+        bid_price = bid_price.quantize(market_params.price_tick_size)
+
+        order = PaperOrder.create(
+            exchange=self.exchange_name,
+            market=market,
+            side=PaperOrder.SIDE__SELL,
+            order_type=PaperOrder.TYPE__LIMIT,
+            status=PaperOrder.STATUS__NEW,
+            quantity=quantized_qty,
+            price=bid_price,
+            timestamp=time.time()
+        )
+        self.balance_snapshot.lock(market, quantized_qty)
+
+        return {
+            "order_id": order.id,
+            "price": bid_price,
+            "quantity": quantized_qty
+        }
+
+
+    def cancel_order(self, market, order_id):
+        order = PaperOrder.get_or_none(PaperOrder.id == order_id)
+        num_canceled = PaperOrder.update(
+                status=PaperOrder.STATUS__CANCELED
+            ).where(
+                PaperOrder.id == order_id,
+                PaperOrder.status == PaperOrder.STATUS__NEW
+            ).execute()
+
+        if num_canceled:
+            self.balance_snapshot.unlock(market, order.quantity)
+        status = PaperOrder.STATUS__CANCELED if num_canceled else "UNKNOWN"
+        return (num_canceled == 1, {"orderId": order_id, "status": status})
+
+
+    def fetch_balances(self):
+        """
+            PAPER_STARTING_BALANCES plus every paper order's effect on them,
+            with the quantity held by open LIMIT SELLs locked. None (so every
+            balance check passes) if no starting balances are configured.
+        """
+        if not config.PAPER_STARTING_BALANCES:
+            return None
+
+        def to_decimal(value):
+            # The SUMs come back as floats (or None: open orders have no fees yet)
+            return Decimal(str(value or 0)).quantize(Decimal('0.00000001'))
+
+        # Replay the orders through a snapshot of the starting balances
+        ledger = BalanceSnapshot(None, None)
+        ledger.balances = {
+            asset: {'free': Decimal(str(amount)), 'locked': Decimal('0')}
+            for (asset, amount) in config.PAPER_STARTING_BALANCES.items()
+        }
+
+        orders = PaperOrder.select(
+                PaperOrder.market,
+                PaperOrder.side,
+                PaperOrder.status,
+                fn.SUM(PaperOrder.quantity),
+                fn.SUM(PaperOrder.quantity * PaperOrder.price),
+                fn.SUM(PaperOrder.fees)
+            ).where(
+                PaperOrder.exchange == self.exchange_name,
+                PaperOrder.status != PaperOrder.STATUS__CANCELED
+            ).group_by(
+                PaperOrder.market, PaperOrder.side, PaperOrder.status
+            ).tuples()
+
+        for (market, side, status, quantity, value, fees) in orders:
+            (quantity, value, fees) = (to_decimal(quantity), to_decimal(value), to_decimal(fees))
+            if status == PaperOrder.STATUS__NEW:
+                ledger.lock(market, quantity)
+            elif side == PaperOrder.SIDE__BUY:
+                ledger.bought(market, quantity, value + fees)
+            else:
+                ledger.sold(market, quantity, value - fees, locked=False)
+
+        return ledger.balances
+
+
+    def get_current_balance(self, asset):
+        return self.balance_snapshot.free(asset)
+
+
+    def match_orders(self, market, interval=None):
+        """
+            Fill the market's open LIMIT SELLs against the candles that closed
+            since they were last checked. Returns the newly FILLED PaperOrders.
+        """
+        interval = interval or config.interval or Candle.INTERVAL__1HOUR
+        step = Candle.INTERVAL_SECONDS[interval]
+
+        def first_candle(order):
+            # Only a candle that opened after the order was placed can fill it
+            if order.checked_through is not None:
+                return order.checked_through + step
+            return int(-(-order.timestamp // step) * step)
+
+        orders = sorted(
+            PaperOrder.get_open_orders(self.exchange_name, market).where(PaperOrder.side == PaperOrder.SIDE__SELL),
+            key=first_candle)
+        if not orders:
+            return []
+
+        candles = Candle.select(
+                Candle.timestamp, Candle.high
+            ).where(
+                Candle.market_id == Market.get_id(market),
+                Candle.interval == interval,
+                Candle.timestamp >= first_candle(orders[0])
+            ).order_by(
+                Candle.timestamp
+            ).tuples()
+
+        # Walk the candles once; each candle fills the cheapest eligible orders
+        #   up to its high.
+        eligible = []
+        next_order = 0
+        filled = []
+        last_timestamp = None
+        for (timestamp, high) in candles:
+            timestamp = int(timestamp)
+            while next_order < len(orders) and first_candle(orders[next_order]) <= timestamp:
+                order = orders[next_order]
+                heappush(eligible, (order.price, order.id, order))
+                next_order += 1
+
+            while eligible and eligible[0][0] <= high:
+                (price, order_id, order) = heappop(eligible)
+                order.status = PaperOrder.STATUS__FILLED
+                order.fill_timestamp = timestamp
+                order.checked_through = timestamp
+                order.fees = self._calculate_fees(order.price, order.quantity)
+                filled.append(order)
+
+            last_timestamp = timestamp
+
+        if last_timestamp is None:
+            return []
+
+        with db.atomic():
+            for order in filled:
+                order.save()
+                self.balance_snapshot.sold(market, order.quantity, order.quantity * order.price - order.fees)
+
+            # Everything still open has now been checked through the last candle
+            PaperOrder.update(
+                    checked_through=last_timestamp
+                ).where(
+                    PaperOrder.exchange == self.exchange_name,
+                    PaperOrder.market == market,
+                    PaperOrder.status == PaperOrder.STATUS__NEW,
+                    (PaperOrder.checked_through.is_null(False)) | (PaperOrder.timestamp <= last_timestamp)
+                ).execute()
+
+        tracer.incr(f"paper_fills.{self.exchange_name}", len(filled))
+        return filled
+
+
+    def get_sell_order_status(self, position):
+        order = PaperOrder.get_or_none(PaperOrder.id == position.sell_order_id)
+        if not order:
+            raise Exception(f"Position {position} has no paper sell order")
+
+        if order.status == PaperOrder.STATUS__FILLED:
+            return {
+                "status": order.status,
+                "sell_price": order.price,
+                "quantity": order.quantity,
+                "timestamp": order.fill_timestamp,
+            }
+        else:
+            return {
+                "status": order.status
+            }
+
+
+    def update_order_statuses(self, market, positions):
+        """
+            Batch update open positions by market, same contract as the real
+            exchanges: returns the positions whose LIMIT SELL filled.
+        """
+        if len(positions) == 0:
+            return []
+
+        self.match_orders(market)
+
+        market_params = self.get_market_params(market)
+        order_ids = [p.sell_order_id for p in positions if p.sell_order_id is not None]
+        orders = {}
+        for ids in chunked(order_ids, 500):
+            orders.update({o.id: o for o in PaperOrder.select().where(PaperOrder.id.in_(ids))})
+
+        print(f"{market} paper orders: {len(orders)} | positions: {len(positions)}")
+        positions_sold = []
+        with db.atomic():
+            for position in positions:
+                if position.sell_order_id is None:
+                    continue
+
+                order = orders.get(position.sell_order_id)
+                if not order:
+                    cprint(f"Paper order {position.sell_order_id} not found for position {position.id}: {market}", "red")
+                    continue
+
+                if order.status == PaperOrder.STATUS__NEW:
+                    # Nothing to do. Still waiting for LIMIT SELL.
+                    continue
+
+                elif order.status == PaperOrder.STATUS__FILLED:
+                    position.sell_price = order.price.quantize(market_params.price_tick_size)
+                    position.sell_quantity = order.quantity.quantize(market_params.lot_step_size)
+                    position.sell_timestamp = order.fill_timestamp
+                    position.scalped_quantity = (position.buy_quantity - position.sell_quantity).quantize(market_params.lot_step_size)
+                    position.save()
+
+                    positions_sold.append(position)
+
+                elif order.status == PaperOrder.STATUS__CANCELED:
+                    print(f"CANCELED order not properly updated in DB: {market} {position.id}")
+                    position.sell_order_id = None
+                    position.sell_price = None
+                    position.sell_quantity = None
+                    position.save()
+
+        return positions_sold
@@ -0,0 +1,64 @@
+import time
+
+from decimal import Decimal
+
+
+
+class PriceSnapshot():
+    """
+        Best bid/ask and last price for every symbol on an exchange, fetched with
+        bulk ticker calls and then served from memory for the rest of the run.
+
+        `fetch` returns {market: {'bid': Decimal, 'ask': Decimal, 'last': Decimal}}.
+        The snapshot is re-fetched once it's older than `max_age` seconds.
+    """
+    def __init__(self, fetch, max_age):
+        self._fetch = fetch
+        self.max_age = max_age
+        self.prices = {}
+        self.fetched_at = None
+
+
+    @property
+    def is_stale(self):
+        return self.fetched_at is None or time.time() - self.fetched_at > self.max_age
+
+
+    def refresh(self):
+        self.prices = self._fetch()
+        self.fetched_at = time.time()
+
+
+    def has(self, market):
+        if self.is_stale:
+            self.refresh()
+        return market in self.prices
+
+
+    def get(self, market):
+        if self.is_stale:
+            self.refresh()
+
+        if market not in self.prices:
+            raise Exception(f"No price data for '{market}'")
+
+        return self.prices[market]
+
+
+    def bid(self, market):
+        return self.get(market)['bid']
+
+
+    def ask(self, market):
+        return self.get(market)['ask']
+
+
+    def last(self, market):
+        return self.get(market)['last']
+
+
+
+def decimal_or_none(value):
+    if value is None:
+        return None
+    return Decimal(str(value))
@@ -0,0 +1,334 @@
+import random
+import socket
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import NewConnectionError
+
+from .. import config
+from ..tracing import tracer
+
+
+"""
+    Shared HTTP transport for the exchange clients.
+
+    Every exchange session is mounted on the same pooled, keep-alive adapter so
+    TCP + TLS connections get reused across calls (and across clients). Each
+    endpoint gets its own timeout and retry policy; order placement is never
+    blindly retried once the request might have reached the exchange. Each
+    endpoint also gets a circuit breaker so a struggling exchange fails fast
+    instead of eating a full round of timeouts on every call.
+"""
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'DELETE'])
+RETRY_STATUSES = frozenset([418, 429, 500, 502, 503, 504])
+
+
+
+class EndpointPolicy():
+    def __init__(self, connect_timeout=3.05, read_timeout=10, retries=2, backoff=0.5, retry_writes=False):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+
+        # Writes (e.g. POST /order) are only retried when the connection failed
+        #   outright, i.e. the request never reached the exchange.
+        self.retry_writes = retry_writes
+
+
+    def backoff_seconds(self, attempt, retry_after=None):
+        if retry_after:
+            return float(retry_after)
+        # Exponential backoff with full jitter
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+
+
+DEFAULT_POLICY = EndpointPolicy()
+
+ENDPOINT_POLICIES = {
+    # Binance
+    '/api/v1/ping': EndpointPolicy(read_timeout=3),
+    '/api/v1/time': EndpointPolicy(read_timeout=3),
+    '/api/v1/klines': EndpointPolicy(read_timeout=20, retries=3),
+    '/api/v1/exchangeInfo': EndpointPolicy(read_timeout=20, retries=3),
+    '/api/v1/depth': EndpointPolicy(read_timeout=5),
+    '/api/v1/ticker/24hr': EndpointPolicy(read_timeout=10),
+    '/api/v3/order': EndpointPolicy(read_timeout=10, retries=2),
+    '/api/v3/allOrders': EndpointPolicy(read_timeout=20, retries=3),
+    '/api/v3/account': EndpointPolicy(read_timeout=10, retries=2),
+    '/api/v3/myTrades': EndpointPolicy(read_timeout=20, retries=3),
+
+    # Bittrex v3; per-market candle and order paths get the default policy
+    '/v3/markets': EndpointPolicy(read_timeout=20, retries=3),
+    '/v3/markets/tickers': EndpointPolicy(read_timeout=10),
+    '/v3/orders/open': EndpointPolicy(read_timeout=10, retries=2),
+    '/v3/orders/closed': EndpointPolicy(read_timeout=20, retries=3),
+    '/v3/orders': EndpointPolicy(read_timeout=10, retries=2),
+    '/v3/batch': EndpointPolicy(read_timeout=20, retries=2),
+    '/v3/balances': EndpointPolicy(read_timeout=10, retries=2),
+}
+
+
+
+class RateLimiter():
+    """
+        Token bucket: `rate` requests per second, with bursts of up to `burst`.
+        Shared by every session using the same API key so several portfolios
+        (or threads) on one account can't blow through its limits together.
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            wait = 0
+            if self.tokens < 1:
+                wait = (1 - self.tokens) / self.rate
+            self.tokens -= 1
+
+        if wait:
+            tracer.incr("rate_limit_sleep_seconds", wait)
+            time.sleep(wait)
+        return wait
+
+
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+
+def get_rate_limiter(exchange_name, api_key):
+    """
+        The RateLimiter for this exchange + API key (None if it isn't limited).
+    """
+    if exchange_name not in config.RATE_LIMITS:
+        return None
+
+    with _rate_limiters_lock:
+        key = (exchange_name, api_key)
+        if key not in _rate_limiters:
+            (rate, burst) = config.RATE_LIMITS[exchange_name]
+            _rate_limiters[key] = RateLimiter(rate, burst)
+        return _rate_limiters[key]
+
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """
+        Raised instead of sending a request to an endpoint whose circuit is open.
+    """
+    pass
+
+
+
+class CircuitBreaker():
+    """
+        Opens after `threshold` consecutive failed requests to an endpoint;
+        while open, requests fail fast with CircuitOpenError. After `cooldown`
+        seconds one trial request is let through: it closes the circuit if it
+        succeeds, otherwise the circuit stays open for another cooldown.
+    """
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half-open: this is the trial; everyone else waits out another cooldown
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+
+    def record(self, success):
+        with self.lock:
+            if success:
+                self.failures = 0
+                self.opened_at = None
+            else:
+                self.failures += 1
+                if self.failures >= self.threshold:
+                    self.opened_at = time.monotonic()
+
+
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+
+def get_circuit_breaker(exchange_name, path):
+    """
+        The CircuitBreaker for this exchange's endpoint, shared by every session
+        in the process.
+    """
+    with _circuit_breakers_lock:
+        key = (exchange_name, path)
+        if key not in _circuit_breakers:
+            _circuit_breakers[key] = CircuitBreaker(config.CIRCUIT_BREAKER_THRESHOLD, config.CIRCUIT_BREAKER_COOLDOWN)
+        return _circuit_breakers[key]
+
+
+
+def never_sent(e):
+    """
+        True if the request failed before it could have reached the exchange.
+    """
+    if isinstance(e, (requests.exceptions.ConnectTimeout, CircuitOpenError)):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+        HTTPAdapter that turns on TCP keepalive probes so idle pooled connections
+        aren't silently dropped by NAT/load balancers between calls.
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        socket_options = list(HTTPConnection.default_socket_options)
+        socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 60))
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 20))
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3))
+        kwargs['socket_options'] = socket_options
+        return super().init_poolmanager(*args, **kwargs)
+
+
+
+_adapter = None
+
+
+
+def get_adapter():
+    """
+        The one adapter (and so the one set of connection pools) shared by every
+        exchange session in this process.
+    """
+    global _adapter
+    if _adapter is None:
+        _adapter = KeepAliveAdapter(
+            pool_connections=config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE,
+            pool_block=True,    # Wait for a free connection rather than opening throwaway ones
+            max_retries=0       # Retries are handled per-endpoint by ExchangeSession
+        )
+    return _adapter
+
+
+
+class ExchangeSession(requests.Session):
+    """
+        requests.Session that applies per-endpoint timeouts and retries and
+        reports responses to the run tracer.
+    """
+    def __init__(self, exchange_name, policies=None, rate_limiter=None):
+        super().__init__()
+        self.exchange_name = exchange_name
+        self.policies = policies if policies is not None else ENDPOINT_POLICIES
+        self.rate_limiter = rate_limiter
+        self.mount('https://', get_adapter())
+        self.mount('http://', get_adapter())
+        self.hooks['response'].append(
+            lambda response, *args, **kwargs: tracer.record_response(exchange_name, response))
+
+
+    def policy_for(self, url):
+        return self.policies.get(urlparse(url).path, DEFAULT_POLICY)
+
+
+    def circuit_breaker_for(self, url):
+        # Only the endpoints with a policy get one; per-market/per-order paths
+        #   (e.g. Bittrex candles) would each need their own.
+        path = urlparse(url).path
+        if path not in self.policies:
+            return None
+        return get_circuit_breaker(self.exchange_name, path)
+
+
+    def request(self, method, url, *args, **kwargs):
+        policy = self.policy_for(url)
+        breaker = self.circuit_breaker_for(url)
+
+        # Client libraries hard-code their own timeouts; ours win.
+        kwargs['timeout'] = policy.timeout
+
+        idempotent = method.upper() in IDEMPOTENT_METHODS or policy.retry_writes
+        attempt = 0
+        while True:
+            if breaker and not breaker.allow():
+                tracer.incr(f"circuit_open.{self.exchange_name}")
+                raise CircuitOpenError(f"{urlparse(url).path} has failed {breaker.failures} times in a row; not sending")
+
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if breaker:
+                    breaker.record(False)
+                # Connect failures never reached the exchange so are always safe to
+                #   retry; anything else is only safe for idempotent calls.
+                if attempt >= policy.retries or not (idempotent or never_sent(e)):
+                    raise
+                self._wait(url, policy, attempt, reason=type(e).__name__)
+                attempt += 1
+                continue
+
+            if breaker:
+                breaker.record(response.status_code not in RETRY_STATUSES)
+
+            if response.status_code in RETRY_STATUSES and idempotent and attempt < policy.retries:
+                self._wait(url, policy, attempt, reason=str(response.status_code),
+                           retry_after=response.headers.get('Retry-After'))
+                response.close()
+                attempt += 1
+                continue
+
+            return response
+
+
+    def _wait(self, url, policy, attempt, reason, retry_after=None):
+        seconds = policy.backoff_seconds(attempt, retry_after)
+        print(f"Retrying {urlparse(url).path} in {seconds:0.2f}s ({reason})")
+        tracer.incr(f"retries.{self.exchange_name}")
+        time.sleep(seconds)
+
+
+
+def new_session(exchange_name, headers=None, api_key=None):
+    session = ExchangeSession(exchange_name, rate_limiter=get_rate_limiter(exchange_name, api_key))
+    if headers:
+        session.headers.update(headers)
+    return session
+
@@ -0,0 +1,244 @@
+import csv
+import datetime
+import json
+import os
+
+from decimal import Decimal
+from peewee import fn
+
+from .models import Candle, Market, PositionHistory, PortfolioSnapshot, MetricsHistory, Fill, ExportWatermark
+
+
+"""
+    Streams tables out of the DB for analysis: CSV, JSON Lines or Parquet.
+
+    Rows are read with a cursor (no result caching) and written as they arrive,
+    Parquet in fixed-size row groups, so memory stays flat no matter how much
+    history there is. Each (table, destination) pair keeps a watermark, or one
+    per market for tables exported market by market; later exports only pick
+    up rows past it unless `full` is set.
+"""
+FORMATS = ('csv', 'jsonl', 'parquet')
+PARQUET_ROW_GROUP_SIZE = 50000
+
+
+
+class ExportTable():
+    def __init__(self, name, model, columns, watermark, fields=None, join=None, per_market=False):
+        self.name = name
+        self.model = model
+        self.columns = columns
+
+        # Expression whose value only grows as rows are added or changed
+        #   (within each market, if `per_market`)
+        self.watermark = watermark
+        self.per_market = per_market
+
+        # Column expressions, if they aren't all plain fields of `model`, and
+        #   the (model, on) they need joined in
+        self.fields = fields or {}
+        self.join = join
+
+
+    def field(self, column):
+        return self.fields.get(column) or getattr(self.model, column)
+
+
+    def markets(self):
+        return [m.name for m in Market.select(Market.name).order_by(Market.name)]
+
+
+    def query(self, since=None, market=None):
+        query = self.model.select(*[self.field(c) for c in self.columns], self.watermark)
+        if self.join:
+            query = query.join(self.join[0], on=self.join[1])
+        if since is not None:
+            query = query.where(self.watermark > since)
+        if market:
+            query = query.where(self.field('market') == market)
+        return query.order_by(self.watermark)
+
+
+
+TABLES = {
+    # Candles are exported by timestamp, market by market. A market added to
+    #   the watchlist later backfills candles older than the others', and an
+    #   export can run mid-ingest with only some markets' latest candle in, so
+    #   one watermark across every market would skip both. Older candles filled
+    #   in later by gap repair still need a `full` export to be picked up.
+    'candles': ExportTable(
+        'candles', Candle,
+        ['market', 'interval', 'timestamp', 'open', 'high', 'low', 'close'],
+        Candle.timestamp,
+        fields={'market': Market.name},
+        join=(Market, Candle.market_id == Market.id),
+        per_market=True),
+
+    # A position is re-exported when it sells, so incremental files carry the
+    #   latest state of every position bought or sold since the last export.
+    'positions': ExportTable(
+        'positions', PositionHistory,
+        ['id', 'exchange', 'market', 'buy_order_id', 'buy_quantity', 'purchase_price', 'fees',
+         'timestamp', 'watchlist', 'sell_order_id', 'sell_quantity', 'sell_price',
+         'sell_timestamp', 'scalped_quantity'],
+        fn.MAX(PositionHistory.timestamp, fn.COALESCE(PositionHistory.sell_timestamp, 0))),
+
+    'snapshots': ExportTable(
+        'snapshots', PortfolioSnapshot,
+        ['base_currency', 'timestamp', 'num_open_positions', 'open_spent', 'open_value',
+         'scalped_value', 'spent', 'recouped', 'holdings'],
+        PortfolioSnapshot.timestamp),
+
+    # Exported by run; the lottery columns are filled in later in the same run
+    'metrics': ExportTable(
+        'metrics', MetricsHistory,
+        ['run_timestamp', 'exchange', 'market', 'timestamp', 'close', 'ma_period', 'ma',
+         'price_to_ma', 'ma_reliable', 'entries', 'weight', 'selected'],
+        MetricsHistory.run_timestamp),
+
+    # By id: a market's first sync can insert fills older than ones already exported
+    'fills': ExportTable(
+        'fills', Fill,
+        ['exchange', 'market', 'trade_id', 'order_id', 'position_id', 'side', 'price', 'quantity',
+         'quote_quantity', 'commission', 'commission_asset', 'timestamp'],
+        Fill.id),
+}
+
+
+
+def _jsonable(value):
+    if isinstance(value, Decimal):
+        return str(value)   # Keep full precision
+    return value
+
+
+
+class CsvWriter():
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+
+class JsonLinesWriter():
+    def __init__(self, path, columns):
+        self.file = open(path, 'w')
+        self.columns = columns
+
+    def write(self, row):
+        self.file.write(json.dumps({c: _jsonable(v) for (c, v) in zip(self.columns, row)}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+
+class ParquetWriter():
+    """
+        Buffers PARQUET_ROW_GROUP_SIZE rows at a time. Decimals become float64 so
+        the columns are directly usable by pandas/Arrow tooling.
+    """
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise Exception("Parquet export requires pyarrow (pip install pyarrow)")
+
+        self.pyarrow = pyarrow
+        self.path = path
+        self.columns = columns
+        self.rows = []
+        self.writer = None
+
+    def write(self, row):
+        self.rows.append([float(v) if isinstance(v, Decimal) else v for v in row])
+        if len(self.rows) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self.rows:
+            return
+        table = self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(list(column)) for column in zip(*self.rows)],
+            names=self.columns)
+        if not self.writer:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self._flush()
+        if self.writer:
+            self.writer.close()
+
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'jsonl': JsonLinesWriter,
+    'parquet': ParquetWriter,
+}
+
+
+
+def export_table(name, destination, format='csv', full=False, market=None):
+    """
+        Export `name` (see TABLES) rows past the last watermark into a new file
+        in the `destination` dir. Returns (path, num_rows); path is None if
+        there was nothing new.
+    """
+    if format not in FORMATS:
+        raise Exception(f"Unsupported export format '{format}'")
+
+    table = TABLES[name]
+    destination = os.path.abspath(destination)
+    os.makedirs(destination, exist_ok=True)
+
+    # A market-filtered export is a one-off; don't move the table's watermarks
+    use_watermark = not market
+    since = {} if full or not use_watermark else ExportWatermark.get_watermarks(name, destination)
+
+    # Watermarks are keyed by market for per-market tables, '' otherwise
+    if table.per_market:
+        markets = [market] if market else table.markets()
+    else:
+        markets = [market]
+
+    exported_at = datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    path = os.path.join(destination, f"{name}-{exported_at}.{format}")
+    tmp_path = path + ".tmp"
+
+    num_rows = 0
+    watermarks = {}
+    counts = {}
+    writer = WRITERS[format](tmp_path, table.columns)
+    try:
+        for m in markets:
+            key = m if table.per_market else ''
+            for row in table.query(since=since.get(key), market=m).tuples().iterator():
+                writer.write(row[:-1])
+                watermarks[key] = row[-1]
+                counts[key] = counts.get(key, 0) + 1
+                num_rows += 1
+    finally:
+        writer.close()
+
+    if num_rows == 0:
+        os.remove(tmp_path)
+        return (None, 0)
+
+    # Only publish the file, then advance the watermarks, once it's complete
+    os.replace(tmp_path, path)
+    if use_watermark:
+        for (key, watermark) in watermarks.items():
+            ExportWatermark.set_watermark(name, destination, float(watermark), counts[key], market=key)
+
+    return (path, num_rows)
@@ -1,5 +1,7 @@
 import datetime
 import decimal
+import hashlib
+import json
 import pytz
 import time
 
@@ -10,9 +12,10 @@ from termcolor import cprint
 from peewee import (fn, SqliteDatabase, Model, CharField, SmallIntegerField,
                     TimestampField, FloatField, CompositeKey, TextField,
                     BooleanField, DateTimeField, SQL, DecimalField, IntegerField,
-                    Window)
+                    Window, Field, chunked)
 
 from . import config
+from .tracing import tracer
 
 import sqlite3
 from io import StringIO
@@ -33,13 +36,71 @@ def init_sqlite_db(mem_db):
     mem_db.row_factory = sqlite3.Row
     print("imported DB to memory")
 
+class TracedSqliteDatabase(SqliteDatabase):
+    """
+        Counts queries and the time spent executing them for the run tracer.
+    """
+    def execute_sql(self, sql, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, *args, **kwargs)
+        finally:
+            tracer.incr("sqlite_queries")
+            tracer.incr("sqlite_seconds", time.perf_counter() - start)
+
+
+def connection_params(db_file, read_only=False):
+    """
+        (database, kwargs) for opening `db_file` with the configured pragmas.
+        Read-only connections can't change the journal mode; they just use
+        whatever mode the writer set.
+    """
+    pragmas = dict(config.SQLITE_PRAGMAS)
+    timeout = pragmas.get('busy_timeout', 5000) / 1000.0
+    if read_only and db_file != ':memory:':
+        pragmas.pop('journal_mode', None)
+        return (f"file:{db_file}?mode=ro", {"pragmas": pragmas, "timeout": timeout, "uri": True})
+    return (db_file, {"pragmas": pragmas, "timeout": timeout})
+
+
+def configure_db(read_only=None):
+    """
+        (Re)open the DBs with the current config: pragmas, read-only mode and
+        file locations.
+    """
+    if read_only is not None:
+        config.SQLITE_READ_ONLY = read_only
+
+    databases = [(db, config.SQLITE_DB_FILE)]
+    if market_db is not db:
+        databases.append((market_db, config.MARKET_DATA_DB_FILE))
+
+    for (database, db_file) in databases:
+        if not database.is_closed():
+            database.close()
+        (name, kwargs) = connection_params(db_file, config.SQLITE_READ_ONLY)
+        database.init(name, **kwargs)
+
+    # The market data may be in a different file now
+    Market.clear_cache()
+
+
 # Load into memory?
 if 0 == 1:
-    db = SqliteDatabase(':memory:')
+    db = TracedSqliteDatabase(':memory:')
     init_sqlite_db(db)
 
 else:
-    db = SqliteDatabase(config.SQLITE_DB_FILE)
+    (name, kwargs) = connection_params(config.SQLITE_DB_FILE, config.SQLITE_READ_ONLY)
+    db = TracedSqliteDatabase(name, **kwargs)
+
+# Market data (candles, MarketParams) can live in a store shared by several
+#   portfolios' DBs; see host.py
+if config.MARKET_DATA_DB_FILE and config.MARKET_DATA_DB_FILE != config.SQLITE_DB_FILE:
+    (name, kwargs) = connection_params(config.MARKET_DATA_DB_FILE, config.SQLITE_READ_ONLY)
+    market_db = TracedSqliteDatabase(name, **kwargs)
+else:
+    market_db = db
 
 
 
@@ -53,7 +114,67 @@ class BaseModel(Model):
 
 
 
-class Candle(BaseModel):
+class MarketDataModel(BaseModel):
+    class Meta:
+        database = market_db
+
+
+
+class Market(MarketDataModel):
+    """
+        Interned market names. Candles refer to their market by this integer
+        id instead of repeating the name in every row and in the primary key.
+    """
+    name = CharField(unique=True)       # e.g. EOSBTC
+
+    # Ids never change once assigned, so cache them for the life of the process
+    _ids = {}
+    _names = {}
+
+
+    def __str__(self):
+        return self.name
+
+
+    @staticmethod
+    def get_id(name, create=False):
+        """
+            `name`'s id; None if it has no candles yet unless `create` is set.
+        """
+        market_id = Market._ids.get(name)
+        if market_id is not None:
+            return market_id
+
+        market = Market.get_or_none(Market.name == name)
+        if not market:
+            if not create:
+                return None
+            Market.insert(name=name).on_conflict_ignore().execute()
+            market = Market.get(Market.name == name)
+
+        Market._ids[name] = market.id
+        Market._names[market.id] = name
+        return market.id
+
+
+    @staticmethod
+    def get_name(market_id):
+        name = Market._names.get(market_id)
+        if name is None:
+            name = Market.get_by_id(market_id).name
+            Market._ids[name] = market_id
+            Market._names[market_id] = name
+        return name
+
+
+    @staticmethod
+    def clear_cache():
+        Market._ids.clear()
+        Market._names.clear()
+
+
+
+class Candle(MarketDataModel):
     INTERVAL__1MINUTE = 1
     INTERVAL__5MINUTE = 2
     INTERVAL__15MINUTE = 3
@@ -68,11 +189,19 @@ class Candle(BaseModel):
         (INTERVAL__4HOUR, "4 hours"),
         (INTERVAL__1DAY, "1 day")
     ]
+    INTERVAL_SECONDS = {
+        INTERVAL__1MINUTE: 60,
+        INTERVAL__5MINUTE: 5 * 60,
+        INTERVAL__15MINUTE: 15 * 60,
+        INTERVAL__1HOUR: 60 * 60,
+        INTERVAL__4HOUR: 4 * 60 * 60,
+        INTERVAL__1DAY: 24 * 60 * 60,
+    }
 
     # Unique together CompositeKey fields
-    market = CharField()    # e.g. EOSBTC
+    market_id = IntegerField()          # Market.id
     interval = SmallIntegerField(choices=_intervals)
-    timestamp = DateTimeField()
+    timestamp = IntegerField()          # Unix timestamp of the candle's open
 
     open = DecimalField()
     high = DecimalField()
@@ -83,14 +212,21 @@ class Candle(BaseModel):
     rsi_1min = DecimalField(null=True)
 
     class Meta:
-        # Enforce 'unique together' constraint
-        primary_key = CompositeKey('market', 'interval', 'timestamp')
+        # Enforce 'unique together' constraint. WITHOUT ROWID clusters the rows
+        #   by this key, so a market's candles sit together in timestamp order.
+        primary_key = CompositeKey('market_id', 'interval', 'timestamp')
+        without_rowid = True
 
 
     def __str__(self):
         return f"{self.market} {self.interval} {self.timestamp}"
 
 
+    @property
+    def market(self):
+        return Market.get_name(self.market_id)
+
+
     @property
     def timestamp_utc(self):
         return time.ctime(self.timestamp)
@@ -100,7 +236,7 @@ class Candle(BaseModel):
     def get_last_candles(market, interval, n):
         c = Candle.select(
             ).where(
-                Candle.market == market,
+                Candle.market_id == Market.get_id(market),
                 Candle.interval == interval
             ).order_by(Candle.timestamp.desc()
             ).limit(n)
@@ -121,23 +257,85 @@ class Candle(BaseModel):
 
     @staticmethod
     def batch_create_candles(market, interval, candle_data):
-        for d in candle_data:
-            Candle.create(
-                market=market,
-                interval=interval,
-                timestamp=d['timestamp'],
-                open=d['open'],
-                high=d['high'],
-                low=d['low'],
-                close=d['close'],
-            )
+        market_id = Market.get_id(market, create=True)
+        rows = [{
+                "market_id": market_id,
+                "interval": interval,
+                "timestamp": int(d['timestamp']),
+                "open": d['open'],
+                "high": d['high'],
+                "low": d['low'],
+                "close": d['close'],
+            } for d in candle_data]
+
+        # Gap repairs can overlap candles we already have; keep the existing rows
+        with market_db.atomic():
+            for batch in chunked(rows, 100):
+                Candle.insert_many(batch).on_conflict_ignore().execute()
+
+
+    @staticmethod
+    def find_gaps(market, interval):
+        """
+            Full scan of a market's stored candles for holes. Returns a list of
+            (first_missing, last_missing) timestamps.
+        """
+        step = Candle.INTERVAL_SECONDS[interval]
+        timestamps = Candle.select(
+                Candle.timestamp
+            ).where(
+                Candle.market_id == Market.get_id(market),
+                Candle.interval == interval
+            ).order_by(
+                Candle.timestamp
+            ).tuples().iterator()
+
+        gaps = []
+        previous = None
+        for (timestamp, ) in timestamps:
+            timestamp = int(timestamp)
+            if previous is not None and timestamp - previous > step:
+                gaps.append((previous + step, timestamp - step))
+            previous = timestamp
+        return gaps
+
+
+    @staticmethod
+    def missing_ranges(market, interval, start, end):
+        """
+            Contiguous runs of missing candles between `start` and `end` (inclusive).
+        """
+        step = Candle.INTERVAL_SECONDS[interval]
+        start = int(start)
+        end = int(end)
+        existing = {int(t) for (t, ) in Candle.select(
+                Candle.timestamp
+            ).where(
+                Candle.market_id == Market.get_id(market),
+                Candle.interval == interval,
+                Candle.timestamp >= start,
+                Candle.timestamp <= end
+            ).tuples()}
+
+        ranges = []
+        run_start = None
+        for timestamp in range(start, end + step, step):
+            if timestamp not in existing:
+                if run_start is None:
+                    run_start = timestamp
+            elif run_start is not None:
+                ranges.append((run_start, timestamp - step))
+                run_start = None
+        if run_start is not None:
+            ranges.append((run_start, end))
+        return ranges
 
 
     @staticmethod
     def get_historical_candles(market, interval, historical_timestamp, n):
         c = Candle.select(
             ).where(
-                Candle.market == market,
+                Candle.market_id == Market.get_id(market),
                 Candle.interval == interval,
                 Candle.timestamp <= historical_timestamp
             ).order_by(Candle.timestamp.desc()
@@ -148,11 +346,43 @@ class Candle(BaseModel):
         return c
 
 
+    @staticmethod
+    def get_close(market, interval=None, until=None):
+        """
+            The latest close (at or before `until`), or None if there isn't one.
+        """
+        query = Candle.select(Candle.close).where(Candle.market_id == Market.get_id(market))
+        if interval is not None:
+            query = query.where(Candle.interval == interval)
+        if until is not None:
+            query = query.where(Candle.timestamp <= until)
+        return query.order_by(Candle.timestamp.desc()).limit(1).scalar()
+
+
+    @staticmethod
+    def get_rows(market, interval, since=None, until=None):
+        """
+            Streams a market's (timestamp, open, high, low, close) namedtuples
+            in timestamp order, for back-tests and other long scans.
+        """
+        query = Candle.select(
+                Candle.timestamp, Candle.open, Candle.high, Candle.low, Candle.close
+            ).where(
+                Candle.market_id == Market.get_id(market),
+                Candle.interval == interval
+            )
+        if since is not None:
+            query = query.where(Candle.timestamp >= since)
+        if until is not None:
+            query = query.where(Candle.timestamp <= until)
+        return query.order_by(Candle.timestamp).namedtuples().iterator()
+
+
     @staticmethod
     def get_historical_candle(market, interval, historical_timestamp):
         c = Candle.select(
             ).where(
-                Candle.market == market,
+                Candle.market_id == Market.get_id(market),
                 Candle.interval == interval,
                 Candle.timestamp == historical_timestamp
             )
@@ -178,8 +408,35 @@ class Candle(BaseModel):
         return int(abs(int(cur_timestamp - self.timestamp)) / timestamp_multiplier)
 
 
+    def is_ma_reliable(self, periods):
+        """
+            calculate_moving_average() just averages the last `periods` rows. That's
+            only valid if those rows are continuous, aside from any holes the
+            exchange itself has no data for (see CandleGap.unfillable).
+        """
+        step = Candle.INTERVAL_SECONDS[self.interval]
+        timestamps = [int(t) for (t, ) in Candle.select(
+                Candle.timestamp
+            ).where(
+                Candle.market_id == self.market_id,
+                Candle.interval == self.interval,
+                Candle.timestamp <= self.timestamp
+            ).order_by(
+                Candle.timestamp.desc()
+            ).limit(periods).tuples()]
+
+        if len(timestamps) < periods:
+            return False
+
+        num_missing = int((timestamps[0] - timestamps[-1]) / step) + 1 - periods
+        if num_missing == 0:
+            return True
+
+        return num_missing <= CandleGap.num_unfillable(self.market, self.interval, timestamps[-1], timestamps[0])
+
+
     def calculate_moving_average(self, periods):
-        # Assumes we have continuous data for the full 'periods' range
+        # Assumes we have continuous data for the full 'periods' range; check with is_ma_reliable()
         # ma = Candle.select(
         #         fn.AVG(Candle.close).over(
         #             order_by=[Candle.timestamp],
@@ -191,29 +448,169 @@ class Candle(BaseModel):
         #         Candle.interval == self.interval,
         #         Candle.timestamp <= self.timestamp
         #     ).scalar()
-        ma = Decimal('0.0')
-        candles = Candle.select(
+        closes = Candle.select(
+                Candle.close
             ).where(
-                Candle.market == self.market,
+                Candle.market_id == self.market_id,
                 Candle.interval == self.interval,
                 Candle.timestamp <= self.timestamp
             ).limit(periods).order_by(Candle.timestamp.desc())
-        for candle in candles:
-            ma += candle.close
+        ma = sum((close for (close, ) in closes.tuples().iterator()), Decimal('0.0'))
         return ma / Decimal(periods)
 
 
 
+class CandleGap(MarketDataModel):
+    """
+        Index of known holes in a market's stored candles, so they can be
+        re-fetched in targeted batches instead of re-downloading everything.
+    """
+    market = CharField()
+    interval = SmallIntegerField(choices=Candle._intervals)
+    start_timestamp = IntegerField()        # First missing candle
+    end_timestamp = IntegerField()          # Last missing candle
+    attempts = SmallIntegerField(default=0)
+
+    # The exchange itself has no data for this range (e.g. maintenance downtime)
+    unfillable = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('market', 'interval', 'start_timestamp'), True),
+        )
+
+
+    def __str__(self):
+        return f"{self.market} {self.interval} {self.start_timestamp}-{self.end_timestamp}"
+
+
+    @property
+    def num_candles(self):
+        return int((self.end_timestamp - self.start_timestamp) / Candle.INTERVAL_SECONDS[self.interval]) + 1
+
+
+    @staticmethod
+    def get_open_gaps(market, interval):
+        return CandleGap.select(
+            ).where(
+                CandleGap.market == market,
+                CandleGap.interval == interval,
+                CandleGap.unfillable == False
+            ).order_by(
+                CandleGap.start_timestamp.desc()     # Most recent first; they matter most for the MAs
+            )
+
+
+    @staticmethod
+    def num_unfillable(market, interval, start, end):
+        """
+            How many candles between `start` and `end` are known to be missing on
+            the exchange itself.
+        """
+        step = Candle.INTERVAL_SECONDS[interval]
+        num_missing = 0
+        for gap in CandleGap.select().where(
+                CandleGap.market == market,
+                CandleGap.interval == interval,
+                CandleGap.unfillable == True,
+                CandleGap.start_timestamp <= end,
+                CandleGap.end_timestamp >= start):
+            num_missing += int((min(gap.end_timestamp, end) - max(gap.start_timestamp, start)) / step) + 1
+        return num_missing
+
+
+    @staticmethod
+    def record(market, interval, ranges, attempts=0, unfillable=False):
+        for (start, end) in ranges:
+            CandleGap.insert(
+                market=market,
+                interval=interval,
+                start_timestamp=int(start),
+                end_timestamp=int(end),
+                attempts=attempts,
+                unfillable=unfillable
+            ).on_conflict_replace().execute()
+
+
+    @staticmethod
+    def index_range(market, interval, start, end):
+        """
+            Record any holes between `start` and `end` (inclusive).
+        """
+        ranges = Candle.missing_ranges(market, interval, start, end)
+        CandleGap.record(market, interval, ranges)
+        return ranges
+
+
+    @staticmethod
+    def rebuild_index(market, interval):
+        """
+            Re-scan all of a market's candles. Ranges already known to be
+            unfillable stay that way.
+        """
+        unfillable = {(g.start_timestamp, g.end_timestamp) for g in CandleGap.select().where(
+            CandleGap.market == market,
+            CandleGap.interval == interval,
+            CandleGap.unfillable == True)}
+
+        with market_db.atomic():
+            CandleGap.delete().where(
+                CandleGap.market == market,
+                CandleGap.interval == interval
+            ).execute()
+
+            gaps = Candle.find_gaps(market, interval)
+            for gap in gaps:
+                CandleGap.record(market, interval, [gap], unfillable=(gap in unfillable))
+
+        return gaps
+
+
+    def update_after_fetch(self, fetched_through):
+        """
+            Re-check this gap after fetching [start_timestamp, fetched_through].
+            Whatever is still missing in the fetched part isn't available on the
+            exchange; anything past it is still open.
+        """
+        step = Candle.INTERVAL_SECONDS[self.interval]
+        fetched_through = min(int(fetched_through), self.end_timestamp)
+        with market_db.atomic():
+            self.delete_instance()
+            CandleGap.record(
+                self.market,
+                self.interval,
+                Candle.missing_ranges(self.market, self.interval, self.start_timestamp, fetched_through),
+                attempts=self.attempts + 1,
+                unfillable=True)
+            if fetched_through < self.end_timestamp:
+                CandleGap.record(
+                    self.market,
+                    self.interval,
+                    [(fetched_through + step, self.end_timestamp)],
+                    attempts=self.attempts + 1)
+
+
+
+class OrderIdField(Field):
+    """
+        Exchange order id: an integer on Binance, a UUID string on Bittrex v3.
+        INTEGER affinity means SQLite keeps numeric ids numeric (so they still
+        sort as numbers) and stores anything else as text.
+    """
+    field_type = 'INT'
+
+
+
 class LongPosition(BaseModel):
     exchange = CharField()
     market = CharField()
-    buy_order_id = IntegerField()
+    buy_order_id = OrderIdField()
     buy_quantity = DecimalField()
     purchase_price = DecimalField()
     fees = DecimalField()
     timestamp = DateTimeField()
     watchlist = CharField()
-    sell_order_id = IntegerField(null=True)
+    sell_order_id = OrderIdField(null=True)
     sell_quantity = DecimalField(null=True)
     sell_price = DecimalField(null=True)
     sell_timestamp = DateTimeField(null=True)
@@ -238,16 +635,25 @@ class LongPosition(BaseModel):
             return None
 
     @staticmethod
-    def get_last_positions(num, market=None):
-        if not market:
-            return LongPosition.select().order_by(LongPosition.timestamp.desc()).limit(num)
-        else:
-            return LongPosition.select(
+    def get_last_positions(num, market=None, markets=None):
+        # The most recent buys may have already sold and been archived
+        if market:
+            return PositionHistory.select(
                 ).where(
-                    LongPosition.market == market
+                    PositionHistory.market == market
                 ).order_by(
-                    LongPosition.timestamp.desc()
+                    PositionHistory.timestamp.desc()
+                ).limit(num)
+        elif markets:
+            # e.g. just the markets for one base currency
+            return PositionHistory.select(
+                ).where(
+                    PositionHistory.market.in_(markets)
+                ).order_by(
+                    PositionHistory.timestamp.desc()
                 ).limit(num)
+        else:
+            return PositionHistory.select().order_by(PositionHistory.timestamp.desc()).limit(num)
 
     @staticmethod
     def get_num_positions(market=None, limit=None):
@@ -314,6 +720,45 @@ class LongPosition(BaseModel):
                     LongPosition.sell_timestamp.is_null(True)
                 )
 
+    @staticmethod
+    def archive_sold(batch_size=None):
+        """
+            Move sold positions into ArchivedPosition, `batch_size` per
+            transaction, so the live table only holds what's still open. Returns
+            the number of positions moved.
+        """
+        batch_size = batch_size or config.ARCHIVE_BATCH_SIZE
+
+        # SQLite hands out max(id) + 1 for new rows; keep the newest position
+        #   in place so an archived id is never reused.
+        max_id = LongPosition.select(fn.MAX(LongPosition.id)).scalar()
+        if max_id is None:
+            return 0
+
+        names = LongPosition._meta.sorted_field_names
+        num_archived = 0
+        while True:
+            with db.atomic():
+                ids = [position_id for (position_id, ) in LongPosition.select(
+                        LongPosition.id
+                    ).where(
+                        LongPosition.sell_timestamp.is_null(False),
+                        LongPosition.id < max_id
+                    ).order_by(
+                        LongPosition.id
+                    ).limit(batch_size).tuples()]
+                if not ids:
+                    return num_archived
+
+                ArchivedPosition.insert_from(
+                    LongPosition.select(*[getattr(LongPosition, n) for n in names]).where(LongPosition.id.in_(ids)),
+                    [getattr(ArchivedPosition, n) for n in names]
+                ).execute()
+                LongPosition.delete().where(LongPosition.id.in_(ids)).execute()
+
+            num_archived += len(ids)
+
+
     @property
     def timestamp_str(self):
         return datetime.datetime.fromtimestamp(self.timestamp).strftime('%Y-%m-%d %H:%M:%S')
@@ -343,7 +788,550 @@ class LongPosition(BaseModel):
         return (sell_quantity, target_price)
 
 
-class MarketParams(BaseModel):
+class PositionRow():
+    """
+        Read-only stand-in for a position on the read paths (reports,
+        snapshots, back-tests): just the columns, in __slots__, without a
+        model instance's per-field state. Has the same `spent`.
+    """
+    __slots__ = ('id', 'exchange', 'market', 'buy_quantity', 'purchase_price', 'fees', 'timestamp',
+                 'watchlist', 'sell_quantity', 'sell_price', 'sell_timestamp', 'scalped_quantity')
+
+    def __init__(self, *values):
+        for (name, value) in zip(PositionRow.__slots__, values):
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return f"PositionRow({self.id}: {self.market} {self.timestamp})"
+
+    @property
+    def spent(self):
+        return self.buy_quantity * self.purchase_price
+
+
+
+class ArchivedPosition(LongPosition):
+    """
+        Sold LongPositions moved out of the live table by
+        LongPosition.archive_sold(); same columns, same ids.
+    """
+    class Meta:
+        indexes = (
+            (('market', 'sell_timestamp'), False),
+        )
+
+
+
+class PositionHistory(LongPosition):
+    """
+        Read-only view of every position, live and archived, for the reports
+        and back-tests that need the whole trading history.
+    """
+    class Meta:
+        table_name = 'positionhistory'
+
+
+    @staticmethod
+    def get_rows(*conditions):
+        """
+            Streams the matching positions, live and archived, in id order as
+            PositionRows.
+        """
+        query = PositionHistory.select(*[getattr(PositionHistory, name) for name in PositionRow.__slots__])
+        if conditions:
+            query = query.where(*conditions)
+        return (PositionRow(*row) for row in query.order_by(PositionHistory.id).tuples().iterator())
+
+
+    @staticmethod
+    def create_view():
+        # Explicit columns; migrations appended some of LongPosition's, so
+        #   the two tables' column order can differ.
+        columns = ", ".join(f'"{LongPosition._meta.fields[n].column_name}"' for n in LongPosition._meta.sorted_field_names)
+        db.execute_sql(
+            f'CREATE VIEW IF NOT EXISTS "positionhistory" AS '
+            f'SELECT {columns} FROM "longposition" UNION ALL SELECT {columns} FROM "archivedposition"')
+
+
+
+class PortfolioSnapshot(BaseModel):
+    """
+        Value of one base currency's holdings as of a candle's close. Appended
+        every run, incrementally from the previous snapshot; see
+        utils.backfill_portfolio_snapshots() for history.
+    """
+    base_currency = CharField()
+    timestamp = IntegerField()              # Candle timestamp whose close values the holdings
+
+    num_open_positions = IntegerField()
+    open_spent = DecimalField()             # Cost basis of the open positions
+    open_value = DecimalField()
+    scalped_value = DecimalField()
+    spent = DecimalField()                  # All-time totals
+    recouped = DecimalField()
+
+    # {market: [open_quantity, scalped_quantity]} so the next snapshot only has to
+    #   apply what changed since this one.
+    holdings = TextField()
+
+    class Meta:
+        indexes = (
+            (('base_currency', 'timestamp'), True),
+        )
+
+
+    def __str__(self):
+        return f"{self.base_currency} {self.timestamp}: {self.total_value:0.8f}"
+
+
+    @property
+    def unrealized_profit(self):
+        return self.open_value - self.open_spent
+
+
+    @property
+    def total_value(self):
+        return self.open_value + self.scalped_value
+
+
+    @staticmethod
+    def get_latest(base_currency, before=None):
+        query = PortfolioSnapshot.select().where(PortfolioSnapshot.base_currency == base_currency)
+        if before is not None:
+            query = query.where(PortfolioSnapshot.timestamp < before)
+        return query.order_by(PortfolioSnapshot.timestamp.desc()).first()
+
+
+    @staticmethod
+    def get_series(base_currency, since=None):
+        query = PortfolioSnapshot.select().where(PortfolioSnapshot.base_currency == base_currency)
+        if since is not None:
+            query = query.where(PortfolioSnapshot.timestamp >= since)
+        return query.order_by(PortfolioSnapshot.timestamp)
+
+
+    @staticmethod
+    def take(base_currency, interval):
+        """
+            Append the snapshot for the latest closed candle: the previous
+            snapshot plus the buys and fills since then, revalued at the latest
+            closes.
+        """
+        step = Candle.INTERVAL_SECONDS[interval]
+        markets = [lp.market for lp in PositionHistory.select(
+                PositionHistory.market
+            ).where(
+                PositionHistory.market.endswith(base_currency)
+            ).distinct()]
+        if not markets:
+            return None
+
+        last_candles = [Candle.get_last_candle(market, interval) for market in markets]
+        timestamp = max((int(c.timestamp) for c in last_candles if c), default=None)
+        if timestamp is None:
+            # None of these markets has candles yet (e.g. before the first ingest)
+            return None
+
+        previous = PortfolioSnapshot.get_latest(base_currency, before=timestamp)
+        if previous:
+            # Fills are only recorded when reconciled, with the exchange's fill
+            #   time. If one landed before `previous` was taken, start over.
+            since = previous.timestamp + step
+            num_open = PositionHistory.select().where(
+                    PositionHistory.market.in_(markets),
+                    PositionHistory.timestamp < since,
+                    (PositionHistory.sell_timestamp.is_null(True)) | (PositionHistory.sell_timestamp >= since)
+                ).count()
+            if num_open != previous.num_open_positions:
+                print(f"{base_currency} fills found from before the last snapshot; rebuilding from scratch")
+                previous = None
+
+        if previous:
+            holdings = {m: [Decimal(q) for q in qs] for (m, qs) in json.loads(previous.holdings).items()}
+            totals = {
+                "num_open_positions": previous.num_open_positions,
+                "open_spent": previous.open_spent,
+                "spent": previous.spent,
+                "recouped": previous.recouped,
+            }
+        else:
+            holdings = {}
+            totals = {
+                "num_open_positions": 0,
+                "open_spent": Decimal('0'),
+                "spent": Decimal('0'),
+                "recouped": Decimal('0'),
+            }
+            since = None
+
+        # A position counts toward a snapshot if it happened before its candle closed
+        until = timestamp + step
+        window = (PositionHistory.timestamp < until) if since is None else PositionHistory.timestamp.between(since, until - 0.001)
+        for position in PositionHistory.get_rows(PositionHistory.market.in_(markets), window):
+            held = holdings.setdefault(position.market, [Decimal('0'), Decimal('0')])
+            held[0] += position.buy_quantity
+            totals["num_open_positions"] += 1
+            totals["open_spent"] += position.spent
+            totals["spent"] += position.spent
+
+        window = (PositionHistory.sell_timestamp < until) if since is None else PositionHistory.sell_timestamp.between(since, until - 0.001)
+        for position in PositionHistory.get_rows(PositionHistory.market.in_(markets), window):
+            held = holdings.setdefault(position.market, [Decimal('0'), Decimal('0')])
+            held[0] -= position.buy_quantity
+            held[1] += position.scalped_quantity or Decimal('0')
+            totals["num_open_positions"] -= 1
+            totals["open_spent"] -= position.spent
+            totals["recouped"] += position.sell_quantity * position.sell_price
+
+        # Revalue everything at the latest close
+        open_value = Decimal('0')
+        scalped_value = Decimal('0')
+        for (market, (open_quantity, scalped_quantity)) in holdings.items():
+            if not open_quantity and not scalped_quantity:
+                continue
+            close = Candle.get_close(market, interval, until=timestamp)
+            if close is None:
+                continue
+            open_value += open_quantity * close
+            scalped_value += scalped_quantity * close
+
+        PortfolioSnapshot.delete().where(
+            PortfolioSnapshot.base_currency == base_currency,
+            PortfolioSnapshot.timestamp == timestamp
+        ).execute()
+        return PortfolioSnapshot.create(
+            base_currency=base_currency,
+            timestamp=timestamp,
+            num_open_positions=totals["num_open_positions"],
+            open_spent=totals["open_spent"].quantize(ONE_SATOSHI),
+            open_value=open_value.quantize(ONE_SATOSHI),
+            scalped_value=scalped_value.quantize(ONE_SATOSHI),
+            spent=totals["spent"].quantize(ONE_SATOSHI),
+            recouped=totals["recouped"].quantize(ONE_SATOSHI),
+            holdings=json.dumps({m: [f"{q:f}" for q in qs] for (m, qs) in holdings.items() if any(qs)})
+        )
+
+
+
+class MetricsHistory(BaseModel):
+    """
+        Every run's buy decision inputs: each market's metrics from
+        calculate_latest_metrics() and, for the markets that made it into a
+        buy lottery, their entries, odds and whether they were picked.
+    """
+    run_timestamp = IntegerField()          # When the run started
+    exchange = CharField()
+    market = CharField()
+    timestamp = IntegerField()              # Candle timestamp the metrics are as of
+    close = DecimalField()
+    ma_period = SmallIntegerField()
+    ma = DecimalField()
+    price_to_ma = DecimalField()
+    ma_reliable = BooleanField()
+
+    # Lottery; null for markets that weren't buy candidates
+    entries = IntegerField(null=True)
+    weight = FloatField(null=True)
+    selected = BooleanField(default=False)
+
+    class Meta:
+        indexes = (
+            (('run_timestamp', 'exchange', 'market'), True),
+            (('market', 'run_timestamp'), False),
+        )
+
+
+    def __str__(self):
+        return f"{self.run_timestamp} {self.market}: price-to-MA {self.price_to_ma:0.4f}"
+
+
+    @staticmethod
+    def record(run_timestamp, metrics):
+        rows = [{
+                "run_timestamp": int(run_timestamp),
+                "exchange": m['exchange'],
+                "market": m['market'],
+                "timestamp": int(m['timestamp']),
+                "close": m['close'],
+                "ma_period": m['ma_period'],
+                "ma": m['ma'],
+                "price_to_ma": m['price_to_ma'],
+                "ma_reliable": m['ma_reliable'],
+            } for m in metrics]
+
+        with db.atomic():
+            # 9 columns per row; stay under SQLite's 999 variable limit
+            for batch in chunked(rows, 100):
+                MetricsHistory.insert_many(batch).on_conflict_replace().execute()
+
+
+    @staticmethod
+    def record_lottery(run_timestamp, candidates, weights, selected):
+        with db.atomic():
+            for (candidate, weight) in zip(candidates, weights):
+                MetricsHistory.update(
+                        entries=int(candidate['entries']),
+                        weight=weight,
+                        selected=(candidate['exchange'], candidate['market']) == (selected['exchange'], selected['market'])
+                    ).where(
+                        MetricsHistory.run_timestamp == int(run_timestamp),
+                        MetricsHistory.exchange == candidate['exchange'],
+                        MetricsHistory.market == candidate['market']
+                    ).execute()
+
+
+    @staticmethod
+    def get_series(market, since=None):
+        query = MetricsHistory.select().where(MetricsHistory.market == market)
+        if since is not None:
+            query = query.where(MetricsHistory.run_timestamp >= since)
+        return query.order_by(MetricsHistory.run_timestamp)
+
+
+    @staticmethod
+    def get_closes(markets=None):
+        """
+            {run_timestamp: {market: close}} for every recorded run, oldest
+            first, without touching the candles.
+        """
+        query = MetricsHistory.select(
+                MetricsHistory.run_timestamp, MetricsHistory.market, MetricsHistory.close
+            ).order_by(MetricsHistory.run_timestamp)
+        if markets is not None:
+            query = query.where(MetricsHistory.market.in_(list(markets)))
+
+        runs = {}
+        for (run_timestamp, market, close) in query.tuples():
+            runs.setdefault(run_timestamp, {})[market] = close
+        return runs
+
+
+
+class PaperOrder(BaseModel):
+    """
+        Simulated orders for PaperExchange. Market orders fill immediately;
+        LIMIT SELLs stay NEW until a later candle's high reaches their price.
+    """
+    SIDE__BUY = 'BUY'
+    SIDE__SELL = 'SELL'
+    TYPE__MARKET = 'MARKET'
+    TYPE__LIMIT = 'LIMIT'
+    STATUS__NEW = 'NEW'
+    STATUS__FILLED = 'FILLED'
+    STATUS__CANCELED = 'CANCELED'
+
+    exchange = CharField()
+    market = CharField()
+    side = CharField()
+    order_type = CharField()
+    status = CharField()
+    quantity = DecimalField()
+    price = DecimalField()
+    fees = DecimalField(default=Decimal('0'))
+    timestamp = DateTimeField()                 # When the order was placed
+    fill_timestamp = DateTimeField(null=True)
+
+    # Last candle already matched against this open order
+    checked_through = IntegerField(null=True)
+
+    class Meta:
+        indexes = (
+            (('exchange', 'market', 'status'), False),
+        )
+
+
+    def __str__(self):
+        return f"{self.id}: {self.market} {self.side} {self.order_type} {self.quantity} @ {self.price} {self.status}"
+
+
+    @staticmethod
+    def get_open_orders(exchange, market):
+        return PaperOrder.select().where(
+            PaperOrder.exchange == exchange,
+            PaperOrder.market == market,
+            PaperOrder.status == PaperOrder.STATUS__NEW
+        )
+
+
+
+class Fill(BaseModel):
+    """
+        One execution (trade) of an order, as reported by the exchange's
+        account trade list. Synced incrementally (see FillCursor and
+        trading.sync_fills()) so fees, sell prices and scalped quantities can be
+        worked out locally instead of asking the exchange order by order.
+    """
+    SIDE__BUY = 'BUY'
+    SIDE__SELL = 'SELL'
+
+    exchange = CharField()
+    market = CharField()
+    trade_id = OrderIdField()
+    order_id = OrderIdField()
+    position_id = IntegerField(null=True)       # LongPosition.id (may since have been archived)
+    side = CharField()
+    price = DecimalField()
+    quantity = DecimalField()
+    quote_quantity = DecimalField()
+    commission = DecimalField()
+    commission_asset = CharField()
+    timestamp = DateTimeField()
+
+    class Meta:
+        indexes = (
+            (('exchange', 'market', 'trade_id'), True),
+            (('exchange', 'order_id'), False),
+            (('position_id', ), False),
+        )
+
+
+    @staticmethod
+    def record(exchange, market, fills, positions_by_order=None):
+        """
+            Store new fills, linking each to the position whose buy or sell
+            order it executed. Fills that are already stored are skipped.
+        """
+        positions_by_order = positions_by_order or {}
+        rows = [dict(
+                exchange=exchange,
+                market=market,
+                position_id=positions_by_order.get(fill['order_id']),
+                **fill
+            ) for fill in fills]
+
+        # Keep each batch under SQLite's 999 bound variables
+        batch_size = 999 // len(Fill._meta.sorted_field_names)
+        with db.atomic():
+            for i in range(0, len(rows), batch_size):
+                Fill.insert_many(rows[i:i + batch_size]).on_conflict_ignore().execute()
+
+
+    @staticmethod
+    def get_order_summaries(exchange, order_ids):
+        """
+            {order_id: {quantity, quote_quantity, price, commissions, timestamp}}
+            for each of `order_ids` that has any stored fills; `price` is the
+            volume-weighted fill price and `commissions` is {asset: amount}.
+        """
+        summaries = {}
+        order_ids = list(order_ids)
+        for i in range(0, len(order_ids), 900):
+            fills = Fill.select(
+                    Fill.order_id, Fill.quantity, Fill.quote_quantity, Fill.commission, Fill.commission_asset, Fill.timestamp
+                ).where(
+                    Fill.exchange == exchange,
+                    Fill.order_id.in_(order_ids[i:i + 900])
+                ).tuples()
+            for (order_id, quantity, quote_quantity, commission, commission_asset, timestamp) in fills:
+                if order_id not in summaries:
+                    summaries[order_id] = {
+                        "quantity": Decimal('0'),
+                        "quote_quantity": Decimal('0'),
+                        "commissions": {},
+                        "timestamp": timestamp,
+                    }
+                summary = summaries[order_id]
+                summary["quantity"] += quantity
+                summary["quote_quantity"] += quote_quantity
+                summary["commissions"][commission_asset] = summary["commissions"].get(commission_asset, Decimal('0')) + commission
+                summary["timestamp"] = max(summary["timestamp"], timestamp)
+
+        for summary in summaries.values():
+            summary["price"] = summary["quote_quantity"] / summary["quantity"] if summary["quantity"] else None
+        return summaries
+
+
+    @staticmethod
+    def get_realized_pnl(position_ids=None):
+        """
+            {position_id: {market, bought, spent, sold, recouped, commissions}}
+            from the stored fills, where `commissions` is {asset: amount}.
+            Realized P&L in the base currency is recouped - spent (less any
+            commission paid in the base currency).
+        """
+        query = Fill.select(
+                Fill.position_id, Fill.market, Fill.side,
+                fn.SUM(Fill.quantity), fn.SUM(Fill.quote_quantity)
+            ).where(
+                Fill.position_id.is_null(False)
+            ).group_by(
+                Fill.position_id, Fill.market, Fill.side
+            )
+        commissions = Fill.select(
+                Fill.position_id, Fill.commission_asset, fn.SUM(Fill.commission)
+            ).where(
+                Fill.position_id.is_null(False)
+            ).group_by(
+                Fill.position_id, Fill.commission_asset
+            )
+        if position_ids is not None:
+            query = query.where(Fill.position_id.in_(list(position_ids)))
+            commissions = commissions.where(Fill.position_id.in_(list(position_ids)))
+
+        results = {}
+        for (position_id, market, side, quantity, quote_quantity) in query.tuples():
+            result = results.setdefault(position_id, {
+                "market": market,
+                "bought": Decimal('0'),
+                "spent": Decimal('0'),
+                "sold": Decimal('0'),
+                "recouped": Decimal('0'),
+                "commissions": {},
+            })
+            # SQLite SUMs come back as floats
+            quantity = Decimal(quantity).quantize(Decimal('0.00000001'))
+            quote_quantity = Decimal(quote_quantity).quantize(Decimal('0.00000001'))
+            if side == Fill.SIDE__BUY:
+                result["bought"] = quantity
+                result["spent"] = quote_quantity
+            else:
+                result["sold"] = quantity
+                result["recouped"] = quote_quantity
+
+        for (position_id, asset, commission) in commissions.tuples():
+            results[position_id]["commissions"][asset] = Decimal(commission).quantize(Decimal('0.00000001'))
+
+        return results
+
+
+
+class FillCursor(BaseModel):
+    """
+        The last trade id synced into Fill for each market, so every sync only
+        asks the exchange for newer trades.
+    """
+    exchange = CharField()
+    market = CharField()
+    last_trade_id = OrderIdField()
+    synced_at = FloatField()
+
+    class Meta:
+        indexes = (
+            (('exchange', 'market'), True),
+        )
+
+
+    @staticmethod
+    def get_cursor(exchange, market):
+        cursor = FillCursor.select().where(
+            FillCursor.exchange == exchange,
+            FillCursor.market == market
+        ).first()
+        return cursor.last_trade_id if cursor else None
+
+
+    @staticmethod
+    def set_cursor(exchange, market, last_trade_id):
+        FillCursor.insert(
+            exchange=exchange,
+            market=market,
+            last_trade_id=last_trade_id,
+            synced_at=time.time()
+        ).on_conflict_replace().execute()
+
+
+
+class MarketParams(MarketDataModel):
     EXCHANGE__BINANCE = "B"
     EXCHANGE__BITTREX = "X"
     EXCHANGE__KUCOIN = "K"
@@ -396,15 +1384,140 @@ class AllTimeWatchlist(BaseModel):
 
 
 
-if not Candle.table_exists():
-    Candle.create_table(True)
 
-if not LongPosition.table_exists():
-    LongPosition.create_table(True)
+class ExportWatermark(BaseModel):
+    """
+        How far each table has been exported to each destination; see export.py.
+        Tables exported market by market (candles) keep one per market.
+    """
+    table = CharField()
+    destination = CharField()
+    market = CharField(default='')
+    watermark = FloatField()
+    exported_at = FloatField()
+    num_rows = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('table', 'destination', 'market'), True),
+        )
+
+
+    @staticmethod
+    def get_watermarks(table, destination):
+        """
+            {market: watermark}; the market is '' unless the table is exported
+            per market.
+        """
+        marks = ExportWatermark.select(ExportWatermark.market, ExportWatermark.watermark).where(
+            ExportWatermark.table == table,
+            ExportWatermark.destination == destination
+        ).tuples()
+        return {market: watermark for (market, watermark) in marks}
+
+
+    @staticmethod
+    def set_watermark(table, destination, watermark, num_rows, market=''):
+        ExportWatermark.insert(
+            table=table,
+            destination=destination,
+            market=market,
+            watermark=watermark,
+            exported_at=time.time(),
+            num_rows=num_rows
+        ).on_conflict_replace().execute()
+
+
+
+class StatusSnapshot(BaseModel):
+    """
+        Precomputed JSON for the status API (see status.py), refreshed by each
+        run so the server never has to touch the exchange or re-run reports.
+    """
+    name = CharField(unique=True)
+    body = TextField()
+    etag = CharField()                      # Hash of `body`
+    updated = FloatField()
+
+
+    @staticmethod
+    def get_snapshot(name):
+        return StatusSnapshot.select().where(StatusSnapshot.name == name).first()
+
+
+    @staticmethod
+    def publish(name, body):
+        StatusSnapshot.insert(
+            name=name,
+            body=body,
+            etag=hashlib.sha1(body.encode('utf-8')).hexdigest(),
+            updated=time.time()
+        ).on_conflict_replace().execute()
+
+
+
+if not config.SQLITE_READ_ONLY:
+    if not Market.table_exists():
+        Market.create_table(True)
+
+    if not Candle.table_exists():
+        Candle.create_table(True)
+
+    if not CandleGap.table_exists():
+        CandleGap.create_table(True)
+
+    if not LongPosition.table_exists():
+        LongPosition.create_table(True)
+
+    if not ArchivedPosition.table_exists():
+        ArchivedPosition.create_table(True)
+    PositionHistory.create_view()
+
+    if not MarketParams.table_exists():
+        MarketParams.create_table(True)
+
+    if not AllTimeWatchlist.table_exists():
+        AllTimeWatchlist.create_table(True)
+
+    if not PortfolioSnapshot.table_exists():
+        PortfolioSnapshot.create_table(True)
+
+    if not ExportWatermark.table_exists():
+        ExportWatermark.create_table(True)
+
+    if not MetricsHistory.table_exists():
+        MetricsHistory.create_table(True)
+
+    if not PaperOrder.table_exists():
+        PaperOrder.create_table(True)
+
+    if not StatusSnapshot.table_exists():
+        StatusSnapshot.create_table(True)
+
+    if not Fill.table_exists():
+        Fill.create_table(True)
+
+    if not FillCursor.table_exists():
+        FillCursor.create_table(True)
+
+
 
-if not MarketParams.table_exists():
-    MarketParams.create_table(True)
+def use_account_db(db_file):
+    """
+        Point the per-account models (positions, all-time watchlist) at another
+        portfolio's DB. Market data stays in the shared market_db.
+    """
+    if market_db is db:
+        raise Exception("Set MARKET_DATA_DB_FILE to host several portfolios")
 
-if not AllTimeWatchlist.table_exists():
-    AllTimeWatchlist.create_table(True)
+    if not db.is_closed():
+        db.close()
+    (name, kwargs) = connection_params(db_file, config.SQLITE_READ_ONLY)
+    db.init(name, **kwargs)
+    config.SQLITE_DB_FILE = db_file
 
+    for model in (LongPosition, ArchivedPosition, AllTimeWatchlist, PortfolioSnapshot, MetricsHistory, ExportWatermark, PaperOrder, StatusSnapshot, Fill, FillCursor):
+        if not config.SQLITE_READ_ONLY and not model.table_exists():
+            model.create_table(True)
+    if not config.SQLITE_READ_ONLY:
+        PositionHistory.create_view()
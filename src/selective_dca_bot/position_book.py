@@ -0,0 +1,173 @@
+from bisect import bisect_left
+from collections import defaultdict
+from decimal import Decimal
+
+from .models import LongPosition
+
+
+
+class MarketBook():
+    """
+        One market's open LongPositions, kept ordered by purchase_price (highest
+        first, then id) so percentile lookups are just an index.
+    """
+    def __init__(self, exchange, market):
+        self.exchange = exchange
+        self.market = market
+        self._keys = []
+        self._positions = []
+
+
+    @staticmethod
+    def _key(position):
+        return (-position.purchase_price, position.id)
+
+
+    def __len__(self):
+        return len(self._positions)
+
+
+    def __iter__(self):
+        return iter(list(self._positions))
+
+
+    def add(self, position):
+        key = MarketBook._key(position)
+        index = bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            # Already booked; swap in the newer instance
+            self._positions[index] = position
+            return
+        self._keys.insert(index, key)
+        self._positions.insert(index, position)
+
+
+    def remove(self, position):
+        key = MarketBook._key(position)
+        index = bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+            del self._positions[index]
+
+
+    def percentile_index(self, percentile):
+        """
+            Index of the position at `percentile` (0.0 - 1.0) of the stash, counting
+            from the highest purchase_price.
+        """
+        return int(len(self._positions) * percentile)
+
+
+    def at_percentile(self, percentile):
+        index = self.percentile_index(percentile)
+        if index >= len(self._positions):
+            return None
+        return self._positions[index]
+
+
+    def cohorts(self, percentile):
+        """
+            Split the book at `percentile`: (positions above it, positions at or below it).
+        """
+        index = self.percentile_index(percentile)
+        return (self._positions[:index], self._positions[index:])
+
+
+    def with_sell_orders(self):
+        return sorted((p for p in self._positions if p.sell_order_id is not None), key=lambda p: p.sell_order_id)
+
+
+    @property
+    def quantity(self):
+        return sum((p.buy_quantity for p in self._positions), Decimal('0'))
+
+
+    @property
+    def spent(self):
+        return sum((p.spent for p in self._positions), Decimal('0'))
+
+
+
+class PositionBook():
+    """
+        In-memory view of every open LongPosition, grouped by exchange and
+        market. Loaded with a single query at the start of a run and then kept
+        current as positions are bought (add) and sold (remove), so repricing and
+        the over-position checks don't have to keep going back to the DB.
+
+        Repriced positions are the same instances held here, so their sell_*
+        changes are already reflected.
+    """
+    def __init__(self):
+        self._books = defaultdict(dict)
+
+        # Bumped on every add/remove so callers can tell the book has changed
+        self.version = 0
+
+
+    @staticmethod
+    def load(exchange=None):
+        book = PositionBook()
+        positions = LongPosition.get_open_positions()
+        if exchange:
+            positions = positions.where(LongPosition.exchange == exchange)
+        for position in positions:
+            book.add(position)
+        return book
+
+
+    def market_book(self, exchange, market):
+        if market not in self._books[exchange]:
+            self._books[exchange][market] = MarketBook(exchange, market)
+        return self._books[exchange][market]
+
+
+    def markets(self, exchange):
+        return [market for (market, market_book) in self._books[exchange].items() if len(market_book)]
+
+
+    def positions(self, exchange, market):
+        return self.market_book(exchange, market)
+
+
+    def add(self, position):
+        self.market_book(position.exchange, position.market).add(position)
+        self.version += 1
+
+
+    def remove(self, position):
+        self.market_book(position.exchange, position.market).remove(position)
+        self.version += 1
+
+
+    def count(self, market=None):
+        """
+            Number of open positions, across all exchanges; optionally for just
+            one market.
+        """
+        return sum(len(b) for b in self._market_books(market))
+
+
+    def counts(self):
+        """
+            {market: number of open positions}, across all exchanges, in one pass.
+        """
+        counts = defaultdict(int)
+        for books in self._books.values():
+            for (market, market_book) in books.items():
+                counts[market] += len(market_book)
+        return dict(counts)
+
+
+    def exposure(self, market=None):
+        """
+            Base currency spent on the open positions, overall or for one market.
+        """
+        return sum((b.spent for b in self._market_books(market)), Decimal('0'))
+
+
+    def _market_books(self, market=None):
+        for books in self._books.values():
+            for (m, market_book) in books.items():
+                if not market or m == market:
+                    yield market_book
@@ -0,0 +1,136 @@
+import fcntl
+import random
+import time
+import traceback
+
+from . import config
+from .tracing import tracer
+
+
+"""
+    Resident scheduler: runs each phase of the bot (candle ingest, order
+    reconciliation, repricing, buying, ...) on its own cadence from one
+    long-lived process, so the exchange clients, connection pools and the
+    PositionBook stay warm between ticks instead of being rebuilt by cron.
+
+    Each phase is a Job. A Job with a `fingerprint` is skipped when the
+    fingerprint hasn't changed since its last successful run (e.g. no new
+    candles and no new positions since the last repricing). Every wait gets
+    some random jitter so multiple accounts/hosts don't hit the exchange in
+    lockstep, and every phase runs under the account's RunLock so it can't
+    overlap a cron'd main.py on the same DB.
+"""
+
+
+
+class RunLock():
+    """
+        Advisory (flock) lock on `<account db>.lock`. Held by anything that
+        trades on the account so two runs never overlap. The OS drops it if the
+        holder dies, so there's no stale lock to clean up.
+    """
+    def __init__(self, path=None):
+        self.path = path or f"{config.SQLITE_DB_FILE}.lock"
+        self._file = None
+
+
+    def acquire(self):
+        """
+            Doesn't wait: returns False if another process holds the lock.
+        """
+        if self._file:
+            return True
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+
+    def release(self):
+        if self._file:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+
+class Job():
+    def __init__(self, name, func, every, fingerprint=None):
+        self.name = name
+        self.func = func
+        self.every = every
+        self.fingerprint = fingerprint
+        self.next_run = 0
+        self.last_fingerprint = None
+        self.last_status = None
+
+
+
+class Scheduler():
+    """
+        Runs the added Jobs, in the order they were added, whenever they're
+        due. Each run is traced as its own run (tagged with the job's name) and
+        handed to `on_finish(status)` to be logged.
+    """
+    def __init__(self, lock=None, jitter=None, tags=None, on_finish=None):
+        self.lock = lock or RunLock()
+        self.jitter = config.SCHEDULE_JITTER if jitter is None else jitter
+        self.tags = tags or {}
+        self.on_finish = on_finish
+        self.jobs = []
+
+
+    def add(self, name, func, every, fingerprint=None):
+        job = Job(name, func, every, fingerprint)
+        self.jobs.append(job)
+        return job
+
+
+    def run_pending(self, now=None):
+        """
+            Runs every job that's due; returns the names of the ones that ran.
+        """
+        now = time.time() if now is None else now
+        ran = []
+        for job in self.jobs:
+            if job.next_run > now:
+                continue
+            job.next_run = now + job.every + random.uniform(0, self.jitter * job.every)
+
+            fingerprint = job.fingerprint() if job.fingerprint else None
+            if fingerprint is not None and fingerprint == job.last_fingerprint:
+                # Nothing it depends on has changed since it last ran
+                continue
+
+            if not self.lock.acquire():
+                print(f"{job.name}: {self.lock.path} is held by another run; skipping")
+                continue
+
+            tracer.reset()
+            tracer.tags = dict(self.tags, phase=job.name)
+            status = "ok"
+            try:
+                job.func()
+                job.last_fingerprint = fingerprint
+            except Exception:
+                # Don't let one phase's failure stop the scheduler
+                traceback.print_exc()
+                status = "error"
+            finally:
+                self.lock.release()
+
+            job.last_status = status
+            if self.on_finish:
+                self.on_finish(status)
+            ran.append(job.name)
+        return ran
+
+
+    def run_forever(self):
+        while True:
+            self.run_pending()
+            time.sleep(max(0, min(job.next_run for job in self.jobs) - time.time()))
@@ -0,0 +1,195 @@
+import asyncio
+import email.utils
+import hashlib
+import json
+import time
+
+from decimal import Decimal
+
+from . import config
+from .models import StatusSnapshot
+
+
+"""
+    Read-only JSON status API.
+
+    Each run publishes its reports (open and scalped positions, the latest
+    metrics, recent runs) as precomputed StatusSnapshots. The server only ever
+    serves those: it polls the snapshots' ETags every few seconds and keeps
+    the bodies in memory, so dashboards can poll as often as they like without
+    touching the exchange or re-running any aggregates. Clients that send
+    If-None-Match get a 304 until the next run changes the data.
+"""
+SNAPSHOT__OPEN_POSITIONS = 'open_positions'
+SNAPSHOT__SCALPED_POSITIONS = 'scalped_positions'
+SNAPSHOT__METRICS = 'metrics'
+SNAPSHOT__RUNS = 'runs'
+
+ROUTES = {
+    '/positions/open': SNAPSHOT__OPEN_POSITIONS,
+    '/positions/scalped': SNAPSHOT__SCALPED_POSITIONS,
+    '/metrics': SNAPSHOT__METRICS,
+    '/runs': SNAPSHOT__RUNS,
+}
+
+MAX_HEADER_LINES = 100
+KEEP_ALIVE_SECONDS = 30
+
+
+
+def _to_json(data):
+    # Decimals as strings to keep full precision
+    return json.dumps(data, default=lambda v: str(v) if isinstance(v, Decimal) else repr(v))
+
+
+
+def publish_reports(open_summary, scalped_summary, metrics):
+    """
+        Refresh the position and metrics snapshots from the data a run has
+        already computed for its own reports.
+    """
+    timestamp = time.time()
+    StatusSnapshot.publish(SNAPSHOT__OPEN_POSITIONS, _to_json(dict(open_summary, timestamp=timestamp)))
+    StatusSnapshot.publish(SNAPSHOT__SCALPED_POSITIONS, _to_json(dict(scalped_summary, timestamp=timestamp)))
+    if metrics:
+        StatusSnapshot.publish(SNAPSHOT__METRICS, _to_json({"timestamp": timestamp, "metrics": metrics}))
+
+
+
+def publish_run(run):
+    """
+        Add a finished run (tracer.to_dict()) to the recent runs snapshot.
+    """
+    snapshot = StatusSnapshot.get_snapshot(SNAPSHOT__RUNS)
+    runs = json.loads(snapshot.body)["runs"] if snapshot else []
+
+    # The per-call spans are in the run log; the phase totals are enough here
+    runs.insert(0, {k: v for (k, v) in run.items() if k != 'spans'})
+    StatusSnapshot.publish(SNAPSHOT__RUNS, _to_json({"runs": runs[:config.STATUS_RECENT_RUNS]}))
+
+
+
+class StatusServer():
+    def __init__(self, refresh_seconds=None):
+        self.refresh_seconds = refresh_seconds or config.STATUS_REFRESH_SECONDS
+
+        # name: (etag, updated, body)
+        self.snapshots = {}
+
+
+    def refresh(self):
+        """
+            Reload just the snapshots whose ETag changed since the last check.
+        """
+        current = StatusSnapshot.select(
+                StatusSnapshot.name, StatusSnapshot.etag, StatusSnapshot.updated
+            ).tuples()
+        for (name, etag, updated) in current:
+            cached = self.snapshots.get(name)
+            if cached and cached[0] == etag:
+                continue
+            body = StatusSnapshot.get_snapshot(name).body.encode('utf-8')
+            self.snapshots[name] = (etag, updated, body)
+
+
+    def index(self):
+        body = _to_json({
+            "endpoints": {path: self.snapshots[name][1] for (path, name) in ROUTES.items() if name in self.snapshots}
+        }).encode('utf-8')
+        return (hashlib.sha1(body).hexdigest(), time.time(), body)
+
+
+    def response(self, method, path, headers):
+        """
+            (status, headers, body) for a request.
+        """
+        if method not in ('GET', 'HEAD'):
+            return ("405 Method Not Allowed", {"Allow": "GET, HEAD"}, b"")
+
+        path = path.split('?', 1)[0].rstrip('/') or '/'
+        if path == '/':
+            snapshot = self.index()
+        elif ROUTES.get(path) in self.snapshots:
+            snapshot = self.snapshots[ROUTES[path]]
+        else:
+            return ("404 Not Found", {}, b"")
+
+        (etag, updated, body) = snapshot
+        response_headers = {
+            "Content-Type": "application/json",
+            "ETag": f'"{etag}"',
+            "Last-Modified": email.utils.formatdate(updated, usegmt=True),
+            "Cache-Control": "no-cache",
+        }
+
+        if_none_match = headers.get('if-none-match')
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if '*' in tags or response_headers["ETag"] in [t[2:] if t.startswith('W/') else t for t in tags]:
+                return ("304 Not Modified", response_headers, b"")
+
+        return ("200 OK", response_headers, body)
+
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    (method, path, version) = request_line.decode('latin-1').split()
+                except ValueError:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+
+                headers = {}
+                for i in range(MAX_HEADER_LINES):
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    (name, _, value) = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                (status, response_headers, body) = self.response(method, path, headers)
+                response_headers["Content-Length"] = str(len(body))
+                if method == 'HEAD':
+                    body = b""
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if not keep_alive:
+                    response_headers["Connection"] = "close"
+
+                head = f"HTTP/1.1 {status}\r\n" + "".join(f"{k}: {v}\r\n" for (k, v) in response_headers.items())
+                writer.write(head.encode('latin-1') + b"\r\n" + body)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+    async def refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                # The DB may be mid-write or briefly missing; try again next time
+                print(f"Status refresh failed: {e}")
+            await asyncio.sleep(self.refresh_seconds)
+
+
+    async def serve(self, host=None, port=None):
+        asyncio.ensure_future(self.refresh_loop())
+        server = await asyncio.start_server(
+            self.handle,
+            host or config.STATUS_HOST,
+            port or config.STATUS_PORT)
+        async with server:
+            await server.serve_forever()
@@ -0,0 +1,200 @@
+import json
+import os
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+"""
+    Per-run instrumentation: timed spans for each phase of a run and for each
+    exchange API call, plus counters (SQLite queries, API weight, retries).
+
+    A single module-level `tracer` collects everything for the current run; at
+    the end of the run it's written out as a line in a JSON run log and as a
+    Prometheus textfile (for node_exporter's textfile collector).
+"""
+METRIC_PREFIX = 'selective_dca_bot'
+
+
+
+class RunTracer():
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.tags = {}
+        self.spans = []
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self._stack = []
+
+
+    @contextmanager
+    def span(self, name, **tags):
+        span = {
+            "name": name,
+            "parent": self._stack[-1]['name'] if self._stack else None,
+            "start": time.time() - self.started,
+        }
+        if tags:
+            span["tags"] = tags
+        self._stack.append(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except Exception as e:
+            span["error"] = repr(e)
+            raise
+        finally:
+            span["seconds"] = time.perf_counter() - start
+            self._stack.pop()
+            self.spans.append(span)
+
+
+    def incr(self, name, value=1):
+        self.counters[name] += value
+
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+
+    def gauge_max(self, name, value):
+        self.gauges[name] = max(value, self.gauges.get(name, value))
+
+
+    def phase_seconds(self):
+        """
+            Total time per span name (nested spans of the same name aren't
+            double-counted).
+        """
+        totals = defaultdict(float)
+        for span in self.spans:
+            if span["parent"] != span["name"]:
+                totals[span["name"]] += span["seconds"]
+        return dict(totals)
+
+
+    def trace_client(self, client, exchange_name):
+        return TracedClient(client, exchange_name, self)
+
+
+    def record_response(self, exchange_name, response):
+        """
+            Response hook for the exchange sessions (see exchanges/transport.py);
+            tracks API weight from the exchange's headers.
+        """
+        self.incr(f"http_requests.{exchange_name}")
+        for header in ['x-mbx-used-weight-1m', 'x-mbx-used-weight']:
+            if header in response.headers:
+                weight = int(response.headers[header])
+                self.gauge(f"api_used_weight.{exchange_name}", weight)
+                self.gauge_max(f"api_peak_weight.{exchange_name}", weight)
+                break
+
+
+    def to_dict(self):
+        return {
+            "started": self.started,
+            "finished": self.finished,
+            "status": self.status,
+            "tags": self.tags,
+            "duration": (self.finished or time.time()) - self.started,
+            "phases": self.phase_seconds(),
+            "counters": dict(self.counters),
+            "gauges": self.gauges,
+            "spans": self.spans,
+        }
+
+
+    def finish(self, status="ok"):
+        if self.finished:
+            return
+        self.finished = time.time()
+        self.status = status
+
+
+    def write_run_log(self, path):
+        """
+            Appends this run as a single line of JSON.
+        """
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.to_dict()) + "\n")
+
+
+    def write_prometheus(self, path):
+        run = self.to_dict()
+        lines = [
+            f"# HELP {METRIC_PREFIX}_run_seconds Duration of the last run",
+            f"# TYPE {METRIC_PREFIX}_run_seconds gauge",
+            f"{METRIC_PREFIX}_run_seconds {run['duration']:0.6f}",
+            f"# HELP {METRIC_PREFIX}_run_timestamp_seconds Start time of the last run",
+            f"# TYPE {METRIC_PREFIX}_run_timestamp_seconds gauge",
+            f"{METRIC_PREFIX}_run_timestamp_seconds {run['started']:0.0f}",
+            f"# HELP {METRIC_PREFIX}_run_success Whether the last run finished cleanly",
+            f"# TYPE {METRIC_PREFIX}_run_success gauge",
+            f"{METRIC_PREFIX}_run_success {1 if run['status'] == 'ok' else 0}",
+            f"# HELP {METRIC_PREFIX}_phase_seconds Time spent in each phase of the last run",
+            f"# TYPE {METRIC_PREFIX}_phase_seconds gauge",
+        ]
+        for phase, seconds in sorted(run['phases'].items()):
+            lines.append(f'{METRIC_PREFIX}_phase_seconds{{phase="{phase}"}} {seconds:0.6f}')
+
+        for values in [run['counters'], run['gauges']]:
+            by_metric = defaultdict(list)
+            for key, value in values.items():
+                # "metric.label" keys become metric{label="..."}
+                (metric, _, label) = key.partition('.')
+                by_metric[metric].append((label, value))
+
+            for metric, series in sorted(by_metric.items()):
+                name = f"{METRIC_PREFIX}_{metric}"
+                lines.append(f"# TYPE {name} gauge")
+                for label, value in sorted(series):
+                    if label:
+                        lines.append(f'{name}{{key="{label}"}} {value}')
+                    else:
+                        lines.append(f"{name} {value}")
+
+        # Write then rename so the collector never reads a half-written file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+
+
+class TracedClient():
+    """
+        Wraps an exchange API client so every method call is recorded as an
+        'exchange_call' span.
+    """
+    def __init__(self, client, exchange_name, tracer):
+        self._client = client
+        self._exchange_name = exchange_name
+        self._tracer = tracer
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr) or name.startswith('_'):
+            return attr
+
+        def traced(*args, **kwargs):
+            with self._tracer.span('exchange_call', exchange=self._exchange_name, method=name):
+                self._tracer.incr(f"exchange_calls.{self._exchange_name}.{name}")
+                try:
+                    return attr(*args, **kwargs)
+                except Exception:
+                    self._tracer.incr(f"exchange_errors.{self._exchange_name}.{name}")
+                    raise
+        return traced
+
+
+
+tracer = RunTracer()   # noqa: E305
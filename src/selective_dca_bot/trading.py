@@ -0,0 +1,208 @@
+import json
+
+from decimal import Decimal
+
+from .models import db, Fill, FillCursor
+from .position_book import PositionBook
+from .tracing import tracer
+
+
+
+def sync_fills(exchanges, book=None):
+    """
+        Pull each market's new account trades into Fill, picking up from the
+        market's FillCursor, and link them to the open positions whose buy or
+        LIMIT SELL they executed. Run before update_order_statuses() so it can
+        settle sold positions from the fills. Returns the number of new fills.
+    """
+    if book is None:
+        book = PositionBook.load()
+
+    num_fills = 0
+    for exchange_name, exchange in exchanges.items():
+        for market in book.markets(exchange_name):
+            positions_by_order = {}
+            for position in book.positions(exchange_name, market):
+                positions_by_order[position.buy_order_id] = position.id
+                if position.sell_order_id is not None:
+                    positions_by_order[position.sell_order_id] = position.id
+
+            with tracer.span('fill_sync', exchange=exchange_name, market=market):
+                fills = exchange.get_fills(market, after_trade_id=FillCursor.get_cursor(exchange_name, market))
+                if fills is None:
+                    # This exchange has no trade list to sync from
+                    break
+                if not fills:
+                    continue
+
+                with db.atomic():
+                    Fill.record(exchange_name, market, fills, positions_by_order)
+                    FillCursor.set_cursor(exchange_name, market, fills[-1]['trade_id'])
+                num_fills += len(fills)
+
+    return num_fills
+
+
+
+def update_order_statuses(exchanges, book=None):
+    """
+        Check the status of every open LIMIT SELL, market by market. Returns the
+        LongPositions that sold since the last check; they're also dropped from
+        the PositionBook.
+    """
+    if book is None:
+        book = PositionBook.load()
+
+    positions_sold = []
+    for exchange_name, exchange in exchanges.items():
+        for market in book.markets(exchange_name):
+            positions = book.positions(exchange_name, market).with_sell_orders()
+            sold = exchange.update_order_statuses(market, positions)
+            for position in sold:
+                book.remove(position)
+            positions_sold.extend(sold)
+
+    return positions_sold
+
+
+
+def update_limit_sell_targets(exchanges, metrics, profit_threshold, book=None):
+    """
+        Revise the LIMIT SELL targets of open LongPositions based on the latest
+        metrics (close and MA) for each market.
+    """
+    if book is None:
+        book = PositionBook.load()
+
+    for exchange_name, exchange in exchanges.items():
+        markets = book.markets(exchange_name)
+
+        for market in markets:
+            market_params = exchange.get_market_params(market)
+            metric = next((m for m in metrics if m['exchange'] == exchange_name and m['market'] == market), None)
+            if not metric:
+                # Its base currency isn't part of this run
+                continue
+
+            if not metric['ma_reliable']:
+                print(f"Not revising {market} sell targets; its MA window has missing candles")
+                continue
+
+            # PERCENT_PRICE is enforced against the live price, not the last hourly close
+            current_price = exchange.get_current_price(market).quantize(market_params.price_tick_size)
+            current_ma = metric['ma'].quantize(market_params.price_tick_size)
+
+            # This market's open positions, highest purchase_price first
+            positions = book.positions(exchange_name, market)
+            if len(positions) == 0:
+                continue
+
+            hold_index = positions.percentile_index(0.75)
+            last_target_price = None
+            revisions = []
+            for index, position in enumerate(positions):
+                if index >= hold_index and last_target_price:
+                    # Hold the last 1/4 of the stash at the 75th percentile's target price
+                    target_price = last_target_price
+
+                    if position.sell_order_id and position.sell_price and target_price == position.sell_price.quantize(market_params.price_tick_size):
+                        # This position is already at its min profit. Just have to keep holding
+                        # print(f"Keeping {market} {position.id:3d} {position.purchase_price:0.8f} at {target_price:0.8f}")
+                        continue
+
+                else:
+                    min_sell_price = (position.purchase_price * profit_threshold).quantize(market_params.price_tick_size)
+
+                    # Account for cryptos like LTC with high-value price_tick_sizes
+                    (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, min_sell_price)
+                    last_target_price = target_price
+                    if target_price > current_ma:
+                        # position.sell_price could be None if it was a partially-canceled error position
+                        if position.sell_order_id and position.sell_price and target_price == position.sell_price.quantize(market_params.price_tick_size):
+                            # This position is already at its min profit. Just have to keep holding
+                            # print(f"Keeping {market} {position.id:3d} {position.purchase_price.quantize(market_params.price_tick_size):0.8f} at {target_price:0.8f}")
+                            continue
+                        else:
+                            # Update to the target_price we just calculated.
+                            pass
+
+                    else:
+                        (sell_quantity, target_price) = position.calculate_scalp_sell_price(market_params, (min_sell_price + current_ma)/Decimal('2.0'))
+                        last_target_price = target_price
+
+                        # If the MA has just barely changed, don't bother chasing the tiny difference
+                        diff = (max([position.sell_price, target_price]) - min([position.sell_price, target_price])) / min([position.sell_price, target_price])
+                        if diff < Decimal('0.0025'):
+                            # Current sell_price is close enough
+                            print(f"Not going to bother updating {market} {position.id:3d} ({position.purchase_price.quantize(market_params.price_tick_size):0.8f}): {position.sell_price:0.8f} to {target_price:0.8f} ({diff * Decimal('100.0'):.2f}%)")
+                            continue
+
+                    print(f"Revise  {market} {position.id:3d} {position.purchase_price.quantize(market_params.price_tick_size):0.8f} to: {target_price:0.8f} | {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
+
+                # Factor in the max percent price range allowed for API orders (Binance only)
+                if market_params.multiplier_up:
+                    max_price = (current_price * market_params.multiplier_up).quantize(market_params.price_tick_size)
+                    if target_price > max_price:
+                        print(f"{market} {position.id:3d} New price {target_price:0.8f} most likely exceeds PERCENT_PRICE {max_price:0.8f}")
+                        # So for now set the LIMIT SELL price for the whole lot at nearly the PERCENT_PRICE limit
+                        #   (this will most likely get re-set once the price gets closer).
+                        target_price = (max_price * Decimal('0.99')).quantize(market_params.price_tick_size)
+                        sell_quantity = position.buy_quantity
+
+                        if target_price == position.sell_price:
+                            # Nothing to change
+                            continue
+
+                if target_price * sell_quantity < market_params.min_notional:
+                    print(f"{market} {position.id:3d} sell order for {sell_quantity} @ {target_price:0.8f} ({target_price * sell_quantity:0.4f}) is below MIN_NOTIONAL ({market_params.min_notional})")
+                    continue
+
+                revisions.append((position, sell_quantity, target_price))
+
+            if not revisions:
+                continue
+
+            # Cancel + replace this market's revised LIMIT SELLs together (exchanges
+            #   with a batch endpoint send them in a few requests)
+            replacements = exchange.replace_limit_sells(market, [{
+                    "order_id": position.sell_order_id,
+                    "quantity": sell_quantity,
+                    "price": target_price,
+                } for (position, sell_quantity, target_price) in revisions])
+
+            for ((position, sell_quantity, target_price), (canceled, results)) in zip(revisions, replacements):
+                # All clean records should have a sell_order_id, but we specifically catch
+                #   bad cases in AbstractExchange.update_order_statuses() so should deal with
+                #   them here.
+                if position.sell_order_id:
+                    (success, result) = canceled
+
+                    if not success:
+                        # Its old order is still open or just filled; leave it
+                        #   for update_order_statuses() to sort out
+                        print(f"ERROR CANCELING: {json.dumps(result, indent=4, default=str)}")
+                        if results:
+                            print(f"Replacement LIMIT SELL {results['order_id']} placed for {market} position {position.id} despite the failed cancel")
+                        continue
+
+                    position.sell_order_id = None
+                else:
+                    # If there's no sell_order_id, it's already been canceled
+                    pass
+
+                """
+                    {
+                        "order_id": order_id,
+                        "price": bid_price,
+                        "quantity": quantized_qty
+                    }
+                """
+                if results:
+                    print(f"LIMIT SELL ORDER: {results}\n")
+                    print(f"Revised {market} sell target = {(target_price / position.purchase_price * Decimal('100.0')):.2f}%")
+                    position.sell_order_id = results['order_id']
+                    position.sell_price = target_price
+                    position.sell_quantity = sell_quantity
+
+                # Saved as each replacement completes so it's easy to spot if a later one fails
+                position.save()
@@ -1,26 +1,22 @@
+import bisect
+import json
 import numpy
 
 from decimal import Decimal
-from peewee import fn
+from peewee import chunked, fn
 
-from .models import LongPosition, Candle, AllTimeWatchlist
+from .models import db, LongPosition, PositionHistory, Candle, Market, AllTimeWatchlist, PortfolioSnapshot, MetricsHistory, Fill
 from .exchanges import EXCHANGE__BINANCE
 
 
-def open_positions_report():
+def open_positions_summary():
     markets = [lp.market for lp in LongPosition.select(LongPosition.market).distinct()]
 
     results = []
-    result_str = "Open Positions:\n"
     total_net = Decimal('0.0')
     total_spent = Decimal('0.0')
     for market in markets:
-        current_price = Candle.select(
-            ).where(
-                Candle.market == market
-            ).order_by(
-                Candle.timestamp.desc()
-            ).limit(1)[0].close
+        current_price = Candle.get_close(market)
 
         (num_positions, quantity, spent, min, avg, max, min_sell_price) = LongPosition.select(
                 fn.COUNT(LongPosition.id),
@@ -65,41 +61,55 @@ def open_positions_report():
         total_percentage = (total_net / total_spent * Decimal('100.0')).quantize(Decimal('0.01'))
     else:
         total_percentage = Decimal('0.0')
-    for result in sorted(results, key=lambda i: i['profit'], reverse=True):
+
+    return {
+        "positions": sorted(results, key=lambda i: i['profit'], reverse=True),
+        "total_net": total_net,
+        "total_spent": total_spent,
+        "total_percentage": total_percentage,
+    }
+
+
+def open_positions_report(summary=None):
+    if summary is None:
+        summary = open_positions_summary()
+
+    result_str = "Open Positions:\n"
+    for result in summary["positions"]:
         result_str += f"{'{:>8}'.format(result['market'])}: {result['min_position']:0.8f} | {result['min_sell_price']:0.8f} ({'{:>6}'.format(str(result['min_profit_percentage']))}%) | {'{:>2}'.format(str(result['num_positions']))} | {'{:>6}'.format(str(result['current_profit_percentage']))}%\n"
 
     result_str += f"{'-' * 53}\n"
-    result_str += f"   total: {'{:>11}'.format(str(total_net))} | {'{:>6}'.format(str(total_percentage))}%\n"
+    result_str += f"   total: {'{:>11}'.format(str(summary['total_net']))} | {'{:>6}'.format(str(summary['total_percentage']))}%\n"
 
     return result_str
 
 
-def scalped_positions_report():
-    markets = [lp.market for lp in LongPosition.select(
-                    LongPosition.market
+def scalped_positions_summary():
+    markets = [lp.market for lp in PositionHistory.select(
+                    PositionHistory.market
                 ).where(
-                    LongPosition.scalped_quantity.is_null(False)
+                    PositionHistory.scalped_quantity.is_null(False)
                 ).distinct()]
 
+    # Realized P&L of the sold positions whose fills have been synced
+    realized_pnl = {}
+    for pnl in Fill.get_realized_pnl().values():
+        if pnl["bought"] and pnl["sold"]:
+            realized_pnl[pnl["market"]] = realized_pnl.get(pnl["market"], Decimal('0')) + pnl["recouped"] - pnl["spent"]
+
     results = []
-    result_str = "Scalped Positions:\n"
     total_net = Decimal('0.0')
     total_spent = Decimal('0.0')
     for market in markets:
-        current_price = Candle.select(
-            ).where(
-                Candle.market == market
-            ).order_by(
-                Candle.timestamp.desc()
-            ).limit(1)[0].close
+        current_price = Candle.get_close(market)
 
-        (num_positions, spent, quantity_scalped) = LongPosition.select(
-                fn.COUNT(LongPosition.id),
-                fn.SUM(LongPosition.buy_quantity * LongPosition.purchase_price),
-                fn.SUM(LongPosition.scalped_quantity)
+        (num_positions, spent, quantity_scalped) = PositionHistory.select(
+                fn.COUNT(PositionHistory.id),
+                fn.SUM(PositionHistory.buy_quantity * PositionHistory.purchase_price),
+                fn.SUM(PositionHistory.scalped_quantity)
             ).where(
-                LongPosition.market == market,
-                LongPosition.sell_timestamp.is_null(False)
+                PositionHistory.market == market,
+                PositionHistory.sell_timestamp.is_null(False)
             ).scalar(as_tuple=True)
 
         quantity = Decimal(quantity_scalped).quantize(Decimal('0.00000001'))
@@ -115,16 +125,31 @@ def scalped_positions_report():
             "num_positions": num_positions,
             "spent": spent,
             "current_value": current_value,
-            "quantity": quantity.normalize()
+            "quantity": quantity.normalize(),
+            "realized_pnl": realized_pnl.get(market),
         })
 
     total_net = total_net.quantize(Decimal('0.00000001'))
     total_spent = total_spent.quantize(Decimal('0.00000001'))
-    for result in sorted(results, key=lambda i: i['current_value'], reverse=True):
+
+    return {
+        "positions": sorted(results, key=lambda i: i['current_value'], reverse=True),
+        "total_net": total_net,
+        "total_spent": total_spent,
+        "total_realized_pnl": sum(realized_pnl.values(), Decimal('0')).quantize(Decimal('0.00000001')),
+    }
+
+
+def scalped_positions_report(summary=None):
+    if summary is None:
+        summary = scalped_positions_summary()
+
+    result_str = "Scalped Positions:\n"
+    for result in summary["positions"]:
         result_str += f"{'{:>8}'.format(result['market'])}: current_value {'{:>10}'.format(str(result['current_value']))} | {'{:>6f}'.format(result['quantity'])} | {result['num_positions']:3d}\n"
 
     result_str += f"{'-' * 49}\n"
-    result_str += f"   total: {'{:>10}'.format(str(total_net))}\n"
+    result_str += f"   total: {'{:>10}'.format(str(summary['total_net']))}\n"
 
     return result_str
 
@@ -133,39 +158,54 @@ def generate_performance_report(base_pair='BTC',
                                 interval=Candle.INTERVAL__1HOUR,
                                 test_iterations=100000,
                                 exchanges=[EXCHANGE__BINANCE]):
-    positions = LongPosition.select()
-
-    # Prep back-testing data for every buy
-    for position in positions:
-        watchlist = position.watchlist.split(',')
-
-        position.possible_buys = []
-        for crypto in watchlist:
-            market = f"{crypto}{base_pair}"
-            price = Candle.get_historical_candles(market, interval, position.timestamp, 1)[0].close
-            quantity = (position.spent / price).quantize(Decimal('0.00000001'))
-            position.possible_buys.append({
-                "market": market,
-                "price": price,
-                "quantity": quantity
-            })
+    # The closes each run already recorded when it made its buy decision
+    run_closes = MetricsHistory.get_closes() if MetricsHistory.table_exists() else {}
+    run_timestamps = list(run_closes)
 
     # Grab latest price for all cryptos ever watched
     current_prices = {}
     for exchange in exchanges:
         for crypto in AllTimeWatchlist.get_watchlist(exchange=exchange):
+            if crypto == base_pair:
+                continue
             market = f"{crypto}{base_pair}"
-            candle = Candle.get_last_candle(market, interval=interval)
-            current_prices[market] = candle.close
+            current_prices[market] = Candle.get_close(market, interval=interval)
+
+    # Prep back-testing data for every buy in this base currency: the net profit
+    #   each of its possible buys would have made by now
+    possible_profits = []
+    for position in PositionHistory.get_rows(PositionHistory.market.endswith(base_pair)):
+        watchlist = position.watchlist.split(',')
+        spent = position.spent
+
+        # The run that made this buy started just before it
+        index = bisect.bisect_right(run_timestamps, position.timestamp) - 1
+        closes = run_closes[run_timestamps[index]] if index >= 0 else {}
+
+        profits = []
+        for crypto in watchlist:
+            market = f"{crypto}{base_pair}"
+            if current_prices.get(market) is None:
+                # The base currency itself, or a crypto with no market against it
+                continue
+            price = closes.get(market)
+            if price is None:
+                # Bought before metrics were recorded
+                price = Candle.get_close(market, interval, until=position.timestamp)
+                if price is None:
+                    # Not listed yet at the time
+                    continue
+            quantity = (spent / price).quantize(Decimal('0.00000001'))
+            profits.append(quantity * current_prices[market] - spent)
+        if profits:
+            possible_profits.append(profits)
 
     test_runs = []
     for i in range(0, test_iterations):
         # For each historical LongPosition, randomly select a possible buy and calculate net profitability
         net_profit = Decimal('0.0')
-        for position in positions:
-            rand_buy_index = numpy.random.randint(low=0, high=len(position.possible_buys))
-            buy = position.possible_buys[rand_buy_index]
-            net_profit += buy['quantity'] * current_prices[buy['market']] - position.spent
+        for profits in possible_profits:
+            net_profit += profits[numpy.random.randint(low=0, high=len(profits))]
 
         test_runs.append(net_profit)
         # print(f"{str(i):5s} net profit: {net_profit:0.08f} {base_pair}")
@@ -174,5 +214,125 @@ def generate_performance_report(base_pair='BTC',
     median_profit = test_runs[int(test_iterations/2)]
     print(f"min | median | max: {test_runs[0]:0.08f} | {median_profit:0.08f} | {test_runs[test_iterations - 1]:0.08f}")
 
-    print(current_profit())
+    return {
+        "min": test_runs[0],
+        "median": median_profit,
+        "max": test_runs[test_iterations - 1],
+    }
+
+
+
+def backfill_portfolio_snapshots(base_currency='BTC', interval=Candle.INTERVAL__1HOUR):
+    """
+        Rebuild every historical PortfolioSnapshot for `base_currency` in one
+        pass. Buys and fills become +/- deltas on the candle grid, cumulative sums
+        give the holdings at every candle, and those are valued against each
+        market's closes (carried forward over missing candles).
+    """
+    step = Candle.INTERVAL_SECONDS[interval]
+    positions = list(PositionHistory.select(
+            PositionHistory.market,
+            PositionHistory.timestamp,
+            PositionHistory.sell_timestamp,
+            PositionHistory.buy_quantity,
+            PositionHistory.purchase_price,
+            PositionHistory.sell_quantity,
+            PositionHistory.sell_price,
+            PositionHistory.scalped_quantity
+        ).where(
+            PositionHistory.market.endswith(base_currency)
+        ).tuples())
+    if not positions:
+        return 0
+
+    markets = sorted({p[0] for p in positions})
+    last_candles = [Candle.get_last_candle(market, interval) for market in markets]
+    start = int(min(p[1] for p in positions) // step) * step
+    end = max((int(c.timestamp) for c in last_candles if c), default=None)
+    if end is None or end < start:
+        # No candles yet from the first buy on
+        return 0
+    num_steps = int((end - start) // step) + 1
+    grid = start + numpy.arange(num_steps, dtype=numpy.int64) * step
+
+    num_open = numpy.zeros(num_steps)
+    open_spent = numpy.zeros(num_steps)
+    spent = numpy.zeros(num_steps)
+    recouped = numpy.zeros(num_steps)
+    open_value = numpy.zeros(num_steps)
+    scalped_value = numpy.zeros(num_steps)
+    holdings = {}
+
+    def to_index(timestamps):
+        # Bucket of the candle each event happened in; anything past the grid
+        #   lands in the overflow bucket at num_steps.
+        indexes = numpy.floor((timestamps - start) / step).astype(numpy.int64)
+        return numpy.clip(indexes, 0, num_steps)
+
+    def running_total(indexes, weights=None):
+        return numpy.cumsum(numpy.bincount(indexes, weights=weights, minlength=num_steps + 1))[:num_steps]
+
+    for market in markets:
+        rows = [p for p in positions if p[0] == market]
+        buy_index = to_index(numpy.array([float(p[1]) for p in rows]))
+        # Unsold positions "sell" in the overflow bucket
+        sell_index = to_index(numpy.array([float(p[2]) if p[2] else float(end + step) for p in rows]))
+        quantity = numpy.array([float(p[3]) for p in rows])
+        cost = numpy.array([float(p[3] * p[4]) for p in rows])
+        scalped = numpy.array([float(p[7] or 0) for p in rows])
+        proceeds = numpy.array([float(p[5] * p[6]) if p[5] is not None and p[6] is not None else 0.0 for p in rows])
+
+        open_quantity = running_total(buy_index, quantity) - running_total(sell_index, quantity)
+        scalped_quantity = running_total(sell_index, scalped)
+
+        num_open += running_total(buy_index) - running_total(sell_index)
+        open_spent += running_total(buy_index, cost) - running_total(sell_index, cost)
+        spent += running_total(buy_index, cost)
+        recouped += running_total(sell_index, proceeds)
+
+        # Latest close at or before each grid point
+        candles = numpy.array(list(Candle.select(
+                Candle.timestamp, Candle.close
+            ).where(
+                Candle.market_id == Market.get_id(market),
+                Candle.interval == interval,
+                Candle.timestamp <= end
+            ).order_by(
+                Candle.timestamp
+            ).tuples()), dtype=float).reshape(-1, 2)
+        closes = numpy.zeros(num_steps)
+        if len(candles):
+            candle_index = numpy.searchsorted(candles[:, 0], grid, side='right') - 1
+            closes = numpy.where(candle_index >= 0, candles[numpy.maximum(candle_index, 0), 1], 0.0)
+
+        open_value += open_quantity * closes
+        scalped_value += scalped_quantity * closes
+        holdings[market] = (open_quantity, scalped_quantity)
+
+    def to_decimal(value):
+        return Decimal(f"{value:0.8f}")
+
+    snapshots = []
+    for i in range(num_steps):
+        snapshots.append({
+            "base_currency": base_currency,
+            "timestamp": int(grid[i]),
+            "num_open_positions": int(round(num_open[i])),
+            "open_spent": to_decimal(open_spent[i]),
+            "open_value": to_decimal(open_value[i]),
+            "scalped_value": to_decimal(scalped_value[i]),
+            "spent": to_decimal(spent[i]),
+            "recouped": to_decimal(recouped[i]),
+            "holdings": json.dumps({
+                    market: [f"{q[i]:0.8f}", f"{s[i]:0.8f}"]
+                    for (market, (q, s)) in holdings.items() if round(q[i], 8) or round(s[i], 8)
+                }),
+        })
+
+    with db.atomic():
+        PortfolioSnapshot.delete().where(PortfolioSnapshot.base_currency == base_currency).execute()
+        # 9 columns per row; stay under SQLite's 999 bound-variable limit
+        for batch in chunked(snapshots, 100):
+            PortfolioSnapshot.insert_many(batch).execute()
 
+    return num_steps
@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+
+from selective_dca_bot import config
+
+
+"""
+    Serves the snapshots each bot run publishes as a read-only JSON API:
+        GET /                       endpoints and when each was last updated
+        GET /positions/open
+        GET /positions/scalped
+        GET /metrics
+        GET /runs
+
+    The DB is opened read-only and nothing is recomputed per request. To run:
+        python status_server.py --port 8080
+"""
+parser = argparse.ArgumentParser(description='Selective DCA (Dollar Cost Averaging) Bot: status API')
+
+parser.add_argument('--host',
+                    default=config.STATUS_HOST,
+                    dest="host",
+                    help="Interface to listen on")
+
+parser.add_argument('--port',
+                    type=int,
+                    default=config.STATUS_PORT,
+                    dest="port",
+                    help="Port to listen on")
+
+parser.add_argument('--db',
+                    default=None,
+                    dest="db_file",
+                    help="Override the default SQLite db file (e.g. one account's DB under host.py)")
+
+parser.add_argument('--refresh',
+                    type=float,
+                    default=config.STATUS_REFRESH_SECONDS,
+                    dest="refresh_seconds",
+                    help="Seconds between checks for newly published snapshots")
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    # Must be set before the models are imported
+    if args.db_file:
+        config.SQLITE_DB_FILE = args.db_file
+    config.SQLITE_READ_ONLY = True
+
+    from selective_dca_bot.status import StatusServer
+
+    print(f"Serving status on http://{args.host}:{args.port}")
+    server = StatusServer(refresh_seconds=args.refresh_seconds)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass